@@ -0,0 +1,395 @@
+from __future__ import annotations
+import contextlib
+import fnmatch
+import io
+import json
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import scipy
+import soundfile as sf
+
+
+# Case name -> function(ctx); filled by @bench_case. A case does its setup,
+# then runs the measured part inside `with ctx.timed():`.
+CASES: dict[str, Callable[["BenchContext"], None]] = {}
+# The RSS regression check scales a case's growth by at least this much
+RSS_FLOOR_MB = 16.0
+
+
+def bench_case(name: str):
+    def deco(fn: Callable[[BenchContext], None]) -> Callable[[BenchContext], None]:
+        CASES[name] = fn
+        return fn
+    return deco
+
+
+def proc_io() -> tuple[int, int]:
+    # Bytes passed through read()/write() syscalls (page cache included), Linux only
+    try:
+        fields = dict(line.split(": ") for line in Path("/proc/self/io").read_text().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return -1, -1
+
+
+class BenchContext:
+    def __init__(self, sr: int, seconds: float, tmp: Path) -> None:
+        self.sr = sr
+        self.seconds = seconds
+        self.frames = int(sr * seconds)
+        self.tmp = tmp
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+        self.read_bytes = 0
+        self.written_bytes = 0
+
+    @contextlib.contextmanager
+    def timed(self):
+        r0, w0 = proc_io()
+        c0 = time.process_time()
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+        self.wall_s = time.perf_counter() - t0
+        self.cpu_s = time.process_time() - c0
+        r1, w1 = proc_io()
+        self.read_bytes = r1 - r0 if r0 >= 0 else -1
+        self.written_bytes = w1 - w0 if w0 >= 0 else -1
+
+    def noise(self) -> np.ndarray:
+        return (np.random.default_rng(0).standard_normal(self.frames) * 0.1).astype(np.float32)
+
+    def wav(self, name: str = "input.wav") -> Path:
+        # PCM_16 brown noise input for the file stages, written during setup
+        from generate_sleep_noise import generate_noise_to_file
+        path = self.tmp / name
+        with contextlib.redirect_stdout(io.StringIO()):
+            generate_noise_to_file(str(path), self.seconds, self.sr, "brown_noise", seed=0)
+        return path
+
+
+def _register_kernel_cases() -> None:
+    from noise_kernels import PRESETS
+
+    def make(preset: str):
+        def case(ctx: BenchContext) -> None:
+            from generate_sleep_noise import generate_block
+            rng = np.random.default_rng(0)
+            state: dict = {}
+            with ctx.timed():
+                done = 0
+                while done < ctx.frames:
+                    n = min(65536, ctx.frames - done)
+                    _, state = generate_block(preset, n, ctx.sr, rng, state)
+                    done += n
+        return case
+
+    for preset in PRESETS:
+        bench_case(f"generate_block:{preset}")(make(preset))
+
+
+_register_kernel_cases()
+
+
+def _register_spectral_cases() -> None:
+    # FFT engine with the default 18/1200 Hz filters baked in; compare with
+    # generate_block:<preset> + butter_filter
+    from spectral_noise import SHAPES
+
+    def make(preset: str):
+        def case(ctx: BenchContext) -> None:
+            from generate_sleep_noise import generate_block
+            rng = np.random.default_rng(0)
+            state: dict = {}
+            generate_block(preset, 1, ctx.sr, rng, state, "fft", 18.0, 1200.0)  # FIR design outside the timing
+            with ctx.timed():
+                done = 0
+                while done < ctx.frames:
+                    n = min(65536, ctx.frames - done)
+                    _, state = generate_block(preset, n, ctx.sr, rng, state, "fft", 18.0, 1200.0)
+                    done += n
+        return case
+
+    for preset in SHAPES:
+        bench_case(f"generate_block:{preset}:fft")(make(preset))
+
+
+_register_spectral_cases()
+
+
+@bench_case("moving_average_block")
+def _moving_average_block(ctx: BenchContext) -> None:
+    from generate_sleep_noise import moving_average_block
+    x = ctx.noise()
+    window = max(3, int(ctx.sr / 800))
+    with ctx.timed():
+        tail = np.zeros(0, dtype=np.float32)
+        for start in range(0, x.size, 65536):
+            _, tail = moving_average_block(x[start:start + 65536], window, tail)
+
+
+@bench_case("butter_filter")
+def _butter_filter(ctx: BenchContext) -> None:
+    from postprocess import butter_filter
+    x = ctx.noise()
+    with ctx.timed():
+        butter_filter(x, sr=ctx.sr, lowpass_hz=1200.0, highpass_hz=18.0)
+
+
+@bench_case("normalize_to_rms_db")
+def _normalize(ctx: BenchContext) -> None:
+    from postprocess import normalize_to_rms_db
+    x = ctx.noise()
+    with ctx.timed():
+        normalize_to_rms_db(x, target_db=-20.0, peak_ceiling_linear=0.98)
+
+
+@bench_case("stage:generate")
+def _generate(ctx: BenchContext) -> None:
+    from generate_sleep_noise import generate_noise_to_file
+    with ctx.timed():
+        generate_noise_to_file(str(ctx.tmp / "raw.wav"), ctx.seconds, ctx.sr, "brown_noise", seed=0)
+
+
+@bench_case("stage:generate_fft")
+def _generate_fft(ctx: BenchContext) -> None:
+    from generate_sleep_noise import generate_noise_to_file
+    with ctx.timed():
+        generate_noise_to_file(
+            str(ctx.tmp / "raw.wav"), ctx.seconds, ctx.sr, "brown_noise", seed=0,
+            engine="fft", highpass_hz=18.0, lowpass_hz=1200.0,
+        )
+
+
+def _postprocess_case(mode: str):
+    def case(ctx: BenchContext) -> None:
+        import postprocess
+        raw = ctx.wav()
+        with ctx.timed():
+            postprocess.main(str(raw), str(ctx.tmp / "final.wav"), ctx.sr, -20.0, 15, 18.0, 1200.0, 0.98, mode=mode)
+    return case
+
+
+bench_case("stage:postprocess_memory")(_postprocess_case("memory"))
+bench_case("stage:postprocess_stream")(_postprocess_case("stream"))
+
+
+@bench_case("stage:fused_render")
+def _fused(ctx: BenchContext) -> None:
+    from fused_render import render_fused
+    with ctx.timed():
+        render_fused(str(ctx.tmp / "final.wav"), ctx.seconds, ctx.sr, "brown_noise", 0, -20.0, 15, 18.0, 1200.0, 0.98)
+
+
+@bench_case("stream_metrics")
+def _stream_metrics(ctx: BenchContext) -> None:
+    from qc_report import stream_metrics
+    wav = ctx.wav()
+    with ctx.timed():
+        stream_metrics(wav)
+
+
+@bench_case("sha256_file")
+def _sha256_file(ctx: BenchContext) -> None:
+    from block_pipeline import sha256_file
+    wav = ctx.wav()
+    with ctx.timed():
+        sha256_file(wav)
+
+
+@bench_case("analyze_wav")
+def _analyze_wav(ctx: BenchContext) -> None:
+    from wav_analysis import analyze_wav
+    wav = ctx.wav()
+    with ctx.timed():
+        analyze_wav(wav)
+
+
+def _register_metric_cases() -> None:
+    from metrics import METRICS
+
+    def make(metric: str):
+        def case(ctx: BenchContext) -> None:
+            from metrics import make_metrics
+            x = ctx.noise()[:, None]
+            plugin = make_metrics([metric], ctx.sr, 1)[0]
+            with ctx.timed():
+                for start in range(0, x.shape[0], 65536):
+                    plugin.update(x[start:start + 65536])
+                plugin.result()
+        return case
+
+    for metric in METRICS:
+        bench_case(f"metric:{metric}")(make(metric))
+
+
+_register_metric_cases()
+
+
+@bench_case("make_zip")
+def _make_zip(ctx: BenchContext) -> None:
+    from pack_release import make_zip
+    wav = ctx.wav("final.wav")
+    (ctx.tmp / "metadata.json").write_text(json.dumps({"title": "bench"}), encoding="utf-8")
+    (ctx.tmp / "qc_report.json").write_text(json.dumps({"title": "bench"}), encoding="utf-8")
+    (ctx.tmp / "manifest.txt").write_text("bench\n", encoding="utf-8")
+    qc = {"wav_filename": wav.name, "metadata_filename": "metadata.json"}
+    with ctx.timed():
+        make_zip(ctx.tmp, ctx.tmp / "release_pack.zip", qc)
+
+
+def run_case(name: str, sr: int, seconds: float) -> dict:
+    # Runs in a fresh process, so ru_maxrss is the peak of this case alone
+    # (plus the interpreter and numpy/scipy imports, reported as base_rss_mb)
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with tempfile.TemporaryDirectory(prefix="audio_factory_bench_") as tmp:
+        ctx = BenchContext(sr, seconds, Path(tmp))
+        CASES[name](ctx)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "case": name,
+        "sample_rate": sr,
+        "seconds_audio": seconds,
+        "frames": ctx.frames,
+        "wall_s": ctx.wall_s,
+        "cpu_s": ctx.cpu_s,
+        "samples_per_sec": ctx.frames / max(ctx.wall_s, 1e-9),
+        "peak_rss_mb": peak_rss / 1024,
+        "base_rss_mb": base_rss / 1024,
+        "read_bytes": ctx.read_bytes,
+        "written_bytes": ctx.written_bytes,
+    }
+
+
+def result_id(r: dict) -> str:
+    return f"{r['case']}@{r['sample_rate']}/{r['seconds_audio']:g}s"
+
+
+def run_suite(patterns: list[str], sample_rates: list[int], durations: list[float], repeat: int) -> dict[str, dict]:
+    names = [n for n in CASES if any(fnmatch.fnmatch(n, p) for p in patterns)]
+    results: dict[str, dict] = {}
+    # One process per run; spawn so no state (caches, heap) leaks between cases
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn"), max_tasks_per_child=1) as pool:
+        for name in names:
+            for sr in sample_rates:
+                for seconds in durations:
+                    runs = [pool.submit(run_case, name, sr, seconds).result() for _ in range(repeat)]
+                    best = min(runs, key=lambda r: r["wall_s"])
+                    best["repeat"] = repeat
+                    results[result_id(best)] = best
+                    print_result(best)
+    return results
+
+
+def print_header() -> None:
+    print(f"{'case':<34}{'sr':>7}{'sec':>6}{'Msamples/s':>12}{'wall s':>9}{'peak RSS MB':>13}{'case MB':>9}{'read MB':>10}{'written MB':>12}")
+
+
+def print_result(r: dict) -> None:
+    print(
+        f"{r['case']:<34}{r['sample_rate']:>7}{r['seconds_audio']:>6g}{r['samples_per_sec'] / 1e6:>12.2f}"
+        f"{r['wall_s']:>9.3f}{r['peak_rss_mb']:>13.0f}{case_rss_mb(r):>9.0f}{r['read_bytes'] / 2**20:>10.1f}{r['written_bytes'] / 2**20:>12.1f}",
+        flush=True,
+    )
+
+
+def case_rss_mb(r: dict) -> float:
+    # Peak RSS the case itself added on top of the interpreter and imports
+    return max(0.0, r["peak_rss_mb"] - r["base_rss_mb"])
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], threshold: float) -> list[str]:
+    # Regression: throughput down or the case's own peak RSS up by more than
+    # `threshold` (fraction)
+    regressions = []
+    print(f"\n{'benchmark':<50}{'base Ms/s':>11}{'now Ms/s':>10}{'change':>9}{'RSS change':>12}")
+    for key, r in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        speed = r["samples_per_sec"] / base["samples_per_sec"] - 1
+        # Cases that allocate next to nothing are compared against RSS_FLOOR_MB,
+        # so allocator noise of a few MB does not count as a regression
+        rss = (case_rss_mb(r) - case_rss_mb(base)) / max(case_rss_mb(base), RSS_FLOOR_MB)
+        flags = []
+        if speed < -threshold:
+            flags.append("SLOWER")
+        if rss > threshold:
+            flags.append("MORE RAM")
+        if flags:
+            regressions.append(key)
+        print(
+            f"{key:<50}{base['samples_per_sec'] / 1e6:>11.2f}{r['samples_per_sec'] / 1e6:>10.2f}"
+            f"{speed:>+9.1%}{rss:>+12.1%}  {' '.join(flags)}"
+        )
+    return regressions
+
+
+def main(
+    out: str | None = None,
+    baseline: str | None = None,
+    threshold: float = 0.15,
+    patterns: list[str] | None = None,
+    sample_rates: list[int] | None = None,
+    durations: list[float] | None = None,
+    repeat: int = 3,
+) -> None:
+    print_header()
+    results = run_suite(patterns or ["*"], sample_rates or [32000, 44100, 48000], durations or [10.0, 60.0], repeat)
+    if out:
+        payload = {
+            "meta": {
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "scipy": scipy.__version__,
+                "soundfile": sf.__version__,
+                "libsndfile": sf.__libsndfile_version__,
+                "machine": platform.machine(),
+                "processor": platform.processor(),
+                "threshold": threshold,
+            },
+            "results": results,
+        }
+        Path(out).write_text(json.dumps(payload, indent=2), encoding="utf-8")
+        print(f"Benchmark results written: {out}")
+    if baseline:
+        base = json.loads(Path(baseline).read_text(encoding="utf-8"))["results"]
+        regressions = compare(results, base, threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {threshold:.0%} vs {baseline}")
+            sys.exit(1)
+        print(f"\nNo regressions beyond {threshold:.0%} vs {baseline}")
+
+
+def cli(argv: list[str] | None = None) -> None:
+    import argparse
+
+    p = argparse.ArgumentParser(description="Offline benchmarks for generator kernels and pipeline stages")
+    p.add_argument("--out", default=None, help="write results as JSON (e.g. a new baseline)")
+    p.add_argument("--compare", default=None, help="baseline JSON to compare against; exit 1 on regressions")
+    p.add_argument("--threshold", type=float, default=0.15)
+    p.add_argument("--cases", nargs="*", default=["*"], help="glob patterns, e.g. 'generate_block:*' 'stage:*'")
+    p.add_argument("--sr", type=int, nargs="*", default=[32000, 44100, 48000])
+    p.add_argument("--seconds", type=float, nargs="*", default=[10.0, 60.0])
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--list", action="store_true")
+    args = p.parse_args(argv)
+    if args.list:
+        print("\n".join(CASES))
+        return
+    main(args.out, args.compare, args.threshold, args.cases, args.sr, args.seconds, args.repeat)
+
+
+if __name__ == "__main__":
+    cli()
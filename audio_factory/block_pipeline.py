@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Callable, Sequence
+import hashlib
+import os
+import queue
+import threading
+
+
+# Buffers in flight: one per stage keeps every stage busy, one more absorbs
+# jitter. On a single core the threads would only take turns on it, so the
+# loops run inline there (depth 1).
+QUEUE_DEPTH = 4 if (os.cpu_count() or 1) > 1 else 1
+CHUNK_BYTES = 4 * 1024 * 1024
+
+
+class Slot:
+    # One preallocated buffer on its way from the reader through the stages
+    # and back to the pool; `n` is the filled length, `meta` rides along with
+    # the block (e.g. checkpoint state matching its end)
+
+    __slots__ = ("buf", "n", "meta")
+
+    def __init__(self, buf) -> None:
+        self.buf = buf
+        self.n = 0
+        self.meta = None
+
+    @property
+    def data(self):
+        return self.buf[:self.n]
+
+
+def run_blocks(buffers: Sequence, read: Callable[[Slot], bool], *stages: Callable[[Slot], None]) -> None:
+    """Run a block loop as a pipeline: `read` and every stage in its own thread.
+
+    `read(slot)` fills slot.buf (setting slot.n and optionally slot.meta) and
+    returns False at the end of the input; the stages then see every block in
+    order, e.g. compute -> write. Blocks only live in `buffers`, preallocated
+    by the caller, so len(buffers) bounds the queue depth and the memory:
+    the reader waits for a buffer the last stage has handed back.
+
+    Worth it where the work releases the GIL (libsndfile I/O, file reads,
+    hashlib, large numpy kernels): the disk and the CPU then overlap instead
+    of taking turns. The first exception of any thread is re-raised here
+    after all threads stopped; blocks still queued at that point are dropped.
+    With a single buffer nothing can overlap: the loop runs in the calling
+    thread.
+    """
+    if not stages:
+        raise ValueError("run_blocks needs at least one stage after read")
+    if len(buffers) == 1:
+        slot = Slot(buffers[0])
+        while read(slot):
+            for stage in stages:
+                stage(slot)
+            slot.meta = None
+        return
+    free: queue.SimpleQueue[Slot] = queue.SimpleQueue()
+    for buf in buffers:
+        free.put(Slot(buf))
+    inputs: list[queue.SimpleQueue[Slot | None]] = [queue.SimpleQueue() for _ in stages]
+    errors: list[BaseException] = []
+    failed = threading.Event()
+
+    def reader() -> None:
+        try:
+            while not failed.is_set():
+                slot = free.get()
+                slot.meta = None
+                if failed.is_set() or not read(slot):
+                    break
+                inputs[0].put(slot)
+        except BaseException as e:
+            errors.append(e)
+            failed.set()
+        inputs[0].put(None)
+
+    def worker(i: int) -> None:
+        last = i == len(stages) - 1
+        while (slot := inputs[i].get()) is not None:
+            if not failed.is_set():
+                try:
+                    stages[i](slot)
+                except BaseException as e:
+                    errors.append(e)
+                    failed.set()
+            if failed.is_set():
+                free.put(slot)  # drain, so the reader never waits on a dead stage
+            else:
+                (free if last else inputs[i + 1]).put(slot)
+        if not last:
+            inputs[i + 1].put(None)
+
+    threads = [threading.Thread(target=reader, name="blocks-read", daemon=True)]
+    threads += [
+        threading.Thread(target=worker, args=(i,), name=f"blocks-{getattr(stage, '__name__', i)}", daemon=True)
+        for i, stage in enumerate(stages)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+
+def sha256_file(path: str | Path, chunk_bytes: int = CHUNK_BYTES, depth: int = QUEUE_DEPTH) -> str:
+    # The next chunk is read while the previous one is hashed
+    h = hashlib.sha256()
+    with open(path, "rb", buffering=0) as f:
+
+        def read(slot: Slot) -> bool:
+            slot.n = f.readinto(slot.buf)
+            return slot.n > 0
+
+        def update(slot: Slot) -> None:
+            h.update(slot.buf[:slot.n])
+
+        run_blocks([memoryview(bytearray(chunk_bytes)) for _ in range(depth)], read, update)
+    return h.hexdigest()
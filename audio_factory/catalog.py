@@ -0,0 +1,272 @@
+from __future__ import annotations
+
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+import json
+import sqlite3
+
+
+CATALOG_NAME = "catalog.sqlite"
+QC_REPORT_NAME = "qc_report.json"
+PACK_SHA_NAME = "release_pack.sha256"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS releases (
+    release_dir TEXT PRIMARY KEY,     -- absolute path
+    name TEXT NOT NULL,               -- dir name, <ts>_<preset>[_<hours>h]
+    status TEXT NOT NULL,             -- qc | packed
+    preset TEXT NOT NULL,
+    title TEXT,
+    artist TEXT,
+    album TEXT,
+    genre TEXT,
+    mood TEXT,                        -- JSON list
+    description TEXT,
+    duration_seconds REAL,
+    sample_rate INTEGER,
+    channels INTEGER,
+    target_rms_db REAL,
+    peak_ceiling_linear REAL,
+    params_fingerprint TEXT,          -- render + metadata parameters, run_pipeline.release_fingerprint
+    rms_dbfs REAL,
+    peak_linear REAL,
+    peak_dbfs REAL,
+    integrated_lufs REAL,
+    loudness_range_lu REAL,
+    true_peak_dbtp REAL,
+    dropout_count INTEGER,
+    channel_balance_db REAL,
+    final_wav TEXT,
+    final_wav_sha256 TEXT,
+    file_size_mb REAL,
+    deliverable TEXT,
+    deliverable_sha256 TEXT,
+    pack_zip TEXT,
+    pack_sha256 TEXT,
+    pack_bytes INTEGER,
+    manifest TEXT,
+    qc_json TEXT,                     -- the full report, for anything without a column
+    qc_time TEXT NOT NULL             -- when qc_report.json was written
+);
+CREATE INDEX IF NOT EXISTS releases_preset ON releases (preset, duration_seconds);
+CREATE INDEX IF NOT EXISTS releases_title ON releases (title);
+CREATE INDEX IF NOT EXISTS releases_qc_time ON releases (qc_time);
+"""
+
+# Columns added after the first catalogues were written: name -> type
+ADDED_COLUMNS = {"params_fingerprint": "TEXT"}
+
+# qc_report.json keys stored as columns of the same name
+QC_COLUMNS = (
+    "title", "artist", "album", "genre", "duration_seconds", "sample_rate", "channels",
+    "target_rms_db", "peak_ceiling_linear", "params_fingerprint", "rms_dbfs", "peak_linear", "peak_dbfs",
+    "integrated_lufs", "loudness_range_lu", "true_peak_dbtp", "dropout_count", "channel_balance_db",
+    "final_wav_sha256", "file_size_mb", "deliverable_sha256",
+)
+
+
+def catalog_path(release_root: str | Path) -> Path:
+    return Path(release_root) / CATALOG_NAME
+
+
+def connect(db_path: str | Path) -> sqlite3.Connection:
+    # WAL and a generous busy timeout: parallel batch workers index concurrently
+    conn = sqlite3.connect(str(db_path), timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    existing = {row["name"] for row in conn.execute("PRAGMA table_info(releases)")}
+    for column, kind in ADDED_COLUMNS.items():
+        if column not in existing:
+            try:
+                conn.execute(f"ALTER TABLE releases ADD COLUMN {column} {kind}")
+            except sqlite3.OperationalError:  # added by a concurrent worker meanwhile
+                pass
+    return conn
+
+
+def duration_tolerance(seconds: float) -> float:
+    # Same ±0.1% as the duration quality gate, at least one second
+    return max(1.0, 0.001 * seconds)
+
+
+def release_row(release_dir: Path, qc: dict, pack: dict | None = None) -> dict:
+    release_dir = release_dir.resolve()
+    meta_path = release_dir / qc.get("metadata_filename", "metadata.json")
+    meta = json.loads(meta_path.read_text(encoding="utf-8")) if meta_path.exists() else {}
+    qc_path = release_dir / QC_REPORT_NAME
+    qc_time = datetime.fromtimestamp(qc_path.stat().st_mtime) if qc_path.exists() else datetime.now()
+    pack = pack or {}
+    return {
+        "release_dir": str(release_dir),
+        "name": release_dir.name,
+        "status": "packed" if pack else "qc",
+        "preset": qc.get("preset_name", ""),
+        **{column: qc.get(column) for column in QC_COLUMNS},
+        "mood": json.dumps(meta.get("mood", [])),
+        "description": meta.get("description", ""),
+        "final_wav": str(release_dir / qc.get("wav_filename", "")),
+        "deliverable": str(release_dir / qc.get("deliverable_filename", qc.get("wav_filename", ""))),
+        "pack_zip": pack.get("zip"),
+        "pack_sha256": pack.get("sha256"),
+        "pack_bytes": pack.get("bytes"),
+        "manifest": pack.get("manifest"),
+        "qc_json": json.dumps(qc),
+        "qc_time": qc_time.isoformat(timespec="seconds"),
+    }
+
+
+def upsert(conn: sqlite3.Connection, row: dict) -> None:
+    columns = ", ".join(row)
+    updates = ", ".join(f"{c} = excluded.{c}" for c in row if c != "release_dir")
+    conn.execute(
+        f"INSERT INTO releases ({columns}) VALUES ({', '.join('?' * len(row))}) "
+        f"ON CONFLICT (release_dir) DO UPDATE SET {updates}",
+        list(row.values()),
+    )
+
+
+def index_release(release_dir: str | Path, qc: dict, pack: dict | None = None, db_path: str | Path | None = None) -> None:
+    """Insert or update one release in the catalogue next to its release dir.
+
+    qc_report indexes a release with status "qc"; pack_release indexes it
+    again with `pack` ({"zip", "sha256", "bytes", "manifest"}) as "packed".
+    A QC run after packing resets the pack columns, the zip is rebuilt next.
+    """
+    release_dir = Path(release_dir)
+    db_path = db_path or catalog_path(release_dir.resolve().parent)
+    with closing(connect(db_path)) as conn, conn:
+        upsert(conn, release_row(release_dir, qc, pack))
+
+
+def read_pack(release_dir: Path) -> dict | None:
+    # Pack columns of a release dir on disk, if pack_release finished there
+    sha_path = release_dir / PACK_SHA_NAME
+    if not sha_path.exists():
+        return None
+    sha, _, name = sha_path.read_text(encoding="utf-8").strip().partition("  ")
+    zip_path = release_dir / name
+    if not zip_path.exists():
+        return None
+    manifest = release_dir / "manifest.txt"
+    return {
+        "zip": str(zip_path.resolve()),
+        "sha256": sha,
+        "bytes": zip_path.stat().st_size,
+        "manifest": str(manifest.resolve()) if manifest.exists() else None,
+    }
+
+
+def rebuild(release_root: str | Path, db_path: str | Path | None = None) -> int:
+    # Replaces the index with what the release dirs on disk say; returns the release count
+    release_root = Path(release_root)
+    rows = []
+    for qc_path in sorted(release_root.glob(f"*/{QC_REPORT_NAME}")):
+        try:
+            qc = json.loads(qc_path.read_text(encoding="utf-8"))
+        except ValueError:
+            print(f"Skipping unreadable {qc_path}")
+            continue
+        rows.append(release_row(qc_path.parent, qc, read_pack(qc_path.parent)))
+    with closing(connect(db_path or catalog_path(release_root))) as conn, conn:
+        conn.execute("DELETE FROM releases")
+        for row in rows:
+            upsert(conn, row)
+    return len(rows)
+
+
+def find_releases(
+    conn: sqlite3.Connection,
+    preset: str | None = None,
+    title: str | None = None,
+    title_like: str | None = None,
+    hours: float | None = None,
+    status: str | None = None,
+    limit: int | None = None,
+) -> list[sqlite3.Row]:
+    # Newest first
+    where, params = [], []
+    if preset is not None:
+        where.append("preset = ?")
+        params.append(preset)
+    if title is not None:
+        where.append("title = ?")
+        params.append(title)
+    if title_like is not None:
+        where.append("title LIKE ?")
+        params.append(title_like)
+    if hours is not None:
+        seconds = hours * 3600
+        where.append("abs(duration_seconds - ?) <= ?")
+        params += [seconds, duration_tolerance(seconds)]
+    if status is not None:
+        where.append("status = ?")
+        params.append(status)
+    sql = "SELECT * FROM releases" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY qc_time DESC, name"
+    if limit is not None:
+        sql += f" LIMIT {int(limit)}"
+    return conn.execute(sql, params).fetchall()
+
+
+def print_rows(rows: list[sqlite3.Row], as_json: bool) -> None:
+    if as_json:
+        for row in rows:
+            print(json.dumps({k: row[k] for k in row.keys() if k != "qc_json"}))
+        return
+    print(f"{'release':<42}{'status':<8}{'hours':>7}{'RMS dB':>8}{'peak dB':>8}{'LUFS':>8}{'dBTP':>7}  title")
+    for r in rows:
+        print(
+            f"{r['name']:<42}{r['status']:<8}{(r['duration_seconds'] or 0) / 3600:>7.2f}"
+            f"{r['rms_dbfs'] or 0:>8.2f}{r['peak_dbfs'] or 0:>8.2f}{r['integrated_lufs'] or 0:>8.2f}"
+            f"{r['true_peak_dbtp'] or 0:>7.2f}  {r['title']}"
+        )
+    print(f"{len(rows)} release(s)")
+
+
+def cli(argv: list[str] | None = None) -> None:
+    import argparse
+
+    p = argparse.ArgumentParser(description="SQLite index of the releases under release_root")
+    p.add_argument("--release_root", default="releases")
+    p.add_argument("--catalog", default=None, help=f"default: <release_root>/{CATALOG_NAME}")
+    sub = p.add_subparsers(dest="command", required=True)
+    q = sub.add_parser("query", help="list releases, newest first")
+    q.add_argument("--preset", default=None)
+    q.add_argument("--title", default=None, help="exact title, e.g. to check for a duplicate")
+    q.add_argument("--title_like", default=None, help="SQL LIKE pattern, e.g. '%%Rain%%'")
+    q.add_argument("--hours", type=float, default=None)
+    q.add_argument("--status", choices=["qc", "packed"], default=None)
+    q.add_argument("--limit", type=int, default=None, help="1: only the latest")
+    q.add_argument("--json", action="store_true")
+    s = sub.add_parser("sql", help="run a read-only SQL query on the releases table")
+    s.add_argument("query")
+    sub.add_parser("rebuild", help="re-index all release dirs from their qc_report.json and pack files")
+    args = p.parse_args(argv)
+    db_path = Path(args.catalog) if args.catalog else catalog_path(args.release_root)
+
+    if args.command == "rebuild":
+        count = rebuild(args.release_root, db_path)
+        print(f"Indexed {count} release(s) into {db_path}")
+        return
+    if not db_path.exists():
+        raise SystemExit(f"No catalogue at {db_path} (run: catalog.py rebuild)")
+    if args.command == "sql":
+        with closing(sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)) as conn:
+            try:
+                cur = conn.execute(args.query)
+            except sqlite3.Error as e:
+                raise SystemExit(f"SQL error: {e}")
+            print("\t".join(d[0] for d in cur.description or []))
+            for row in cur:
+                print("\t".join("" if v is None else str(v) for v in row))
+        return
+    with closing(connect(db_path)) as conn:
+        rows = find_releases(
+            conn, args.preset, args.title, args.title_like, args.hours, args.status, args.limit,
+        )
+    print_rows(rows, args.json)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+from pathlib import Path
+import json
+import os
+import struct
+import numpy as np
+import soundfile as sf
+
+
+BYTES_PER_SAMPLE = {"PCM_16": 2, "PCM_24": 3, "PCM_32": 4, "FLOAT": 4, "DOUBLE": 8}
+
+
+def checkpoint_path(out_path: str | Path) -> Path:
+    return Path(str(out_path) + ".ckpt.json")
+
+
+def to_jsonable(obj):
+    # numpy arrays/scalars -> JSON; floats keep full precision through repr
+    if isinstance(obj, np.ndarray):
+        return {"__ndarray__": obj.tolist(), "dtype": str(obj.dtype)}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, dict):
+        return {k: to_jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_jsonable(v) for v in obj]
+    return obj
+
+
+def from_jsonable(obj):
+    if isinstance(obj, dict):
+        if "__ndarray__" in obj:
+            return np.array(obj["__ndarray__"], dtype=obj["dtype"])
+        return {k: from_jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [from_jsonable(v) for v in obj]
+    return obj
+
+
+def save_checkpoint(path: Path, payload: dict) -> None:
+    # Atomic replace, so a kill during the write leaves the previous checkpoint
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(to_jsonable(payload), f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load_checkpoint(path: Path, params: dict) -> dict | None:
+    # Returns the checkpoint if it was written by a run with the same params
+    if not path.exists():
+        return None
+    payload = from_jsonable(json.loads(path.read_text(encoding="utf-8")))
+    saved = payload.get("params", {})
+    if saved != to_jsonable(params):
+        raise ValueError(f"Checkpoint {path} was written with different parameters: {saved} != {params}")
+    return payload
+
+
+def wav_data_offset(path: str | Path) -> int:
+    # Byte offset of the sample data in a RIFF/WAVE file
+    with open(path, "rb") as f:
+        riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+        if riff not in (b"RIFF", b"RF64") or wave != b"WAVE":
+            raise ValueError(f"Not a WAV file: {path}")
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f"No data chunk in {path}")
+            chunk_id, size = struct.unpack("<4sI", header)
+            if chunk_id == b"data":
+                return f.tell()
+            f.seek(size + (size & 1), os.SEEK_CUR)
+
+
+def open_wav_resume(path: str | Path, frames: int, sr: int, channels: int, subtype: str) -> sf.SoundFile:
+    """Reopen a partially written WAV, cut it back to `frames` and position the writer there.
+
+    A killed writer leaves a header without sizes plus possibly a half-written
+    block; libsndfile derives the length from the file size, so truncating the
+    data to the checkpointed frame count is enough. Closing the returned file
+    writes the same header an uninterrupted run would have written.
+    """
+    frame_bytes = BYTES_PER_SAMPLE[subtype] * channels
+    os.truncate(path, wav_data_offset(path) + frames * frame_bytes)
+    f = sf.SoundFile(str(path), mode="r+")
+    if f.samplerate != sr or f.channels != channels or f.subtype != subtype or f.frames != frames:
+        f.close()
+        raise ValueError(f"Cannot resume {path}: format or length does not match the checkpoint")
+    f.seek(frames)
+    return f
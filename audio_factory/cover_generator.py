@@ -1,36 +1,108 @@
 ﻿from __future__ import annotations
 from PIL import Image, ImageDraw, ImageFont
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import hashlib
+import json
+import os
+import shutil
+import threading
 
-def main(out_path: str, title: str, artist: str, size: int = 3000) -> None:
-    Path(out_path).parent.mkdir(parents=True, exist_ok=True)
-    img = Image.new("RGB", (size, size), color=(10, 10, 14))
-    draw = ImageDraw.Draw(img)
+JPEG_QUALITY = 95
+BACKGROUND = (10, 10, 14)
+ACCENT = (80, 80, 95)
+MARGIN = 180
+
+# FreeType-Fonts werden von allen Threads geteilt; nur das Text-Zeichnen ist gesperrt,
+# das JPEG-Encoding (der teure Teil) läuft parallel
+_DRAW_LOCK = threading.Lock()
 
-    # Systemfont fallback (ohne externe Fonts)
+@lru_cache(maxsize=None)
+def load_fonts() -> tuple[ImageFont.ImageFont, ImageFont.ImageFont, str]:
+    # Systemfont fallback (ohne externe Fonts); einmal pro Prozess aufgelöst
     try:
-        font_title = ImageFont.truetype("arial.ttf", 120)
-        font_artist = ImageFont.truetype("arial.ttf", 70)
-    except:
-        font_title = ImageFont.load_default()
-        font_artist = ImageFont.load_default()
+        return ImageFont.truetype("arial.ttf", 120), ImageFont.truetype("arial.ttf", 70), "arial.ttf:120/70"
+    except OSError:
+        print("Cover font arial.ttf not found, using PIL default font")
+        return ImageFont.load_default(), ImageFont.load_default(), "default"
 
-    margin = 180
-    draw.text((margin, margin), artist, fill=(220, 220, 230), font=font_artist)
-    draw.text((margin, margin + 140), title, fill=(240, 240, 245), font=font_title)
+@lru_cache(maxsize=4)
+def template(size: int) -> tuple[Image.Image, str]:
+    # Hintergrund + minimaler Akzentbalken, vorgerendert; Hash über Pixel, Fonts und Encoder
+    img = Image.new("RGB", (size, size), color=BACKGROUND)
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([MARGIN, size - 260, size - MARGIN, size - 220], fill=ACCENT)
+    h = hashlib.sha256(img.tobytes())
+    h.update(f"{load_fonts()[2]}|q{JPEG_QUALITY}".encode("utf-8"))
+    return img, h.hexdigest()
 
-    # Minimaler Akzentbalken
-    draw.rectangle([margin, size - 260, size - margin, size - 220], fill=(80, 80, 95))
+def cache_key(title: str, artist: str, size: int) -> str:
+    _, template_hash = template(size)
+    return hashlib.sha256(json.dumps([title, artist, size, template_hash]).encode("utf-8")).hexdigest()[:32]
 
-    img.save(out_path, quality=95)
-    print(f"Cover written: {out_path}")
+def render_cover(title: str, artist: str, size: int = 3000) -> Image.Image:
+    # Nur die Textebene wird pro Titel gezeichnet
+    base, _ = template(size)
+    img = base.copy()
+    font_title, font_artist, _ = load_fonts()
+    with _DRAW_LOCK:
+        draw = ImageDraw.Draw(img)
+        draw.text((MARGIN, MARGIN), artist, fill=(220, 220, 230), font=font_artist)
+        draw.text((MARGIN, MARGIN + 140), title, fill=(240, 240, 245), font=font_title)
+    return img
 
-if __name__ == "__main__":
+def write_cover(out_path: str, title: str, artist: str, size: int = 3000, cache_dir: str | None = None) -> bool:
+    # Returns True if the cover came from the cache (no render, no encode)
+    out = Path(out_path)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    cached = Path(cache_dir) / f"{cache_key(title, artist, size)}.jpg" if cache_dir else None
+    if cached is not None and cached.exists():
+        if out.resolve() != cached.resolve():
+            shutil.copyfile(cached, out)
+        return True
+    img = render_cover(title, artist, size)
+    if cached is None:
+        img.save(out, quality=JPEG_QUALITY)
+        return False
+    cached.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cached.with_name(f"{cached.stem}.{os.getpid()}.{threading.get_ident()}.tmp.jpg")
+    img.save(tmp, quality=JPEG_QUALITY)
+    os.replace(tmp, cached)
+    shutil.copyfile(cached, out)
+    return False
+
+def render_batch(covers: list[dict], size: int = 3000, cache_dir: str | None = None, workers: int | None = None) -> list[bool]:
+    # covers: [{"out", "title", "artist"}, ...]; returns the cache hit flag per cover
+    load_fonts()
+    template(size)
+    with ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 1)) as pool:
+        futures = [pool.submit(write_cover, c["out"], c["title"], c["artist"], size, cache_dir) for c in covers]
+        return [f.result() for f in futures]
+
+def main(out_path: str, title: str, artist: str, size: int = 3000, cache_dir: str | None = None) -> None:
+    hit = write_cover(out_path, title, artist, size, cache_dir)
+    print(f"Cover written: {out_path}" + (" (cached)" if hit else ""))
+
+def cli(argv: list[str] | None = None) -> None:
     import argparse
     p = argparse.ArgumentParser()
-    p.add_argument("--out", required=True)
-    p.add_argument("--title", required=True)
-    p.add_argument("--artist", required=True)
+    p.add_argument("--out")
+    p.add_argument("--title")
+    p.add_argument("--artist")
     p.add_argument("--size", type=int, default=3000)
-    args = p.parse_args()
-    main(args.out, args.title, args.artist, args.size)
+    p.add_argument("--cache_dir", default=None)
+    p.add_argument("--batch", default=None, help='JSON-Liste [{"out", "title", "artist"}, ...]')
+    p.add_argument("--workers", type=int, default=None)
+    args = p.parse_args(argv)
+    if args.batch:
+        covers = json.loads(Path(args.batch).read_text(encoding="utf-8"))
+        hits = render_batch(covers, args.size, args.cache_dir, args.workers)
+        print(f"Covers written: {len(covers)} ({sum(hits)} cached)")
+        return
+    if not (args.out and args.title and args.artist):
+        p.error("--out, --title and --artist are required without --batch")
+    main(args.out, args.title, args.artist, args.size, args.cache_dir)
+
+if __name__ == "__main__":
+    cli()
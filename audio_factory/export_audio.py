@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+from pathlib import Path
+import queue
+import threading
+import numpy as np
+import soundfile as sf
+
+from block_pipeline import sha256_file
+from checkpoint import BYTES_PER_SAMPLE, wav_data_offset
+from tracing import span
+from wav_analysis import CHUNK_BYTES, PCM_SCALE, decode_pcm, load_sidecar, write_sidecar
+
+
+# Export format name -> (libsndfile container, file extension)
+EXPORT_FORMATS = {"wav": ("WAV", "wav"), "flac": ("FLAC", "flac"), "ogg": ("OGG", "ogg")}
+# Blocks queued per encoder before the renderer waits for it
+QUEUE_BLOCKS = 8
+
+
+def parse_export(spec: str) -> tuple[str, str]:
+    # "flac" / "flac:PCM_24" / "ogg:VORBIS" -> (format, subtype)
+    fmt, _, subtype = spec.partition(":")
+    fmt = fmt.lower()
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt} (known: {', '.join(EXPORT_FORMATS)})")
+    container = EXPORT_FORMATS[fmt][0]
+    subtype = subtype.upper() or sf.default_subtype(container)
+    if not sf.check_format(container, subtype):
+        raise ValueError(f"{container} cannot store {subtype}")
+    return fmt, subtype
+
+
+def export_path(master: str | Path, spec: str) -> Path:
+    # x_final.wav -> x_final.flac, x_final.ogg; a WAV export keeps its subtype in
+    # the name (x_final_pcm_24.wav), so it never overwrites the master
+    fmt, subtype = parse_export(spec)
+    master = Path(master)
+    if fmt == "wav":
+        return master.with_name(f"{master.stem}_{subtype.lower()}.wav")
+    return master.with_suffix("." + EXPORT_FORMATS[fmt][1])
+
+
+def export_info(path: str | Path) -> dict:
+    # Sidecar written by the encoder, or the same fields computed from the file
+    path = Path(path)
+    info = load_sidecar(path, metrics=[])
+    if info is None:
+        sfi = sf.info(str(path))
+        st = path.stat()
+        info = {
+            "sha256": sha256_file(path),
+            "frames": sfi.frames,
+            "sample_rate": sfi.samplerate,
+            "channels": sfi.channels,
+            "format": sfi.format,
+            "subtype": sfi.subtype,
+            "file_size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "metrics": {},
+        }
+        write_sidecar(path, info)
+    return info
+
+
+class Encoder:
+    """One export target, encoded in its own thread from a bounded queue.
+
+    libsndfile releases the GIL while encoding, so several encoders and the
+    renderer feeding them run concurrently. PCM_16 targets get the renderer's
+    quantized int16 blocks (a PCM_16 FLAC decodes bit-identical to the master
+    WAV), all others the float blocks.
+    """
+
+    def __init__(self, path: Path, fmt: str, subtype: str, sr: int, channels: int) -> None:
+        self.path = path
+        self.fmt = fmt
+        self.subtype = subtype
+        self.wants_pcm = subtype == "PCM_16"
+        self.f = sf.SoundFile(
+            str(path), mode="w", samplerate=sr, channels=channels, subtype=subtype, format=EXPORT_FORMATS[fmt][0],
+        )
+        self.queue: queue.Queue[np.ndarray | None] = queue.Queue(QUEUE_BLOCKS)
+        self.error: BaseException | None = None
+        self.thread = threading.Thread(target=self._run, name=f"encode-{path.name}", daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        try:
+            with span("export.encode", file=self.path.name, format=self.fmt, subtype=self.subtype) as sp:
+                while True:
+                    block = self.queue.get()
+                    if block is None:
+                        break
+                    self.f.write(block)
+                    sp.add(len(block))
+                self.f.close()
+        except BaseException as e:
+            self.error = e
+            # Drain so the producer never blocks on a dead encoder
+            while self.queue.get() is not None:
+                pass
+
+    def put(self, block: np.ndarray, pcm: np.ndarray | None) -> None:
+        self.queue.put(pcm if self.wants_pcm and pcm is not None else block)
+
+    def finish(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+        if not self.f.closed:
+            self.f.close()
+        if self.error is not None:
+            raise self.error
+
+
+class ExportSet:
+    """Extra encodings of one rendered output, fed block by block while it is written.
+
+    Plugged into wav_analysis.AnalyzingWavWriter (or fed directly). If the
+    blocks do not add up to `frames` (e.g. a pass resumed from a checkpoint
+    only sees the rest of the signal), close() encodes the targets from the
+    finished master WAV instead.
+    """
+
+    def __init__(self, master: str | Path, specs: list[str], frames: int, sr: int, channels: int) -> None:
+        self.master = Path(master)
+        self.targets = [(export_path(master, spec), *parse_export(spec)) for spec in specs]
+        self.frames = frames
+        self.sr = sr
+        self.channels = channels
+        self.fed = 0
+        self.encoders = [Encoder(path, fmt, subtype, sr, channels) for path, fmt, subtype in self.targets]
+
+    def write(self, block: np.ndarray, pcm: np.ndarray | None = None) -> None:
+        for encoder in self.encoders:
+            encoder.put(block, pcm)
+        self.fed += len(block)
+
+    def close(self) -> list[dict]:
+        # Call after the master WAV is closed
+        for encoder in self.encoders:
+            encoder.finish()
+        if self.fed != self.frames:
+            return export_wav(self.master, [f"{fmt}:{subtype}" for _, fmt, subtype in self.targets])
+        results = []
+        for path, fmt, subtype in self.targets:
+            st = path.stat()
+            info = {
+                "sha256": sha256_file(path),
+                "frames": self.fed,
+                "sample_rate": self.sr,
+                "channels": self.channels,
+                "format": EXPORT_FORMATS[fmt][0],
+                "subtype": subtype,
+                "file_size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "metrics": {},
+            }
+            write_sidecar(path, info)
+            results.append({"path": str(path), **info})
+        return results
+
+    def abort(self) -> None:
+        for encoder in self.encoders:
+            try:
+                encoder.finish()
+            except BaseException:
+                pass
+            encoder.path.unlink(missing_ok=True)
+
+
+def export_wav(master: str | Path, specs: list[str], chunk_bytes: int = CHUNK_BYTES) -> list[dict]:
+    """Encode `specs` from a finished WAV: one read, all encoders in parallel.
+
+    Targets with more resolution than the master (e.g. PCM_24 from a PCM_16
+    WAV) only carry the master's resolution; the renderers feed them the float
+    signal directly when the export is set up before rendering.
+    """
+    master = Path(master)
+    info = sf.info(str(master))
+    frame_bytes = BYTES_PER_SAMPLE[info.subtype] * info.channels
+    data_start = wav_data_offset(master)
+    remaining = info.frames * frame_bytes
+    exports = ExportSet(master, specs, info.frames, info.samplerate, info.channels)
+    try:
+        with master.open("rb", buffering=0) as f, span("export.read", file=master.name) as sp:
+            f.seek(data_start)
+            while remaining > 0:
+                # Fresh buffer per chunk: the encoders still hold earlier ones
+                buf = f.read(min(remaining, max(frame_bytes, chunk_bytes // frame_bytes * frame_bytes)))
+                if not buf:
+                    break
+                samples = decode_pcm(memoryview(buf)[:len(buf) - len(buf) % frame_bytes], info.subtype)
+                if info.subtype == "PCM_16":
+                    # int16 goes in as it is; libsndfile scales it to the target subtype
+                    pcm = samples.reshape(-1, info.channels) if info.channels > 1 else samples
+                    exports.write(pcm, pcm)
+                else:
+                    block = samples.astype(np.float32) * np.float32(1.0 / PCM_SCALE[info.subtype])
+                    exports.write(block.reshape(-1, info.channels) if info.channels > 1 else block)
+                remaining -= len(buf)
+                sp.add(len(samples) // info.channels)
+    except BaseException:
+        exports.abort()
+        raise
+    return exports.close()
+
+
+def main(inp: str, specs: list[str]) -> None:
+    for result in export_wav(inp, specs):
+        size_mb = result["file_size"] / (1024 * 1024)
+        print(f"Exported {result['format']}/{result['subtype']}: {result['path']} ({size_mb:.1f} MB)")
+
+
+def cli(argv: list[str] | None = None) -> None:
+    import argparse
+
+    p = argparse.ArgumentParser(description="Encode a rendered WAV into further formats in one read")
+    p.add_argument("--in", dest="inp", required=True)
+    p.add_argument("--export", nargs="+", required=True, help="e.g. flac flac:PCM_24 wav:PCM_24 ogg:VORBIS")
+    args = p.parse_args(argv)
+    main(args.inp, args.export)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,229 @@
+from __future__ import annotations
+import math
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import soundfile as sf
+from scipy.signal import sosfilt
+
+from export_audio import ExportSet, export_path
+from generate_sleep_noise import generate_block
+from postprocess import butter_sos, fade_gain, normalization_gain, per_frame, sos_zi, update_prefix_stats
+from tracing import span
+from wav_analysis import AnalyzingWavWriter
+
+
+def processed_blocks(
+    preset: str,
+    total_frames: int,
+    sr: int,
+    seed: int,
+    sos: np.ndarray | None,
+    block_frames: int = 65536,
+    engine: str = "kernel",
+    highpass_hz: float | None = None,
+    lowpass_hz: float | None = None,
+    channels: int = 1,
+    correlation: float = 0.0,
+) -> Iterator[np.ndarray]:
+    # Generator -> filter in float32 (fades are applied per output). Each call
+    # starts a fresh RNG from `seed`, so iterating twice yields the same audio
+    # twice. The fft engine gets the filters itself and `sos` is None. Blocks
+    # are (n, channels) for channels > 1.
+    rng = np.random.default_rng(seed)
+    state: dict = {}
+    zi = None
+    written = 0
+    while written < total_frames:
+        n = min(block_frames, total_frames - written)
+        block, state = generate_block(
+            preset, n, sr, rng, state, engine, highpass_hz, lowpass_hz, channels, correlation,
+        )
+        block = np.clip(block, -1.0, 1.0)
+        if sos is not None:
+            if zi is None:
+                zi = sos_zi(sos, block[0])
+            y, zi = sosfilt(sos, block, axis=0, zi=zi)
+            block = y.astype(np.float32, order="C")
+        yield block
+        written += n
+
+
+def render_fused(
+    out: str,
+    duration_sec: float,
+    sr: int,
+    preset: str,
+    seed: int,
+    target_rms_db: float,
+    fade_seconds: int,
+    hp: float,
+    lp: float,
+    peak_ceiling_linear: float,
+    block_frames: int = 65536,
+    variants: list[tuple[str, int]] | None = None,
+    exports: list[str] | None = None,
+    engine: str = "kernel",
+    channels: int = 1,
+    correlation: float = 0.0,
+) -> list[tuple[float, float]]:
+    """Generate and postprocess in one go, only the outputs are written to disk.
+
+    Pass 1 renders the chain and collects RMS/peak, pass 2 replays the generator
+    from `seed` and writes the normalized PCM_16 output. No raw WAV, no 16-bit
+    quantization before filtering.
+
+    The filters have to be causal here (a backward pass would need the whole
+    signal), so the highpass/lowpass cascade runs twice forward. That gives the
+    same magnitude response as filtfilt in postprocess, but not zero phase.
+    With engine "fft" the generator shapes the spectrum including both
+    filters (spectral_noise) and no time-domain filter runs at all.
+    `channels`/`correlation` as in generate_sleep_noise.generate_noise_to_file;
+    normalization and the peak ceiling apply to all channels together.
+
+    `variants` are extra (path, frames) prefixes of the same render with their
+    own fade-out and normalization (see postprocess.stream_postprocess); the
+    replay pass writes all outputs at once. `exports` are encoded next to
+    every output from the same blocks (see export_audio).
+
+    Returns (rms_db, peak_linear) of the written float signal for `out` and
+    each variant, in that order.
+    """
+    Path(out).parent.mkdir(parents=True, exist_ok=True)
+    total = int(duration_sec * sr)
+    outputs = [(out, total)] + [(path, min(frames, total)) for path, frames in (variants or [])]
+    lengths = [frames for _, frames in outputs]
+    fade_len = int(fade_seconds * sr)
+    sos = None if engine == "fft" else butter_sos(sr, lowpass_hz=lp, highpass_hz=hp)
+    if sos is not None:
+        sos = np.concatenate([sos, sos], axis=0)
+
+    stats = [[0.0, 0.0] for _ in outputs]
+    with span("fused.analyze", preset=preset, sr=sr) as sp:
+        start = 0
+        for block in processed_blocks(
+            preset, total, sr, seed, sos, block_frames, engine, hp, lp, channels, correlation,
+        ):
+            update_prefix_stats(stats, block, start, lengths, fade_len)
+            start += len(block)
+            sp.add(len(block))
+    gains = [
+        normalization_gain(peak, sum_squares, length * channels, target_rms_db, peak_ceiling_linear)
+        for (peak, sum_squares), length in zip(stats, lengths)
+    ]
+
+    out_stats = [[0.0, 0.0] for _ in outputs]
+    with ExitStack() as stack:
+        sp = stack.enter_context(span("fused.write", preset=preset, sr=sr, outputs=len(outputs)))
+        files = []
+        for path, length in outputs:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            f = sf.SoundFile(path, mode="w", samplerate=sr, channels=channels, subtype="PCM_16")
+            enc = ExportSet(path, exports, length, sr, channels) if exports else None
+            files.append(stack.enter_context(AnalyzingWavWriter(f, length, exports=enc)))
+        start = 0
+        for block in processed_blocks(
+            preset, total, sr, seed, sos, block_frames, engine, hp, lp, channels, correlation,
+        ):
+            for f, length, gain, acc in zip(files, lengths, gains, out_stats):
+                if start >= length:
+                    continue
+                part = block[:length - start] * gain
+                g = fade_gain(start, len(part), length, fade_len)
+                if g is not None:
+                    part *= per_frame(g, part)
+                acc[0] = max(acc[0], float(np.max(np.abs(part))))
+                acc[1] += float(np.sum(np.square(part), dtype=np.float64))
+                f.write(part)
+            start += len(block)
+            sp.add(len(block))
+
+    results = []
+    for (peak, sum_squares), length in zip(out_stats, lengths):
+        rms = float(math.sqrt(sum_squares / max(length * channels, 1))) + 1e-12
+        results.append((20 * math.log10(rms), peak))
+    return results
+
+
+def main(
+    out: str,
+    duration_hours: float,
+    sr: int,
+    preset: str,
+    target_rms_db: float,
+    fade_seconds: int,
+    hp: float,
+    lp: float,
+    peak_ceiling_linear: float,
+    seed: int | None = None,
+    variant_outs: list[str] | None = None,
+    variant_hours: list[float] | None = None,
+    exports: list[str] | None = None,
+    engine: str = "kernel",
+    channels: int = 1,
+    correlation: float = 0.0,
+) -> None:
+    if seed is None:
+        # The replay pass needs a fixed seed; draw one and report it
+        seed = int(np.random.SeedSequence().entropy % (2 ** 63))
+    duration_sec = float(duration_hours) * 3600
+    variants = [(path, int(float(h) * 3600 * sr)) for path, h in zip(variant_outs or [], variant_hours or [])]
+    results = render_fused(
+        out, duration_sec, sr, preset, seed, target_rms_db, fade_seconds, hp, lp, peak_ceiling_linear,
+        variants=variants, exports=exports, engine=engine, channels=channels, correlation=correlation,
+    )
+    for path, (out_rms_db, peak) in zip([out] + [v[0] for v in variants], results):
+        peak = peak + 1e-12
+        print(f"Rendered audio (fused, seed={seed}): {path}")
+        print(f"RMS dB (approx): {out_rms_db:.2f} dBFS")
+        print(f"Peak (linear): {peak:.6f}")
+        print(f"Peak (dBFS): {20 * math.log10(peak):.2f} dBFS")
+        for spec in exports or []:
+            print(f"Exported: {export_path(path, spec)}")
+
+
+def cli(argv: list[str] | None = None) -> None:
+    import argparse
+
+    p = argparse.ArgumentParser()
+    p.add_argument("--out", required=True)
+    p.add_argument("--hours", type=float, default=8)
+    p.add_argument("--sr", type=int, default=44100)
+    p.add_argument("--preset", default="brown_noise")
+    p.add_argument("--target_rms_db", type=float, default=-20.0)
+    p.add_argument("--fade_seconds", type=int, default=15)
+    p.add_argument("--highpass_hz", type=float, default=18.0)
+    p.add_argument("--lowpass_hz", type=float, default=1200.0)
+    p.add_argument("--peak_ceiling_linear", type=float, default=0.98)
+    p.add_argument("--seed", type=int, default=None)
+    p.add_argument("--variant_out", nargs="*", default=[])
+    p.add_argument("--variant_hours", type=float, nargs="*", default=[])
+    p.add_argument("--export", nargs="*", default=[], help="extra formats per output, e.g. flac wav:PCM_24")
+    p.add_argument("--engine", choices=["kernel", "fft"], default="kernel")
+    p.add_argument("--channels", type=int, default=1)
+    p.add_argument("--correlation", type=float, default=0.0, help="inter-channel correlation of the noise, 0 <= c < 1")
+    args = p.parse_args(argv)
+    main(
+        args.out,
+        args.hours,
+        args.sr,
+        args.preset,
+        args.target_rms_db,
+        args.fade_seconds,
+        args.highpass_hz,
+        args.lowpass_hz,
+        args.peak_ceiling_linear,
+        args.seed,
+        args.variant_out,
+        args.variant_hours,
+        args.export,
+        args.engine,
+        args.channels,
+        args.correlation,
+    )
+
+
+if __name__ == "__main__":
+    cli()
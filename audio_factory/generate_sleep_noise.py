@@ -1,11 +1,27 @@
 ﻿from __future__ import annotations
 import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import soundfile as sf
 from pathlib import Path
 
+from block_pipeline import QUEUE_DEPTH, Slot, run_blocks
+from checkpoint import checkpoint_path, load_checkpoint, open_wav_resume, save_checkpoint
+from noise_kernels import make_kernel
+from tracing import span
 
-BASE_GAIN_6DB = 10 ** (-6 / 20)
+# Frames per rendered block. The kernels draw their random numbers per block,
+# so another size renders other noise (it is part of the checkpoint params)
+BLOCK_FRAMES = 65536
+
+
+def kernel_block_frames(block_frames: int) -> int:
+    # Work-buffer size of the kernel for blocks of up to block_frames. The FFT
+    # engine derives its nfft from it, so a fresh and a resumed render must
+    # build their kernels with the same size to render the same noise
+    return max(block_frames, BLOCK_FRAMES)
 
 
 def moving_average_block(x: np.ndarray, window: int, tail: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
@@ -22,93 +38,300 @@ def moving_average_block(x: np.ndarray, window: int, tail: np.ndarray) -> tuple[
     return y.astype(np.float32), new_tail.astype(np.float32)
 
 
-def generate_block(preset: str, n: int, sr: int, rng: np.random.Generator, state: dict) -> tuple[np.ndarray, dict]:
-    if preset == "brown_noise":
-        white = rng.standard_normal(n).astype(np.float32)
-        brown = np.cumsum(white) + state.get("brown_last", 0.0)
-        brown = (brown * 0.02).astype(np.float32)
-        brown -= float(np.mean(brown))
-        state["brown_last"] = float(brown[-1])
-        return (brown * BASE_GAIN_6DB).astype(np.float32), state
-
-    if preset == "fan_noise":
-        white = rng.standard_normal(n).astype(np.float32)
-        brown = np.cumsum(white) + state.get("brown_last", 0.0)
-        brown = (brown * 0.02).astype(np.float32)
-        brown -= float(np.mean(brown))
-        state["brown_last"] = float(brown[-1])
-        mix = (0.7 * brown + 0.3 * white * 0.05).astype(np.float32)
-        window = max(3, int(sr / 800))
-        y, tail = moving_average_block(mix, window, state.get("lp_tail", np.array([], dtype=np.float32)))
-        state["lp_tail"] = tail
-        return (y * BASE_GAIN_6DB).astype(np.float32), state
-
-    if preset == "rain_window":
-        white = rng.standard_normal(n).astype(np.float32) * 0.05
-        hp_window = max(3, int(sr / 200))
-        lp_window = max(3, int(sr / 3500))
-        low, tail_hp = moving_average_block(white, hp_window, state.get("hp_tail", np.array([], dtype=np.float32)))
-        high = (white - low).astype(np.float32)
-        band, tail_lp = moving_average_block(high, lp_window, state.get("lp_tail", np.array([], dtype=np.float32)))
-        state["hp_tail"] = tail_hp
-        state["lp_tail"] = tail_lp
-
-        block_duration = n / sr
-        rate = 1.0 / 120.0
-        events = rng.poisson(rate * block_duration)
-        for _ in range(int(events)):
-            pos = int(rng.integers(0, n))
-            length = int(min(n - pos, sr * 0.01))
-            if length <= 0:
-                continue
-            env = np.exp(-np.arange(length, dtype=np.float32) / (sr * 0.003))
-            band[pos:pos + length] += (rng.standard_normal(length).astype(np.float32) * env * 0.01)
-        return band, state
-
-    if preset == "ocean_waves":
-        white = rng.standard_normal(n).astype(np.float32) * 0.04
-        window = max(3, int(sr / 600))
-        y, tail = moving_average_block(white, window, state.get("lp_tail", np.array([], dtype=np.float32)))
-        state["lp_tail"] = tail
-
-        phase = float(state.get("phase", 0.0))
-        period = float(state.get("period", rng.uniform(8.0, 14.0)))
-        omega = 2 * math.pi / period
-        t = (np.arange(n, dtype=np.float32) / sr)
-        mod = 0.4 + 0.6 * (0.5 + 0.5 * np.sin(phase + omega * t))
-        phase = (phase + omega * (n / sr)) % (2 * math.pi)
-        if rng.random() < 0.2:
-            period = float(rng.uniform(8.0, 14.0))
-        state["phase"] = phase
-        state["period"] = period
-        return (y * mod).astype(np.float32), state
-
-    raise ValueError(f"Unknown preset: {preset}")
-
-
-def generate_noise_to_file(out_path: str, duration_sec: float, sr: int, preset: str, seed: int | None) -> None:
-    rng = np.random.default_rng(seed)
-    total_frames = int(duration_sec * sr)
-    block_frames = 65536
+def generate_block(
+    preset: str,
+    n: int,
+    sr: int,
+    rng: np.random.Generator,
+    state: dict,
+    engine: str = "kernel",
+    highpass_hz: float | None = None,
+    lowpass_hz: float | None = None,
+    channels: int = 1,
+    correlation: float = 0.0,
+) -> tuple[np.ndarray, dict]:
+    # Kernels live in noise_kernels.PRESETS (engine "fft": spectral_noise,
+    # which also applies highpass_hz/lowpass_hz); the instance (with its filter
+    # state and work buffers) is kept in `state` between calls. The returned
+    # block is reused by the kernel on the next call; it is (n,) for mono and
+    # (n, channels) otherwise, see noise_kernels.NoiseKernel.
+    kernel = state.get("kernel")
+    if (
+        kernel is None or kernel.name != preset or kernel.sr != sr or kernel.engine != engine
+        or kernel.channels != channels or kernel.correlation != correlation
+    ):
+        kernel = make_kernel(preset, sr, kernel_block_frames(n), engine, highpass_hz, lowpass_hz, channels, correlation)
+        state["kernel"] = kernel
+    if n <= kernel.block_frames:
+        return kernel.render(n, rng), state
+    parts = []
+    done = 0
+    while done < n:
+        k = min(kernel.block_frames, n - done)
+        parts.append(kernel.render(k, rng).copy())
+        done += k
+    return np.concatenate(parts), state
+
+
+def render_segment(
+    out_path: str,
+    preset: str,
+    sr: int,
+    seed_seq: np.random.SeedSequence,
+    start: int,
+    stop: int,
+    head_frames: int,
+    tail_frames: int,
+    preroll_frames: int,
+    block_frames: int = BLOCK_FRAMES,
+    engine: str = "kernel",
+    highpass_hz: float | None = None,
+    lowpass_hz: float | None = None,
+    channels: int = 1,
+    correlation: float = 0.0,
+) -> tuple[np.ndarray, np.ndarray]:
+    # Renders frames [start, stop + tail_frames) from its own RNG stream. The
+    # first head_frames and the tail are returned for crossfading instead of
+    # being written; everything in between goes straight into out_path.
+    rng = np.random.default_rng(seed_seq)
     state: dict = {}
+    # Settle moving-average tails, integrator and wave phase before frame `start`
+    done = 0
+    while done < preroll_frames:
+        n = min(block_frames, preroll_frames - done)
+        _, state = generate_block(preset, n, sr, rng, state, engine, highpass_hz, lowpass_hz, channels, correlation)
+        done += n
+
+    total = stop + tail_frames - start
+    shape = (0, channels) if channels > 1 else (0,)
+    head = np.zeros(shape, dtype=np.float32)
+    tail = np.zeros(shape, dtype=np.float32)
+    with sf.SoundFile(out_path, mode="r+") as f, span("generate.segment", preset=preset, start=start) as sp:
+        f.seek(start + head_frames)
+        pos = 0
+        while pos < total:
+            n = min(block_frames, total - pos)
+            block, state = generate_block(
+                preset, n, sr, rng, state, engine, highpass_hz, lowpass_hz, channels, correlation,
+            )
+            block = np.clip(block, -1.0, 1.0)
+            lo, hi = pos, pos + n
+            if lo < head_frames:
+                head = np.concatenate([head, block[:head_frames - lo]])
+            if hi > stop - start:
+                tail = np.concatenate([tail, block[max(0, stop - start - lo):]])
+            body = block[max(0, head_frames - lo):max(0, min(n, stop - start - lo))]
+            if len(body):
+                f.write(body)
+            pos = hi
+            sp.add(n)
+    return head, tail
+
+
+def generate_segmented_to_file(
+    out_path: str,
+    duration_sec: float,
+    sr: int,
+    preset: str,
+    seed: int,
+    segments: int,
+    workers: int | None = None,
+    crossfade_sec: float = 1.0,
+    preroll_sec: float = 2.0,
+    engine: str = "kernel",
+    highpass_hz: float | None = None,
+    lowpass_hz: float | None = None,
+    channels: int = 1,
+    correlation: float = 0.0,
+) -> None:
+    """Render one track as `segments` parallel pieces and stitch them in order.
+
+    Segment k uses child k of SeedSequence(seed).spawn(segments), so the output
+    is deterministic for a given (seed, segments) regardless of worker count or
+    scheduling. Each segment first renders `preroll_sec` of throwaway audio so
+    the moving-average tails and integrator state are settled instead of
+    starting from zero. Neighbouring segments overlap by `crossfade_sec`,
+    and the overlap is an equal-power crossfade (uncorrelated noise keeps its
+    level). This also turns the ocean wave phase jump at a seam into a short
+    glide. Workers write their part of the pre-sized file in place.
+    """
+    total_frames = int(duration_sec * sr)
+    block_frames = BLOCK_FRAMES
+    xfade = int(sr * crossfade_sec)
+    segments = max(1, min(segments, total_frames // max(1, 2 * xfade)))
+    xfade = min(xfade, total_frames // (2 * segments))
+    preroll = int(sr * preroll_sec)
+    bounds = [k * total_frames // segments for k in range(segments + 1)]
+    children = np.random.SeedSequence(seed).spawn(segments)
+
     Path(out_path).parent.mkdir(parents=True, exist_ok=True)
-    with sf.SoundFile(out_path, mode="w", samplerate=sr, channels=1, subtype="PCM_16") as f:
+    with sf.SoundFile(out_path, mode="w", samplerate=sr, channels=channels, subtype="PCM_16") as f:
+        zeros = np.zeros((block_frames, channels) if channels > 1 else block_frames, dtype=np.float32)
         written = 0
         while written < total_frames:
             n = min(block_frames, total_frames - written)
-            block, state = generate_block(preset, n, sr, rng, state)
-            block = np.clip(block, -1.0, 1.0)
-            f.write(block)
+            f.write(zeros[:n])
             written += n
 
+    jobs = []
+    for k in range(segments):
+        head = xfade if k > 0 else 0
+        tail = xfade if k < segments - 1 else 0
+        jobs.append((
+            out_path, preset, sr, children[k], bounds[k], bounds[k + 1], head, tail, preroll if k > 0 else 0,
+            block_frames, engine, highpass_hz, lowpass_hz, channels, correlation,
+        ))
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        parts = list(pool.map(render_segment, *zip(*jobs)))
+
+    # Equal-power crossfade: sin^2 + cos^2 = 1
+    t = (np.arange(xfade, dtype=np.float64) + 0.5) / max(xfade, 1)
+    fade_in = np.sin(0.5 * math.pi * t).astype(np.float32)
+    fade_out = np.cos(0.5 * math.pi * t).astype(np.float32)
+    if channels > 1:
+        fade_in, fade_out = fade_in[:, None], fade_out[:, None]
+    with sf.SoundFile(out_path, mode="r+") as f:
+        for k in range(1, segments):
+            seam = parts[k - 1][1] * fade_out + parts[k][0] * fade_in
+            f.seek(bounds[k])
+            f.write(np.clip(seam, -1.0, 1.0))
 
-def main(out_path: str, duration_hours: float, sr: int, preset: str) -> None:
+
+def generate_noise_to_file(
+    out_path: str,
+    duration_sec: float,
+    sr: int,
+    preset: str,
+    seed: int | None,
+    segments: int = 1,
+    workers: int | None = None,
+    checkpoint: bool = False,
+    resume: bool = False,
+    checkpoint_seconds: float = 30.0,
+    engine: str = "kernel",
+    highpass_hz: float | None = None,
+    lowpass_hz: float | None = None,
+    channels: int = 1,
+    correlation: float = 0.0,
+    block_frames: int = BLOCK_FRAMES,
+    queue_depth: int = QUEUE_DEPTH,
+) -> None:
+    # With checkpoint=True the RNG state, kernel state and frame count are saved
+    # next to the output every `checkpoint_seconds`. resume=True continues from
+    # there; the result is byte-identical to an uninterrupted run. engine "fft"
+    # renders the preset's target spectrum including highpass_hz/lowpass_hz
+    # (spectral_noise), so postprocess can skip its filters. channels > 1
+    # writes one interleaved file with an independent stream per channel,
+    # mixed to `correlation` (noise_kernels.correlation_mixer). Blocks are
+    # rendered in one thread and written in another, `queue_depth` blocks of
+    # `block_frames` in flight (block_pipeline).
+    if segments > 1:
+        if seed is None:
+            raise ValueError("Segmented rendering needs a seed to be deterministic")
+        generate_segmented_to_file(
+            out_path, duration_sec, sr, preset, seed, segments, workers,
+            engine=engine, highpass_hz=highpass_hz, lowpass_hz=lowpass_hz, channels=channels, correlation=correlation,
+        )
+        return
+    rng = np.random.default_rng(seed)
+    total_frames = int(duration_sec * sr)
+    state: dict = {}
+    written = 0
+    ckpt = checkpoint_path(out_path)
+    params = {
+        "preset": preset, "sr": sr, "total_frames": total_frames, "block_frames": block_frames, "seed": seed,
+        "engine": engine, "highpass_hz": highpass_hz, "lowpass_hz": lowpass_hz,
+        "channels": channels, "correlation": correlation,
+    }
+    saved = load_checkpoint(ckpt, params) if resume else None
+    if saved and saved.get("complete"):
+        print(f"Already complete: {out_path}")
+        return
+    Path(out_path).parent.mkdir(parents=True, exist_ok=True)
+    state["kernel"] = make_kernel(
+        preset, sr, kernel_block_frames(block_frames), engine, highpass_hz, lowpass_hz, channels, correlation,
+    )
+    if saved:
+        rng.bit_generator.state = saved["rng"]
+        state["kernel"].set_state(saved["kernel"])
+        written = saved["frames"]
+        f = open_wav_resume(out_path, written, sr, channels, "PCM_16")
+        print(f"Resuming {out_path} at frame {written}/{total_frames}")
+    else:
+        f = sf.SoundFile(out_path, mode="w", samplerate=sr, channels=channels, subtype="PCM_16")
+    shape = (block_frames,) if channels == 1 else (block_frames, channels)
+    pos = {"rendered": written, "last_checkpoint": time.monotonic()}
+    with f, span("generate.blocks", preset=preset, sr=sr, engine=engine, channels=channels) as sp:
+
+        def render(slot: Slot) -> bool:
+            nonlocal state
+            n = min(block_frames, total_frames - pos["rendered"])
+            if n <= 0:
+                return False
+            block, state = generate_block(
+                preset, n, sr, rng, state, engine, highpass_hz, lowpass_hz, channels, correlation,
+            )
+            slot.n = n
+            np.clip(block, -1.0, 1.0, out=slot.buf[:n])
+            pos["rendered"] += n
+            if checkpoint and time.monotonic() - pos["last_checkpoint"] >= checkpoint_seconds:
+                # State at the end of this block; saved once the writer got it to disk
+                slot.meta = {
+                    "params": params,
+                    "frames": pos["rendered"],
+                    "rng": rng.bit_generator.state,
+                    "kernel": state["kernel"].get_state(),
+                }
+                pos["last_checkpoint"] = time.monotonic()
+            return True
+
+        def write(slot: Slot) -> None:
+            f.write(slot.data)
+            sp.add(slot.n)
+            if slot.meta is not None:
+                f.flush()
+                save_checkpoint(ckpt, slot.meta)
+
+        run_blocks([np.empty(shape, dtype=np.float32) for _ in range(queue_depth)], render, write)
+        written = pos["rendered"]
+    if checkpoint:
+        save_checkpoint(ckpt, {"params": params, "frames": written, "complete": True})
+
+
+def main(
+    out_path: str,
+    duration_hours: float,
+    sr: int,
+    preset: str,
+    seed: int | None = None,
+    segments: int = 1,
+    workers: int | None = None,
+    checkpoint: bool = False,
+    resume: bool = False,
+    engine: str = "kernel",
+    highpass_hz: float | None = None,
+    lowpass_hz: float | None = None,
+    channels: int = 1,
+    correlation: float = 0.0,
+    block_frames: int = BLOCK_FRAMES,
+    queue_depth: int = QUEUE_DEPTH,
+) -> None:
     duration_sec = float(duration_hours) * 3600
-    generate_noise_to_file(out_path=out_path, duration_sec=duration_sec, sr=sr, preset=preset, seed=None)
-    print(f"Generated raw audio: {out_path}")
+    if segments > 1 and seed is None:
+        seed = int(np.random.SeedSequence().entropy % (2 ** 63))
+    generate_noise_to_file(
+        out_path=out_path, duration_sec=duration_sec, sr=sr, preset=preset, seed=seed,
+        segments=segments, workers=workers, checkpoint=checkpoint or resume, resume=resume,
+        engine=engine, highpass_hz=highpass_hz, lowpass_hz=lowpass_hz, channels=channels, correlation=correlation,
+        block_frames=block_frames, queue_depth=queue_depth,
+    )
+    if segments > 1:
+        print(f"Generated raw audio ({segments} segments, seed={seed}): {out_path}")
+    else:
+        print(f"Generated raw audio: {out_path}")
 
 
-if __name__ == "__main__":
+def cli(argv: list[str] | None = None) -> None:
     import argparse
 
     p = argparse.ArgumentParser()
@@ -116,5 +339,25 @@ if __name__ == "__main__":
     p.add_argument("--hours", type=float, default=8)
     p.add_argument("--sr", type=int, default=44100)
     p.add_argument("--preset", default="brown_noise")
-    args = p.parse_args()
-    main(args.out, args.hours, args.sr, args.preset)
+    p.add_argument("--seed", type=int, default=None)
+    p.add_argument("--segments", type=int, default=1)
+    p.add_argument("--workers", type=int, default=None)
+    p.add_argument("--checkpoint", action="store_true")
+    p.add_argument("--resume", action="store_true")
+    p.add_argument("--engine", choices=["kernel", "fft"], default="kernel")
+    p.add_argument("--highpass_hz", type=float, default=None, help="engine fft only (filter baked into the spectrum)")
+    p.add_argument("--lowpass_hz", type=float, default=None, help="engine fft only (filter baked into the spectrum)")
+    p.add_argument("--channels", type=int, default=1)
+    p.add_argument("--correlation", type=float, default=0.0, help="inter-channel correlation of the noise, 0 <= c < 1")
+    p.add_argument("--block_frames", type=int, default=BLOCK_FRAMES)
+    p.add_argument("--queue_depth", type=int, default=QUEUE_DEPTH, help="blocks in flight between render and write")
+    args = p.parse_args(argv)
+    main(
+        args.out, args.hours, args.sr, args.preset, args.seed, args.segments, args.workers,
+        args.checkpoint, args.resume, args.engine, args.highpass_hz, args.lowpass_hz,
+        args.channels, args.correlation, args.block_frames, args.queue_depth,
+    )
+
+
+if __name__ == "__main__":
+    cli()
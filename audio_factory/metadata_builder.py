@@ -19,7 +19,7 @@ def main(out_json: str, artist: str, title: str, album: str, genre: str, mood: l
     Path(out_json).write_text(json.dumps(payload, indent=2), encoding="utf-8")
     print(f"Metadata written: {out_json}")
 
-if __name__ == "__main__":
+def cli(argv: list[str] | None = None) -> None:
     import argparse
     p = argparse.ArgumentParser()
     p.add_argument("--out", required=True)
@@ -29,5 +29,8 @@ if __name__ == "__main__":
     p.add_argument("--genre", default="Ambient")
     p.add_argument("--mood", nargs="*", default=["Sleep"])
     p.add_argument("--description", default="")
-    args = p.parse_args()
+    args = p.parse_args(argv)
     main(args.out, args.artist, args.title, args.album, args.genre, args.mood, args.description)
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,415 @@
+from __future__ import annotations
+import math
+import numpy as np
+from scipy.signal import firwin, sosfilt, upfirdn
+
+
+# Metric name -> plugin class; filled by @register_metric
+METRICS: dict[str, type["Metric"]] = {}
+
+DEFAULT_METRICS = ["loudness", "true_peak", "spectrum", "silence", "channels"]
+
+
+def register_metric(name: str):
+    def deco(cls: type[Metric]) -> type[Metric]:
+        cls.name = name
+        METRICS[name] = cls
+        return cls
+    return deco
+
+
+def make_metrics(names: list[str], sr: int, channels: int) -> list[Metric]:
+    plugins = []
+    for name in names:
+        cls = METRICS.get(name)
+        if cls is None:
+            raise ValueError(f"Unknown metric: {name}")
+        plugins.append(cls(sr, channels))
+    return plugins
+
+
+class Metric:
+    """Stateful single-pass metric over the decoded stream.
+
+    update() gets every block in order as float32 (frames, channels), scaled
+    like soundfile reads it; blocks can have any length. result() returns a
+    JSON-friendly dict once the stream has ended. Per-channel work is best
+    done on channel_major(block): numpy reduces and filters a (frames, 2)
+    array along either axis several times slower than a (2, frames) one.
+    """
+
+    name = ""
+
+    def __init__(self, sr: int, channels: int) -> None:
+        self.sr = sr
+        self.channels = channels
+
+    def update(self, block: np.ndarray) -> None:
+        raise NotImplementedError
+
+    def result(self) -> dict:
+        raise NotImplementedError
+
+
+def channel_major(block: np.ndarray, dtype: type | None = None) -> np.ndarray:
+    # (frames, channels) -> contiguous (channels, frames); free for mono
+    return np.ascontiguousarray(block.T, dtype=dtype)
+
+
+def _db(x: float, floor: float = 1e-12) -> float:
+    return 10 * math.log10(max(x, floor))
+
+
+class _Chunker:
+    # Splits the stream into fixed-size windows across block boundaries and
+    # returns per-window sums of a per-frame value (e.g. squared samples)
+    __slots__ = ("size", "acc", "filled")
+
+    def __init__(self, size: int, width: int) -> None:
+        self.size = size
+        self.acc = np.zeros(width, dtype=np.float64)
+        self.filled = 0
+
+    def push(self, values: np.ndarray) -> np.ndarray:
+        # values: (frames, width); returns (completed_windows, width)
+        out = []
+        n = values.shape[0]
+        i = 0
+        if self.filled:
+            take = min(self.size - self.filled, n)
+            self.acc += values[:take].sum(axis=0)
+            self.filled += take
+            i = take
+            if self.filled == self.size:
+                out.append(self.acc.copy())
+                self.acc[:] = 0.0
+                self.filled = 0
+        whole = (n - i) // self.size
+        if whole:
+            sums = values[i:i + whole * self.size].reshape(whole, self.size, -1).sum(axis=1)
+            out.extend(sums)
+            i += whole * self.size
+        if i < n:
+            self.acc += values[i:].sum(axis=0)
+            self.filled += n - i
+        return np.array(out, dtype=np.float64).reshape(-1, values.shape[1])
+
+
+def k_weighting_sos(sr: int) -> np.ndarray:
+    # BS.1770 pre-filter (high shelf) and RLB high-pass, re-derived for `sr`
+    # via the bilinear transform (same formulas as libebur128)
+    f0, gain_db, q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+    k = math.tan(math.pi * f0 / sr)
+    vh = 10 ** (gain_db / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = [(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0,
+             1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    f0, q = 38.13547087602444, 0.5003270373238773
+    k = math.tan(math.pi * f0 / sr)
+    a0 = 1 + k / q + k * k
+    highpass = [1.0, -2.0, 1.0, 1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    return np.array([shelf, highpass], dtype=np.float64)
+
+
+@register_metric("loudness")
+class Loudness(Metric):
+    # Integrated loudness (BS.1770-4: 400 ms blocks, 75 % overlap, -70 LUFS
+    # absolute and -10 LU relative gate) and loudness range (EBU Tech 3342:
+    # 3 s windows, -20 LU relative gate, 10th-95th percentile). Only the mean
+    # square per 100 ms of K-weighted audio is kept, 36 KB per hour.
+
+    CHANNEL_WEIGHTS = {4: 1.41, 5: 1.41}  # surround channels of a 5.1 layout (L R C LFE Ls Rs)
+
+    def __init__(self, sr: int, channels: int) -> None:
+        super().__init__(sr, channels)
+        self.sos = k_weighting_sos(sr)
+        self.zi = np.zeros((self.sos.shape[0], 2, channels), dtype=np.float64)
+        self.hop = _Chunker(int(round(sr * 0.1)), channels)
+        self.weights = np.array([self.CHANNEL_WEIGHTS.get(c, 1.0) if channels == 6 else 1.0 for c in range(channels)])
+        if channels == 6:
+            self.weights[3] = 0.0  # LFE is not measured
+        self.energies: list[np.ndarray] = []
+
+    def update(self, block: np.ndarray) -> None:
+        y, self.zi = sosfilt(self.sos, block.astype(np.float64), axis=0, zi=self.zi)
+        sums = self.hop.push(np.square(y))
+        if sums.size:
+            self.energies.append(sums @ self.weights / self.hop.size)
+
+    def _windows(self, hops: int) -> np.ndarray:
+        z = np.concatenate(self.energies) if self.energies else np.zeros(0)
+        if z.size < hops:
+            return np.zeros(0)
+        cs = np.concatenate([[0.0], np.cumsum(z)])
+        return (cs[hops:] - cs[:-hops]) / hops
+
+    @staticmethod
+    def _lufs(z: np.ndarray) -> np.ndarray:
+        return -0.691 + 10 * np.log10(np.maximum(z, 1e-20))
+
+    def result(self) -> dict:
+        blocks = self._windows(4)
+        integrated = None
+        gated = blocks[self._lufs(blocks) > -70.0]
+        if gated.size:
+            relative = self._lufs(np.array([gated.mean()]))[0] - 10.0
+            gated = gated[self._lufs(gated) > relative]
+            integrated = float(self._lufs(np.array([gated.mean()]))[0]) if gated.size else None
+        lra = None
+        short = self._windows(30)
+        short_l = self._lufs(short[self._lufs(short) > -70.0]) if short.size else short
+        if short_l.size:
+            relative = self._lufs(np.array([np.mean(10 ** ((short_l + 0.691) / 10))]))[0] - 20.0
+            short_l = short_l[short_l > relative]
+            if short_l.size:
+                lo, hi = np.percentile(short_l, [10, 95])
+                lra = float(hi - lo)
+        return {
+            "integrated_lufs": integrated,
+            "loudness_range_lu": lra,
+            "max_momentary_lufs": float(self._lufs(blocks).max()) if blocks.size else None,
+        }
+
+
+@register_metric("true_peak")
+class TruePeak(Metric):
+    # BS.1770-4 Annex 2: 4x oversampling (2x from 96 kHz up) with a 48-tap
+    # interpolator. Only outputs with the whole filter inside the signal are
+    # used; the last input samples are carried so the next block covers the
+    # interpolated points across the boundary.
+
+    TAPS = 48
+
+    def __init__(self, sr: int, channels: int) -> None:
+        super().__init__(sr, channels)
+        self.factor = 4 if sr < 96000 else 2
+        self.h = firwin(self.TAPS, 1.0 / self.factor, window=("kaiser", 8.0)) * self.factor
+        self.history = np.zeros((0, channels), dtype=np.float32)
+        self.peak = 0.0
+
+    def update(self, block: np.ndarray) -> None:
+        if block.shape[0] == 0:
+            return
+        self.peak = max(self.peak, float(np.max(np.abs(block))))
+        x = np.concatenate([self.history, block]) if self.history.size else block
+        keep = self.TAPS // self.factor + 1
+        if x.shape[0] > keep:
+            y = upfirdn(self.h, channel_major(x), up=self.factor, axis=1)[:, self.TAPS - 1:(x.shape[0] - 1) * self.factor + 1]
+            if y.size:
+                self.peak = max(self.peak, float(np.max(np.abs(y))))
+        self.history = x[-keep:]
+
+    def result(self) -> dict:
+        return {
+            "true_peak_linear": self.peak,
+            "true_peak_dbtp": 20 * math.log10(self.peak + 1e-12),
+            "oversampling": self.factor,
+        }
+
+
+@register_metric("spectrum")
+class Spectrum(Metric):
+    # Running Welch estimate: Hann segments of NPERSEG with 50 % overlap, all
+    # segments of a block in one batched rfft, mean power accumulated per bin.
+    # Reported as energy per band in dB relative to the total.
+
+    NPERSEG = 4096
+    BANDS = [(20, 60), (60, 250), (250, 500), (500, 2000), (2000, 6000), (6000, 20000)]
+
+    def __init__(self, sr: int, channels: int) -> None:
+        super().__init__(sr, channels)
+        self.window = np.hanning(self.NPERSEG).astype(np.float32)
+        self.hop = self.NPERSEG // 2
+        self.tail = np.zeros((0, channels), dtype=np.float32)
+        self.power = np.zeros(self.NPERSEG // 2 + 1, dtype=np.float64)
+        self.segments = 0
+
+    def update(self, block: np.ndarray) -> None:
+        x = np.concatenate([self.tail, block]) if self.tail.size else block
+        n = x.shape[0]
+        if n < self.NPERSEG:
+            self.tail = x.copy()
+            return
+        count = (n - self.NPERSEG) // self.hop + 1
+        # (channels, segments, nperseg) view without copies, then windowed FFT
+        segs = np.lib.stride_tricks.sliding_window_view(channel_major(x), self.NPERSEG, axis=1)[:, ::self.hop][:, :count]
+        spec = np.fft.rfft(segs * self.window, axis=-1)
+        self.power += np.sum(spec.real ** 2 + spec.imag ** 2, axis=(0, 1))
+        self.segments += count * self.channels
+        self.tail = x[count * self.hop:].copy()
+
+    def result(self) -> dict:
+        if not self.segments:
+            return {"band_energy_db": {}, "segments": 0}
+        freqs = np.fft.rfftfreq(self.NPERSEG, 1.0 / self.sr)
+        total = float(self.power[1:].sum())
+        bands = {}
+        for lo, hi in self.BANDS:
+            if lo >= self.sr / 2:
+                continue
+            sel = (freqs >= lo) & (freqs < min(hi, self.sr / 2))
+            bands[f"{lo}-{min(hi, self.sr // 2)}Hz"] = _db(float(self.power[sel].sum()) / max(total, 1e-30))
+        centroid = float(np.sum(freqs[1:] * self.power[1:]) / max(total, 1e-30))
+        return {"band_energy_db": bands, "spectral_centroid_hz": centroid, "segments": self.segments}
+
+
+class _Runs:
+    # Runs of True across blocks; closes a run when it ends, keeps the open one
+    __slots__ = ("min_len", "start", "pos", "runs")
+
+    def __init__(self, min_len: int) -> None:
+        self.min_len = min_len
+        self.start: int | None = None
+        self.pos = 0
+        self.runs: list[tuple[int, int]] = []
+
+    def push(self, mask: np.ndarray) -> None:
+        if mask.size == 0:
+            return
+        edges = np.diff(mask.astype(np.int8), prepend=np.int8(self.start is not None), append=np.int8(0))
+        starts = np.flatnonzero(edges == 1)
+        stops = np.flatnonzero(edges == -1)
+        if self.start is not None:
+            starts = np.concatenate([[self.start - self.pos], starts])
+        for a, b in zip(starts, stops):
+            if b == mask.size and mask[-1]:
+                # Still open at the block end
+                self.start = int(a) + self.pos
+                break
+            if b - a >= self.min_len:
+                self.runs.append((int(a) + self.pos, int(b - a)))
+        else:
+            self.start = None
+        self.pos += mask.size
+
+    def finish(self) -> list[tuple[int, int]]:
+        if self.start is not None and self.pos - self.start >= self.min_len:
+            self.runs.append((self.start, self.pos - self.start))
+        self.start = None
+        return self.runs
+
+
+@register_metric("silence")
+class Silence(Metric):
+    # Silent stretches: 50 ms windows below SILENCE_DBFS for at least
+    # MIN_SILENCE_S. Dropouts: runs of digital zero in any one channel of at
+    # least MIN_DROPOUT_S that cut the signal off, i.e. the sample before the
+    # run is above CUT_DBFS; as [start_s, length_s] (plus the channel index for
+    # multichannel files). Signal that decays into zero is no dropout: where the
+    # raw brown/fan render clips, the highpass flattens the plateau below 1 LSB
+    # and it quantizes to zero for tens of ms, always reached from +-1 LSB. Zero
+    # runs within EDGE_S of the start or end (the last samples of a fade
+    # quantize to 0 with the odd -1 LSB in between) and silent stretches
+    # touching them are reported as leading/trailing silence.
+
+    WINDOW_S = 0.05
+    SILENCE_DBFS = -60.0
+    MIN_SILENCE_S = 2.0
+    MIN_DROPOUT_S = 0.001
+    CUT_DBFS = -87.0  # between 1 and 2 LSB of PCM_16
+    EDGE_S = 0.05
+
+    def __init__(self, sr: int, channels: int) -> None:
+        super().__init__(sr, channels)
+        self.win = _Chunker(max(1, int(sr * self.WINDOW_S)), 1)
+        self.threshold = 10 ** (self.SILENCE_DBFS / 10)
+        # Mean over channels as a product: a reduction over a 2-wide axis is slow
+        self.channel_mean = np.full((channels, 1), 1.0 / channels)
+        self.silent = _Runs(max(1, int(round(self.MIN_SILENCE_S / self.WINDOW_S))))
+        self.zeros = [_Runs(max(1, int(sr * self.MIN_DROPOUT_S))) for _ in range(channels)]
+        # Per channel: |x| of the last sample so far, and of the sample before
+        # every zero run that may become a dropout, by run start
+        self.last = np.zeros(channels, dtype=np.float32)
+        self.cut_from: list[dict[int, float]] = [{} for _ in range(channels)]
+        self.cut_level = 10 ** (self.CUT_DBFS / 20)
+        self.frames = 0
+
+    def update(self, block: np.ndarray) -> None:
+        ms = self.win.push(np.square(block, dtype=np.float64) @ self.channel_mean)
+        if ms.size:
+            self.silent.push(ms[:, 0] / self.win.size < self.threshold)
+        zero = block == 0
+        for c, runs in enumerate(self.zeros):
+            pos, closed = runs.pos, len(runs.runs)
+            runs.push(zero[:, c])
+            starts = [start for start, _ in runs.runs[closed:] if start >= pos]
+            if runs.start is not None and runs.start >= pos:
+                starts.append(runs.start)
+            for start in starts:
+                before = block[start - pos - 1, c] if start > pos else self.last[c]
+                self.cut_from[c][start] = float(abs(before))
+        if block.shape[0]:
+            self.last = np.abs(block[-1])
+        self.frames += block.shape[0]
+
+    def result(self) -> dict:
+        if self.win.filled:
+            self.silent.push(np.array([self.win.acc[0] / self.win.filled < self.threshold]))
+        win_s = self.win.size / self.sr
+        total_windows = self.silent.pos
+        leading = trailing = 0.0
+        stretches = []
+        for start, length in self.silent.finish():
+            if start == 0:
+                leading = length * win_s
+            elif start + length == total_windows:
+                trailing = length * win_s
+            else:
+                stretches.append([round(start * win_s, 3), round(length * win_s, 3)])
+        dropouts = []
+        edge = int(self.EDGE_S * self.sr)
+        for c, runs in enumerate(self.zeros):
+            for start, length in runs.finish():
+                if start <= edge:
+                    leading = max(leading, (start + length) / self.sr)
+                elif start + length >= self.frames - edge:
+                    trailing = max(trailing, (self.frames - start) / self.sr)
+                elif self.cut_from[c].get(start, 0.0) >= self.cut_level:
+                    dropout = [round(start / self.sr, 4), round(length / self.sr, 4)]
+                    dropouts.append(dropout + [c] if self.channels > 1 else dropout)
+        dropouts.sort()
+        return {
+            "silent_stretches": stretches,
+            "dropouts": dropouts,
+            "leading_silence_s": leading,
+            "trailing_silence_s": trailing,
+        }
+
+
+@register_metric("channels")
+class Channels(Metric):
+    # Per-channel level and the inter-channel correlation matrix from one
+    # running (channels, channels) Gram matrix plus channel sums, i.e. one
+    # matrix product per block for all pairs. Correlation is Pearson over the
+    # whole file; decorrelated noise is near 0, a mono fold-down copy 1.
+
+    def __init__(self, sr: int, channels: int) -> None:
+        super().__init__(sr, channels)
+        self.gram = np.zeros((channels, channels), dtype=np.float64)
+        self.sums = np.zeros(channels, dtype=np.float64)
+        self.peaks = np.zeros(channels, dtype=np.float64)
+        self.frames = 0
+
+    def update(self, block: np.ndarray) -> None:
+        if block.shape[0] == 0:
+            return
+        x = channel_major(block, np.float64)
+        self.gram += x @ x.T
+        self.sums += x.sum(axis=1)
+        self.peaks = np.maximum(self.peaks, np.abs(x).max(axis=1))
+        self.frames += block.shape[0]
+
+    def result(self) -> dict:
+        n = max(self.frames, 1)
+        power = np.diag(self.gram) / n
+        rms_db = [_db(float(pw)) for pw in power]
+        cov = self.gram / n - np.outer(self.sums, self.sums) / (n * n)
+        std = np.sqrt(np.maximum(np.diag(cov), 1e-30))
+        corr = cov / np.outer(std, std)
+        return {
+            "channel_rms_dbfs": rms_db,
+            "channel_peak_linear": [float(pk) for pk in self.peaks],
+            "balance_db": max(rms_db) - min(rms_db),
+            "correlation": [[round(float(v), 4) for v in row] for row in corr],
+        }
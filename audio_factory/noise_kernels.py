@@ -0,0 +1,312 @@
+from __future__ import annotations
+import math
+import numpy as np
+
+
+BASE_GAIN_6DB = 10 ** (-6 / 20)
+
+# Preset name -> kernel class; filled by @register_preset
+PRESETS: dict[str, type["NoiseKernel"]] = {}
+
+
+def register_preset(name: str):
+    def deco(cls: type[NoiseKernel]) -> type[NoiseKernel]:
+        cls.name = name
+        PRESETS[name] = cls
+        return cls
+    return deco
+
+
+ENGINES = ("kernel", "fft")
+
+
+def make_kernel(
+    preset: str,
+    sr: int,
+    block_frames: int = 65536,
+    engine: str = "kernel",
+    highpass_hz: float | None = None,
+    lowpass_hz: float | None = None,
+    channels: int = 1,
+    correlation: float = 0.0,
+) -> NoiseKernel:
+    # engine "fft": spectral_noise.SpectralNoise with the preset's target
+    # spectrum; only that engine applies highpass_hz/lowpass_hz itself
+    if engine == "fft":
+        from spectral_noise import SpectralNoise
+        return SpectralNoise(preset, sr, block_frames, highpass_hz, lowpass_hz, channels, correlation)
+    if engine != "kernel":
+        raise ValueError(f"Unknown engine: {engine} (known: {', '.join(ENGINES)})")
+    cls = PRESETS.get(preset)
+    if cls is None:
+        raise ValueError(f"Unknown preset: {preset}")
+    return cls(sr, block_frames, channels, correlation)
+
+
+def correlation_mixer(channels: int, correlation: float) -> np.ndarray | None:
+    # Lower Cholesky factor of the equicorrelation matrix: independent unit
+    # streams mixed by it have pairwise correlation `correlation` and unit
+    # variance, and row 0 is [1, 0, ...], so channel 0 stays the plain stream
+    if not 0.0 <= correlation < 1.0:
+        raise ValueError(f"Channel correlation must be in [0, 1), got {correlation}")
+    if channels == 1 or correlation == 0.0:
+        return None
+    c = np.full((channels, channels), correlation) + np.eye(channels) * (1.0 - correlation)
+    return np.linalg.cholesky(c)
+
+
+class NoiseKernel:
+    """Stateful per-preset generator with preallocated block buffers.
+
+    render(n, rng) fills and returns a view into the kernel's own output
+    buffer, which is overwritten by the next call; copy it if it has to
+    outlive that. n must not exceed block_frames. get_state()/set_state()
+    round-trip everything carried between blocks as plain numpy/float values.
+
+    With channels > 1 the block is (n, channels) (interleaved, as soundfile
+    writes it), otherwise (n,). All state and work buffers are channel-major
+    (channels, frames), so every step handles all channels in one numpy
+    call. Each channel draws from its own stream: channel 0 from `rng`, the
+    others from streams spawned off it on the first render, so channel 0 of
+    a stereo render is the mono render of the same seed. `correlation` mixes
+    the white noise of the channels (see correlation_mixer) before shaping.
+    """
+
+    __slots__ = ("sr", "block_frames", "channels", "correlation", "mixer", "streams", "white", "out", "interleaved")
+    name = ""
+    engine = "kernel"
+
+    def __init__(self, sr: int, block_frames: int = 65536, channels: int = 1, correlation: float = 0.0) -> None:
+        self.sr = sr
+        self.block_frames = block_frames
+        self.channels = channels
+        self.correlation = correlation
+        self.mixer = correlation_mixer(channels, correlation)
+        self.streams: list[np.random.Generator] | None = None
+        self.white = np.empty((channels, block_frames), dtype=np.float32)
+        self.out = np.zeros((channels, block_frames), dtype=np.float32)
+        self.interleaved = np.zeros((block_frames, channels), dtype=np.float32) if channels > 1 else None
+
+    def channel_streams(self, rng: np.random.Generator) -> list[np.random.Generator]:
+        if self.streams is None:
+            self.streams = rng.spawn(self.channels - 1) if self.channels > 1 else []
+        return [rng, *self.streams]
+
+    def noise(self, white: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+        # Unit white noise into (channels, n), one stream per channel, mixed
+        # in place from the last channel up (row c only reads rows < c)
+        for row, stream in zip(white, self.channel_streams(rng)):
+            stream.standard_normal(out=row, dtype=np.float32)
+        if self.mixer is not None:
+            for c in range(self.channels - 1, 0, -1):
+                white[c] *= self.mixer[c, c]
+                for j in range(c):
+                    white[c] += self.mixer[c, j] * white[j]
+        return white
+
+    def emit(self, y: np.ndarray) -> np.ndarray:
+        # Channel-major result -> the block render() returns
+        if self.interleaved is None:
+            return y[0]
+        out = self.interleaved[:y.shape[1]]
+        for c in range(self.channels):
+            out[:, c] = y[c]  # one strided copy per channel, ~10x faster than out[:] = y.T
+        return out
+
+    def render(self, n: int, rng: np.random.Generator) -> np.ndarray:
+        raise NotImplementedError
+
+    def get_state(self) -> dict:
+        if not self.streams:
+            return {}
+        return {"streams": [stream.bit_generator.state for stream in self.streams]}
+
+    def set_state(self, state: dict) -> None:
+        if "streams" in state:
+            self.streams = []
+            for saved in state["streams"]:
+                stream = np.random.default_rng()
+                stream.bit_generator.state = saved
+                self.streams.append(stream)
+
+
+class MovingAverage:
+    # Boxcar of `window` samples per channel as a running sum: prefix sums of
+    # the (channels, n) block are written after the last `window` prefix sums
+    # of the previous block, so y[:, i] = cs[:, window + i] - cs[:, i] needs no
+    # concatenate and no new arrays. Starts from a zero history, like
+    # moving_average_block with an empty tail.
+
+    __slots__ = ("window", "cs", "tmp")
+
+    def __init__(self, window: int, block_frames: int, channels: int = 1) -> None:
+        self.window = window
+        self.cs = np.zeros((channels, window + block_frames), dtype=np.float64)
+        self.tmp = np.empty((channels, block_frames), dtype=np.float64)
+
+    def process(self, x: np.ndarray, out: np.ndarray) -> np.ndarray:
+        n = x.shape[1]
+        w = self.window
+        cs = self.cs
+        np.cumsum(x, axis=1, dtype=np.float64, out=cs[:, w:w + n])
+        cs[:, w:w + n] += cs[:, w - 1:w]
+        np.subtract(cs[:, w:w + n], cs[:, :n], out=self.tmp[:, :n])
+        np.multiply(self.tmp[:, :n], 1.0 / w, out=out, casting="unsafe")
+        # Keep the last `window` prefix sums as history, rebased to 0 so the
+        # float64 sums do not drift over hours of audio
+        cs[:, :w] = cs[:, n:n + w]
+        cs[:, :w] -= cs[:, w - 1:w].copy()
+        return out
+
+    def get_state(self) -> np.ndarray:
+        return self.cs[:, :self.window].copy()
+
+    def set_state(self, history: np.ndarray) -> None:
+        # Mono checkpoints from before multichannel rendering hold a 1-D history
+        self.cs[:, :self.window] = history
+
+
+def add_clicks(
+    out: np.ndarray, rng: np.random.Generator, sr: int, rate: float, offsets: np.ndarray, env: np.ndarray,
+) -> None:
+    # Poisson-timed decaying clicks into one channel, all of the block in one
+    # scatter-add; clicks are cut at the block end
+    n = out.size
+    events = int(rng.poisson(rate * n / sr))
+    if events:
+        pos = rng.integers(0, n, size=events)
+        clicks = rng.standard_normal((events, offsets.size), dtype=np.float32)
+        clicks *= env
+        idx = pos[:, None] + offsets
+        inside = idx < n
+        np.add.at(out, idx[inside], clicks[inside])
+
+
+def _brown_into(white: np.ndarray, out: np.ndarray) -> np.ndarray:
+    # Integrated white noise with the block mean removed per channel (no offset
+    # survives the mean removal, so there is nothing to carry between blocks)
+    np.cumsum(white, axis=1, out=out)
+    out *= 0.02
+    out -= out.mean(axis=1, dtype=np.float64, keepdims=True)
+    return out
+
+
+@register_preset("brown_noise")
+class BrownNoise(NoiseKernel):
+    __slots__ = ()
+
+    def render(self, n: int, rng: np.random.Generator) -> np.ndarray:
+        white = self.noise(self.white[:, :n], rng)
+        out = _brown_into(white, self.out[:, :n])
+        out *= BASE_GAIN_6DB
+        return self.emit(out)
+
+
+@register_preset("fan_noise")
+class FanNoise(NoiseKernel):
+    __slots__ = ("mix", "lp")
+
+    def __init__(self, sr: int, block_frames: int = 65536, channels: int = 1, correlation: float = 0.0) -> None:
+        super().__init__(sr, block_frames, channels, correlation)
+        self.mix = np.empty((channels, block_frames), dtype=np.float32)
+        self.lp = MovingAverage(max(3, int(sr / 800)), block_frames, channels)
+
+    def render(self, n: int, rng: np.random.Generator) -> np.ndarray:
+        white = self.noise(self.white[:, :n], rng)
+        mix = _brown_into(white, self.mix[:, :n])
+        mix *= 0.7
+        white *= 0.3 * 0.05
+        mix += white
+        out = self.lp.process(mix, self.out[:, :n])
+        out *= BASE_GAIN_6DB
+        return self.emit(out)
+
+    def get_state(self) -> dict:
+        return {**super().get_state(), "lp_history": self.lp.get_state()}
+
+    def set_state(self, state: dict) -> None:
+        super().set_state(state)
+        self.lp.set_state(state["lp_history"])
+
+
+@register_preset("rain_window")
+class RainWindow(NoiseKernel):
+    # Every channel gets its own drop clicks from its own stream
+    __slots__ = ("low", "hp", "lp", "click_env", "click_offsets")
+
+    # Mean drop clicks per second and their shape
+    RATE = 1.0 / 120.0
+    CLICK_SECONDS = 0.01
+    CLICK_DECAY_SECONDS = 0.003
+
+    def __init__(self, sr: int, block_frames: int = 65536, channels: int = 1, correlation: float = 0.0) -> None:
+        super().__init__(sr, block_frames, channels, correlation)
+        self.low = np.empty((channels, block_frames), dtype=np.float32)
+        self.hp = MovingAverage(max(3, int(sr / 200)), block_frames, channels)
+        self.lp = MovingAverage(max(3, int(sr / 3500)), block_frames, channels)
+        click_len = max(1, int(sr * self.CLICK_SECONDS))
+        self.click_offsets = np.arange(click_len)
+        self.click_env = (np.exp(-self.click_offsets / (sr * self.CLICK_DECAY_SECONDS)) * 0.01).astype(np.float32)
+
+    def render(self, n: int, rng: np.random.Generator) -> np.ndarray:
+        white = self.noise(self.white[:, :n], rng)
+        white *= 0.05
+        low = self.hp.process(white, self.low[:, :n])
+        np.subtract(white, low, out=white)  # highpass = white - moving average
+        band = self.lp.process(white, self.out[:, :n])
+        for row, stream in zip(band, self.channel_streams(rng)):
+            add_clicks(row, stream, self.sr, self.RATE, self.click_offsets, self.click_env)
+        return self.emit(band)
+
+    def get_state(self) -> dict:
+        return {**super().get_state(), "hp_history": self.hp.get_state(), "lp_history": self.lp.get_state()}
+
+    def set_state(self, state: dict) -> None:
+        super().set_state(state)
+        self.hp.set_state(state["hp_history"])
+        self.lp.set_state(state["lp_history"])
+
+
+@register_preset("ocean_waves")
+class OceanWaves(NoiseKernel):
+    # One wave envelope (drawn from channel 0's stream) for all channels: the
+    # texture is decorrelated, the swell is the same sea on every side
+    __slots__ = ("mod", "t", "lp", "phase", "period")
+
+    def __init__(self, sr: int, block_frames: int = 65536, channels: int = 1, correlation: float = 0.0) -> None:
+        super().__init__(sr, block_frames, channels, correlation)
+        self.mod = np.empty(block_frames, dtype=np.float32)
+        self.t = np.arange(block_frames, dtype=np.float32) / sr
+        self.lp = MovingAverage(max(3, int(sr / 600)), block_frames, channels)
+        self.phase = 0.0
+        self.period = math.nan  # drawn on the first block
+
+    def render(self, n: int, rng: np.random.Generator) -> np.ndarray:
+        white = self.noise(self.white[:, :n], rng)
+        white *= 0.04
+        y = self.lp.process(white, self.out[:, :n])
+
+        if math.isnan(self.period):
+            self.period = float(rng.uniform(8.0, 14.0))
+        omega = 2 * math.pi / self.period
+        # Wave envelope 0.4 + 0.6 * (0.5 + 0.5 * sin) == 0.7 + 0.3 * sin
+        mod = self.mod[:n]
+        np.multiply(self.t[:n], omega, out=mod)
+        mod += self.phase
+        np.sin(mod, out=mod)
+        mod *= 0.3
+        mod += 0.7
+        y *= mod
+        self.phase = (self.phase + omega * (n / self.sr)) % (2 * math.pi)
+        if rng.random() < 0.2:
+            self.period = float(rng.uniform(8.0, 14.0))
+        return self.emit(y)
+
+    def get_state(self) -> dict:
+        return {**super().get_state(), "lp_history": self.lp.get_state(), "phase": self.phase, "period": self.period}
+
+    def set_state(self, state: dict) -> None:
+        super().set_state(state)
+        self.lp.set_state(state["lp_history"])
+        self.phase = float(state["phase"])
+        self.period = float(state["period"])
@@ -1,11 +1,20 @@
 from __future__ import annotations
 
+from functools import lru_cache
 from pathlib import Path
+import ctypes
 import json
+import os
+import shutil
+import tempfile
 import zipfile
 import hashlib
 from datetime import datetime
 
+from catalog import index_release
+from tracing import span
+from wav_analysis import SIDECAR_SUFFIX
+
 
 def write_manifest(qc: dict, out_path: Path) -> None:
     lines = [
@@ -18,55 +27,257 @@ def write_manifest(qc: dict, out_path: Path) -> None:
         f"target_rms_db: {qc.get('target_rms_db', '')}",
         f"duration: {qc.get('duration_seconds', '')} sec",
         f"sample_rate: {qc.get('sample_rate', '')}",
+        f"channels: {qc.get('channels', 1)}",
         f"file_size_mb: {qc.get('file_size_mb', '')}",
         f"rms_dbfs: {qc.get('rms_dbfs', '')}",
         f"peak_dbfs: {qc.get('peak_dbfs', '')}",
+        f"integrated_lufs: {qc.get('integrated_lufs', '')}",
+        f"true_peak_dbtp: {qc.get('true_peak_dbtp', '')}",
         f"cover: {qc.get('cover_width_px', '')}x{qc.get('cover_height_px', '')} px, {qc.get('cover_file_size_mb', '')} MB",
         f"release_pack_sha256_file: {qc.get('release_pack_sha256_file', '')}",
         f"sha256_final_wav: {qc.get('final_wav_sha256', '')}",
+        f"deliverable: {qc.get('deliverable_filename', qc.get('wav_filename', ''))}",
+        f"sha256_deliverable: {qc.get('deliverable_sha256', qc.get('final_wav_sha256', ''))}",
         f"created_at: {datetime.now().isoformat(timespec='seconds')}",
     ]
     out_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
 
 
-def sha256_file(path: Path) -> str:
-    h = hashlib.sha256()
-    with path.open("rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b""):
-            h.update(chunk)
-    return h.hexdigest()
+# Already-compressed or incompressible members are stored; deflating hours of
+# noise costs minutes of CPU for a few percent
+STORED_SUFFIXES = {".wav", ".flac", ".jpg", ".jpeg", ".png"}
+COPY_CHUNK = 4 * 1024 * 1024
+# With move_audio, copied audio is freed from the source every PUNCH_BYTES,
+# so packing needs that much extra disk instead of a second copy
+PUNCH_BYTES = 64 * 1024 * 1024
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+# With move_audio the audio is renamed to <name>.packing while it is packed;
+# <name>.packing.json records how much of it the zip holds
+PACKING_SUFFIX = ".packing"
+
+
+@lru_cache(maxsize=None)
+def _fallocate():
+    try:
+        fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    except (OSError, AttributeError):
+        return None  # not glibc/Linux
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    return fallocate
+
+
+def punch_hole(fd: int, offset: int, length: int) -> bool:
+    # Deallocates a range of the file, keeping its size (reads as zeros);
+    # False where the platform or file system cannot
+    fallocate = _fallocate()
+    return fallocate is not None and fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+
+@lru_cache(maxsize=None)
+def can_punch_holes(directory: str) -> bool:
+    # Whether move_audio can free the audio while packing in this directory
+    try:
+        with tempfile.TemporaryFile(dir=directory) as f:
+            f.write(b"\0" * 8192)
+            f.flush()
+            return punch_hole(f.fileno(), 0, 4096)
+    except OSError:
+        return False
+
+
+def packing_state_path(packing: Path) -> Path:
+    return packing.with_name(packing.name + ".json")
+
+
+def pending_pack(release_dir: Path) -> bool:
+    # Whether a move_audio pack in release_dir was interrupted after it had
+    # freed audio; only finishing the pack (make_zip) brings the audio back
+    return any(release_dir.glob(f"*{PACKING_SUFFIX}.json"))
+
+
+def _write_state(path: Path, state: dict) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
 
 
-def make_zip(release_dir: Path, zip_path: Path, qc: dict) -> None:
-    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-        for name in [
-            qc.get("wav_filename", ""),
-            qc.get("cover_filename", ""),
-            qc.get("metadata_filename", ""),
-            "qc_report.json",
-            "manifest.txt",
-        ]:
-            file_path = release_dir / name
-            if file_path.exists():
-                zf.write(file_path, arcname=file_path.name)
+class HashingWriter:
+    # Write-only tee that hashes the archive while zipfile writes it. It has no
+    # seek(), so zipfile streams every member with a data descriptor instead
+    # of seeking back to patch local headers, and the hash sees the final bytes.
+    # The first `skip` bytes are only hashed: a resumed pack replays the part
+    # of the archive that is already in the file.
 
+    def __init__(self, f, skip: int = 0) -> None:
+        self.f = f
+        self.sha = hashlib.sha256()
+        self.pos = 0
+        self.skip = skip
 
-def main(release_dir: str, qc_report: str, out_zip: str, manifest: str) -> None:
+    def write(self, data) -> int:
+        self.sha.update(data)
+        start = self.pos
+        self.pos += len(data)
+        if self.pos > self.skip:
+            self.f.write(memoryview(data)[max(0, self.skip - start):])
+        return len(data)
+
+    def tell(self) -> int:
+        return self.pos
+
+    def flush(self) -> None:
+        self.f.flush()
+
+
+def copy_moving(src_path: Path, dest, raw, state: dict, state_path: Path) -> None:
+    # Copies src from state["copied"] on into the zip member and punches the
+    # copied part out of src behind itself, each time once the zip got it to
+    # disk and the state file records it: the audio never takes the disk
+    # twice, and an interrupted pack can be finished. Files hard-linked into
+    # other release dirs (stage cache) and file systems without hole punching
+    # are copied whole.
+    with src_path.open("r+b") as src:
+        fd = src.fileno()
+        punching = os.fstat(fd).st_nlink == 1
+        freed = state["copied"]
+        src.seek(freed)
+        while chunk := src.read(COPY_CHUNK):
+            dest.write(chunk)
+            done = src.tell()
+            if punching and done - freed >= PUNCH_BYTES:
+                raw.flush()
+                os.fsync(raw.fileno())
+                state["copied"] = done
+                _write_state(state_path, state)
+                punching = punch_hole(fd, freed, done - freed)
+                state["punched"] = state.get("punched", False) or punching
+                freed = done
+
+
+def make_zip(release_dir: Path, zip_path: Path, qc: dict, move_audio: bool = False) -> str:
+    # Returns the SHA-256 of the written zip. The audio member is the
+    # deliverable (e.g. the FLAC export), the WAV if there is none. With
+    # move_audio it is renamed to <name>.packing (a half-freed file never
+    # shows up under its own name), freed while it is copied (copy_moving)
+    # and removed with its sidecar once the archive is complete, so it is
+    # only kept on disk inside the zip.
+    # If packing fails before a hole was punched, the audio gets its name
+    # back. After that, the partial zip and <name>.packing stay; the next
+    # make_zip replays the zip up to the recorded offset (the freed audio is
+    # read back from it) and continues from the .packing file.
+    audio_name = qc.get("deliverable_filename") or qc.get("wav_filename", "")
+    audio_path = release_dir / audio_name
+    packing = audio_path.with_name(audio_path.name + PACKING_SUFFIX)
+    state_path = packing_state_path(packing)
+    state = {"date_time": None, "data_offset": None, "copied": 0, "punched": False}
+    if move_audio and not audio_path.is_file() and packing.is_file() and state_path.exists():
+        state = json.loads(state_path.read_text(encoding="utf-8"))
+        state["punched"] = True  # as far as this run knows
+        print(f"Resuming interrupted pack of {audio_name} at {state['copied'] / 2**20:.0f} MiB")
+    elif not audio_path.is_file():
+        raise FileNotFoundError(f"Audio to pack not found: {audio_path}")
+    elif move_audio:
+        # Left over from a pack of audio that has been rendered again since
+        state_path.unlink(missing_ok=True)
+        os.replace(audio_path, packing)
+    # Bytes of the zip that are already in place
+    keep = state["data_offset"] + state["copied"] if state["copied"] else 0
+    try:
+        with zip_path.open("r+b" if keep else "wb") as raw, span("pack.zip", zip=zip_path.name) as sp:
+            raw.truncate(keep)
+            raw.seek(keep)
+            out = HashingWriter(raw, skip=keep)
+            with zipfile.ZipFile(out, "w") as zf:
+                for name in [
+                    audio_name,
+                    qc.get("cover_filename", ""),
+                    qc.get("metadata_filename", ""),
+                    "qc_report.json",
+                    "manifest.txt",
+                ]:
+                    file_path = release_dir / name
+                    moving = move_audio and name == audio_name
+                    if moving:
+                        file_path = packing
+                    if not name or not file_path.exists():
+                        continue
+                    zinfo = zipfile.ZipInfo.from_file(file_path, arcname=Path(name).name)
+                    if Path(name).suffix.lower() in STORED_SUFFIXES:
+                        zinfo.compress_type = zipfile.ZIP_STORED
+                    else:
+                        zinfo.compress_type = zipfile.ZIP_DEFLATED
+                    if moving and state["date_time"]:
+                        # Punching holes touches the mtime; the header must come out the same
+                        zinfo.date_time = tuple(state["date_time"])
+                    with zf.open(zinfo, "w") as dest:
+                        if moving:
+                            if state["data_offset"] is None:
+                                state.update(date_time=zinfo.date_time, data_offset=out.pos)
+                            elif out.pos != state["data_offset"]:
+                                raise RuntimeError(f"Cannot resume {zip_path}: the member header changed")
+                            with zip_path.open("rb") as done:
+                                # The part that was freed from the audio, from the zip
+                                done.seek(state["data_offset"])
+                                left = state["copied"]
+                                while left:
+                                    chunk = done.read(min(COPY_CHUNK, left))
+                                    if not chunk:
+                                        raise RuntimeError(f"Cannot resume {zip_path}: it is shorter than recorded")
+                                    dest.write(chunk)
+                                    left -= len(chunk)
+                            copy_moving(file_path, dest, raw, state, state_path)
+                        else:
+                            with file_path.open("rb") as src:
+                                shutil.copyfileobj(src, dest, COPY_CHUNK)
+                    sp.add()
+            raw.flush()
+            os.fsync(raw.fileno())
+    except BaseException:
+        if move_audio and not state["punched"]:
+            # Nothing freed yet: the audio is whole, start over next time
+            os.replace(packing, audio_path)
+            state_path.unlink(missing_ok=True)
+            zip_path.unlink(missing_ok=True)
+        raise
+    if move_audio:
+        packing.unlink()
+        state_path.unlink(missing_ok=True)
+        Path(str(audio_path) + SIDECAR_SUFFIX).unlink(missing_ok=True)
+    return out.sha.hexdigest()
+
+
+def main(
+    release_dir: str,
+    qc_report: str,
+    out_zip: str,
+    manifest: str,
+    move_audio: bool = False,
+    catalog: str | None = None,
+) -> None:
     release_path = Path(release_dir)
     qc_path = Path(qc_report)
     manifest_path = Path(manifest)
     qc = json.loads(qc_path.read_text(encoding="utf-8"))
 
     write_manifest(qc, manifest_path)
-    make_zip(release_path, Path(out_zip), qc)
+    sha = make_zip(release_path, Path(out_zip), qc, move_audio)
     sha_path = release_path / "release_pack.sha256"
-    sha = sha256_file(Path(out_zip))
     sha_path.write_text(f"{sha}  release_pack.zip\n", encoding="utf-8")
+    if catalog != "off":
+        pack = {"zip": str(Path(out_zip).resolve()), "sha256": sha, "bytes": Path(out_zip).stat().st_size,
+                "manifest": str(manifest_path.resolve())}
+        index_release(release_path, qc, pack, db_path=catalog)
     print(f"Manifest written: {manifest_path}")
     print(f"Release pack written: {out_zip}")
+    if move_audio:
+        print(f"Audio moved into release pack: {qc.get('deliverable_filename') or qc.get('wav_filename', '')}")
 
 
-if __name__ == "__main__":
+def cli(argv: list[str] | None = None) -> None:
     import argparse
 
     p = argparse.ArgumentParser()
@@ -74,5 +285,13 @@ if __name__ == "__main__":
     p.add_argument("--qc_report", required=True)
     p.add_argument("--out_zip", required=True)
     p.add_argument("--manifest", required=True)
-    args = p.parse_args()
-    main(args.release_dir, args.qc_report, args.out_zip, args.manifest)
+    p.add_argument("--move_audio", action="store_true",
+                   help="keep the audio only inside the zip; it is freed while packed, so it never takes the disk twice "
+                        "(where the file system can punch holes, e.g. ext4, XFS, btrfs, tmpfs)")
+    p.add_argument("--catalog", default=None, help="release index (default: catalog.sqlite next to the release dir, off: none)")
+    args = p.parse_args(argv)
+    main(args.release_dir, args.qc_report, args.out_zip, args.manifest, args.move_audio, args.catalog)
+
+
+if __name__ == "__main__":
+    cli()
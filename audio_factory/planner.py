@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+import copy
+import hashlib
+import json
+import os
+import platform
+import tempfile
+import time
+
+import run_pipeline
+from stage_cache import code_version
+
+
+CALIBRATION_NAME = ".plan_calibration.json"
+# Audio seconds of the two micro-renders per calibration; every stage's time is
+# fitted as fixed cost + cost per frame between them
+CALIBRATION_SECONDS = (40.0, 160.0)
+# Stages that run once per entry on the master (and write the variants); all
+# others run once per release
+MASTER_STAGES = {"generate_sleep_noise", "postprocess", "fused_render"}
+
+
+def calibration_settings(cfg: dict, entry: dict, orchestrator: str) -> dict:
+    # Everything the stage times of an entry depend on, besides its duration
+    render_cfg = cfg.get("render") or {}
+    channels, _ = run_pipeline.entry_channels(cfg, entry)
+    mode = render_cfg.get("postprocess_mode", "memory")
+    if len(run_pipeline.expand_variants(cfg, entry)) > 1:
+        mode = "stream"
+    return {
+        "preset": entry["preset"],
+        "engine": entry.get("engine", render_cfg.get("engine", "kernel")),
+        "channels": channels,
+        "sample_rate": cfg["audio"]["sample_rate"],
+        "fused": bool(render_cfg.get("fused", False)),
+        "postprocess_mode": mode,
+        "segments": int(render_cfg.get("segments", 1)),
+        "exports": cfg["output"].get("exports") or [],
+        "deliverable": cfg["output"].get("deliverable", "wav"),
+        "pack_audio": cfg["output"].get("pack_audio", "copy"),
+        "orchestrator": orchestrator,
+        "code": [code_version(stage) for stage in run_pipeline.STAGES],
+        "machine": [platform.node(), os.cpu_count()],
+    }
+
+
+def _calibrate_worker(cfg: dict, entry: dict, orchestrator: str) -> list[dict]:
+    # In a fresh interpreter: the first micro-render pays the imports, as the
+    # first entry of a batch worker does; returns the STAGE_TIMINGS of each
+    timings = []
+    for i, seconds in enumerate(CALIBRATION_SECONDS):
+        micro = {k: v for k, v in entry.items() if k != "variants_hours"}
+        micro["hours"] = seconds / 3600
+        res = run_pipeline._entry_worker(cfg, micro, f"calibration{i}", orchestrator)
+        if res["status"] != "ok":
+            raise RuntimeError(f"Calibration render of {entry['preset']} failed: {res['error']} (log: {res['log']})")
+        timings.append(res["timings"])
+    return timings
+
+
+def calibrate(cfg: dict, entry: dict, orchestrator: str) -> dict[str, list[float]]:
+    """Stage name -> [fixed seconds, seconds per frame] of one entry on this machine.
+
+    Renders the entry twice for CALIBRATION_SECONDS (without variants, into a
+    temporary release root, no stage cache, trace or checkpoints) in a spawned
+    process and fits the two stage times of run_stage linearly. The fixed part
+    includes the imports of the first render.
+    """
+    sr = cfg["audio"]["sample_rate"]
+    micro_cfg = copy.deepcopy(cfg)
+    render_cfg = micro_cfg.setdefault("render", {})
+    render_cfg.update(incremental=False, checkpoint=False, resume=False, force_stages=None)
+    render_cfg["postprocess_mode"] = calibration_settings(cfg, entry, orchestrator)["postprocess_mode"]
+    with tempfile.TemporaryDirectory(prefix="plan_calibration_") as root:
+        micro_cfg["output"] = dict(micro_cfg["output"], release_root=root, trace="off")
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+            short, long = pool.submit(_calibrate_worker, micro_cfg, entry, orchestrator).result()
+    frames = [int(seconds * sr) for seconds in CALIBRATION_SECONDS]
+    model = {}
+    for stage in short.keys() | long.keys():
+        t0 = short.get(stage, {}).get("total_s", 0.0) - short.get(stage, {}).get("import_s", 0.0)
+        t1 = long.get(stage, {}).get("total_s", 0.0) - long.get(stage, {}).get("import_s", 0.0)
+        per_frame = max(0.0, (t1 - t0) / (frames[1] - frames[0]))
+        fixed = max(0.0, t0 - per_frame * frames[0]) + short.get(stage, {}).get("import_s", 0.0)
+        model[stage] = [fixed, per_frame]
+    return model
+
+
+def load_calibrations(path: Path) -> dict:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def entry_seconds(cfg: dict, entry: dict, model: dict[str, list[float]]) -> dict[str, float]:
+    # Predicted wall seconds per stage. Master stages scale with all frames
+    # they write (postprocess/fused write every variant), release stages run
+    # once per release
+    sr = cfg["audio"]["sample_rate"]
+    release_frames = [int(release["hours"] * 3600 * sr) for release in run_pipeline.expand_variants(cfg, entry)]
+    seconds = {}
+    for stage, (fixed, per_frame) in model.items():
+        if stage == "generate_sleep_noise":
+            seconds[stage] = fixed + per_frame * release_frames[0]
+        elif stage in MASTER_STAGES:
+            seconds[stage] = fixed + per_frame * sum(release_frames)
+        else:
+            seconds[stage] = sum(fixed + per_frame * frames for frames in release_frames)
+    return seconds
+
+
+def simulate(durations: list[float], memories: list[int], jobs: int, memory_budget: int | None) -> tuple[float, int]:
+    # Wall time and peak RAM of run_batch's schedule: entries start in order
+    # while a worker is free and the memory budget allows it; the running
+    # entries share the cores (each progresses at min(1, cores / running))
+    cores = os.cpu_count() or 1
+    pending = list(range(len(durations)))
+    running: dict[int, float] = {}  # entry -> seconds of work left
+    now = 0.0
+    used = peak = 0
+    while pending or running:
+        for i in list(pending):
+            if len(running) >= jobs:
+                break
+            if running and memory_budget is not None and used + memories[i] > memory_budget:
+                continue
+            running[i] = durations[i]
+            used += memories[i]
+            pending.remove(i)
+        peak = max(peak, used)
+        rate = min(1.0, cores / len(running))
+        first = min(running, key=running.get)
+        step = running[first] / rate
+        now += step
+        for i in running:
+            running[i] -= step * rate
+        del running[first]
+        used -= memories[first]
+    return now, peak
+
+
+def fmt_seconds(seconds: float) -> str:
+    if seconds < 120:
+        return f"{seconds:.1f} s"
+    if seconds < 7200:
+        return f"{seconds / 60:.1f} min"
+    return f"{seconds / 3600:.1f} h"
+
+
+def plan(cfg: dict, entries: list[dict], orchestrator: str, jobs: int, recalibrate: bool = False) -> bool:
+    """Print the predicted wall time, peak RAM and disk of every entry and of the batch.
+
+    Stage times come from calibrate(), cached per calibration_settings() in
+    <release_root>/.plan_calibration.json (`recalibrate` renews them); RAM and
+    disk from run_pipeline.estimate_entry. The batch wall time simulates the
+    scheduler of run_batch for `jobs` > 1, otherwise the entries add up.
+    Returns False if the batch does not fit on the release disk.
+    """
+    root = Path(cfg["output"]["release_root"])
+    cache_path = root / CALIBRATION_NAME
+    calibrations = {} if recalibrate else load_calibrations(cache_path)
+    rows = []
+    for entry in entries:
+        settings = calibration_settings(cfg, entry, orchestrator)
+        key = hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        if key not in calibrations:
+            print(f"[plan] calibrating {entry['preset']} ({settings['engine']}, {settings['channels']} ch, "
+                  f"{'fused' if settings['fused'] else settings['postprocess_mode']}) ...", flush=True)
+            t0 = time.perf_counter()
+            calibrations[key] = {"settings": settings, "stages": calibrate(cfg, entry, orchestrator)}
+            print(f"[plan] calibrated in {time.perf_counter() - t0:.1f} s", flush=True)
+            root.mkdir(parents=True, exist_ok=True)
+            cache_path.write_text(json.dumps(calibrations, indent=2), encoding="utf-8")
+        seconds = entry_seconds(cfg, entry, calibrations[key]["stages"])
+        rows.append((entry, seconds, run_pipeline.estimate_entry(cfg, entry)))
+
+    print(f"\nPLAN ({len(entries)} entries, {jobs} job(s), {os.cpu_count()} core(s))")
+    print(f"{'preset':<16}{'hours':<12}{'render':>10}{'release':>10}{'total':>10}{'est RAM MB':>12}{'est disk MB':>13}")
+    for entry, seconds, est in rows:
+        render = sum(s for stage, s in seconds.items() if stage in MASTER_STAGES)
+        hours = ",".join(f"{r['hours']:g}" for r in run_pipeline.expand_variants(cfg, entry))
+        print(
+            f"{entry['preset']:<16}{hours:<12}{fmt_seconds(render):>10}{fmt_seconds(sum(seconds.values()) - render):>10}"
+            f"{fmt_seconds(sum(seconds.values())):>10}{est['memory_bytes'] / 2**20:>12.0f}{est['disk_bytes'] / 2**20:>13.0f}"
+        )
+
+    durations = [sum(seconds.values()) for _, seconds, _ in rows]
+    memories = [est["memory_bytes"] for _, _, est in rows]
+    if jobs > 1:
+        memory_budget = run_pipeline.batch_memory_budget(cfg.get("render") or {})
+        wall, peak = simulate(durations, memories, jobs, memory_budget)
+    else:
+        wall, peak = sum(durations), max(memories, default=0)
+    disk = sum(est["disk_bytes"] for _, _, est in rows)
+    free = run_pipeline.free_disk_bytes(root)
+    print(f"\nbatch wall time  ~{fmt_seconds(wall)}")
+    print(f"peak RAM         ~{peak / 2**20:.0f} MB")
+    print(f"disk             ~{disk / 1e9:.2f} GB of {free / 1e9:.2f} GB free on {root}")
+    if disk > free:
+        print(f"NOT ENOUGH DISK: {(disk - free) / 1e9:.2f} GB missing")
+        return False
+    return True
@@ -1,18 +1,33 @@
 ﻿from __future__ import annotations
 import numpy as np
 import soundfile as sf
-from scipy.signal import butter, filtfilt
+from scipy.signal import butter, filtfilt, sosfilt, sosfilt_zi
 from pathlib import Path
 import math
+import os
+import time
+from contextlib import nullcontext
+
+from checkpoint import checkpoint_path, load_checkpoint, open_wav_resume, save_checkpoint
+from export_audio import ExportSet, export_path
+from tracing import span
+from wav_analysis import AnalyzingWavWriter
+
+# Signals are (frames,) for mono and (frames, channels) otherwise, as soundfile
+# reads them; filters run along axis 0 and RMS/peak are taken over all channels
+
+def per_frame(g: np.ndarray, x: np.ndarray) -> np.ndarray:
+    # (frames,) gains shaped to multiply a (frames,) or (frames, channels) block
+    return g if x.ndim == 1 else g[:, None]
 
 def butter_filter(x: np.ndarray, sr: int, lowpass_hz: float | None, highpass_hz: float | None) -> np.ndarray:
     y = x
     if highpass_hz and highpass_hz > 0:
         b, a = butter(2, highpass_hz / (sr / 2), btype="highpass")
-        y = filtfilt(b, a, y).astype(np.float32)
+        y = filtfilt(b, a, y, axis=0).astype(np.float32)
     if lowpass_hz and lowpass_hz > 0:
         b, a = butter(2, lowpass_hz / (sr / 2), btype="lowpass")
-        y = filtfilt(b, a, y).astype(np.float32)
+        y = filtfilt(b, a, y, axis=0).astype(np.float32)
     return y
 
 def apply_fade(x: np.ndarray, sr: int, fade_seconds: int) -> np.ndarray:
@@ -21,8 +36,8 @@ def apply_fade(x: np.ndarray, sr: int, fade_seconds: int) -> np.ndarray:
         return x
     fade_in = np.linspace(0, 1, fade_len, dtype=np.float32)
     fade_out = np.linspace(1, 0, fade_len, dtype=np.float32)
-    x[:fade_len] *= fade_in
-    x[-fade_len:] *= fade_out
+    x[:fade_len] *= per_frame(fade_in, x)
+    x[-fade_len:] *= per_frame(fade_out, x)
     return x
 
 def rms_db(x: np.ndarray) -> float:
@@ -41,6 +56,282 @@ def normalize_to_rms_db(x: np.ndarray, target_db: float, peak_ceiling_linear: fl
         y = (y / peak * peak_ceiling_linear).astype(np.float32)
     return y
 
+def butter_sos(sr: int, lowpass_hz: float | None, highpass_hz: float | None) -> np.ndarray | None:
+    # Same filters as butter_filter, cascaded into one SOS array (highpass first)
+    sections = []
+    if highpass_hz and highpass_hz > 0:
+        sections.append(butter(2, highpass_hz / (sr / 2), btype="highpass", output="sos"))
+    if lowpass_hz and lowpass_hz > 0:
+        sections.append(butter(2, lowpass_hz / (sr / 2), btype="lowpass", output="sos"))
+    if not sections:
+        return None
+    return np.concatenate(sections, axis=0)
+
+def sos_zi(sos: np.ndarray, x0: np.ndarray | np.floating) -> np.ndarray:
+    # sosfilt_zi scaled to the first sample x0 (a scalar, or one frame of a
+    # multichannel signal filtered along axis 0)
+    zi = sosfilt_zi(sos)
+    x0 = np.asarray(x0)
+    return zi.reshape(zi.shape + (1,) * x0.ndim) * x0
+
+def fade_gain(start: int, n: int, total: int, fade_len: int) -> np.ndarray | None:
+    # Fade envelope for frames [start, start + n) of a track with `total` frames,
+    # identical to apply_fade. None if the block is outside both fades.
+    if fade_len <= 0 or fade_len * 2 > total:
+        return None
+    end = start + n
+    if start >= fade_len and end <= total - fade_len:
+        return None
+    idx = np.arange(start, end, dtype=np.float64)
+    g = np.ones(n, dtype=np.float64)
+    head = idx < fade_len
+    g[head] = idx[head] / max(fade_len - 1, 1)
+    tail = idx >= total - fade_len
+    g[tail] = 1.0 - (idx[tail] - (total - fade_len)) / max(fade_len - 1, 1)
+    return g.astype(np.float32)
+
+def normalization_gain(peak: float, sum_squares: float, samples: int, target_db: float, peak_ceiling_linear: float) -> np.float32:
+    # Same math as normalize_to_rms_db, from accumulated stats instead of the
+    # signal; `samples` is frames * channels
+    current_db = 20 * math.log10(float(math.sqrt(sum_squares / max(samples, 1))) + 1e-12)
+    gain = 10 ** ((target_db - current_db) / 20)
+    out_peak = peak * gain + 1e-12
+    if out_peak > peak_ceiling_linear:
+        gain = gain / out_peak * peak_ceiling_linear
+    return np.float32(gain)
+
+def update_prefix_stats(stats: list[list[float]], block: np.ndarray, start: int, lengths: list[int], fade_len: int) -> None:
+    # stats[v] = [peak, sum_squares] of the first lengths[v] frames with that
+    # length's own fade-in/out applied. Blocks away from all fades are reduced once.
+    plain = None
+    for v, length in enumerate(lengths):
+        if start >= length:
+            continue
+        part = block[:length - start]
+        g = fade_gain(start, len(part), length, fade_len)
+        if g is None and len(part) == len(block):
+            if plain is None:
+                plain = (float(np.max(np.abs(block))), float(np.sum(np.square(block), dtype=np.float64)))
+            peak, sum_squares = plain
+        else:
+            if g is not None:
+                part = part * per_frame(g, part)
+            peak = float(np.max(np.abs(part)))
+            sum_squares = float(np.sum(np.square(part), dtype=np.float64))
+        stats[v][0] = max(stats[v][0], peak)
+        stats[v][1] += sum_squares
+
+def read_f32_block(f, frames: int, channels: int) -> np.ndarray:
+    # `frames` frames of an interleaved float32 scratch file
+    block = np.fromfile(f, dtype=np.float32, count=frames * channels)
+    return block.reshape(-1, channels) if channels > 1 else block
+
+def stream_postprocess(
+    inp: str,
+    out: str,
+    sr: int,
+    target_rms_db: float,
+    fade_seconds: int,
+    hp: float,
+    lp: float,
+    peak_ceiling_linear: float,
+    block_frames: int = 65536,
+    variants: list[tuple[str, int]] | None = None,
+    checkpoint: bool = False,
+    resume: bool = False,
+    checkpoint_seconds: float = 30.0,
+    exports: list[str] | None = None,
+) -> list[tuple[float, float]]:
+    """Block-streaming equivalent of the in-memory chain, peak RAM independent of duration.
+
+    Zero-phase filtering is done like sosfiltfilt: a forward SOS pass with carried
+    state into a float32 scratch file next to `out`, then a backward pass over the
+    scratch blocks in reverse order that also collects RMS/peak, then a gain pass
+    per output that applies the fades and writes PCM_16. The scratch file needs
+    4 bytes per sample (frame and channel); multichannel input is filtered and
+    normalized as one (frames, channels) signal. The output writers hash and measure what they write and
+    leave a wav_analysis sidecar for qc_report.
+
+    `variants` are extra (path, frames) outputs cut from the start of the same
+    signal, e.g. 1 h/2 h versions of an 8 h master. Each gets its own fade-out
+    and normalization from prefix stats collected in the backward pass, so a
+    variant costs one copy pass and no extra analysis.
+
+    Tolerance vs. the in-memory path: the filters run as one cascade with float32
+    intermediate storage instead of two separate filtfilt calls. With fades enabled
+    the PCM_16 output differs by at most 2 LSB and RMS/peak by < 0.01 dB. Without
+    fades the edge padding differs, so the first/last ~0.1 s can deviate more and
+    RMS by a few hundredths of a dB.
+
+    With `checkpoint`, the pass, position, filter state and running stats are
+    saved next to `out` every `checkpoint_seconds`, and `resume` continues a
+    killed run from there with byte-identical output. This keeps the scratch
+    files on failure, and the backward pass then needs a second scratch file
+    (8 bytes per sample in total while it runs).
+
+    `exports` (e.g. ["flac", "wav:PCM_24"], see export_audio) are encoded
+    next to every output from the same pass-3 blocks, in encoder threads.
+
+    Returns (rms_db, peak_linear) of the written float signal for `out` and
+    each variant, in that order.
+    """
+    Path(out).parent.mkdir(parents=True, exist_ok=True)
+    info = sf.info(inp)
+    if info.samplerate != sr:
+        raise ValueError(f"Sample rate mismatch: file={info.samplerate}, expected={sr}")
+    total = info.frames
+    channels = info.channels
+    frame_bytes = 4 * channels
+    outputs = [(out, total)] + [(path, min(frames, total)) for path, frames in (variants or [])]
+    lengths = [frames for _, frames in outputs]
+    fade_len = int(fade_seconds * sr)
+    sos = butter_sos(sr, lowpass_hz=lp, highpass_hz=hp)
+    padlen = 0 if sos is None else min(3 * (2 * len(sos) + 1), total - 1)
+
+    scratch = Path(out).with_name(Path(out).name + ".scratch.f32")
+    # With checkpoints the backward pass must not overwrite its own input, so a
+    # resumed pass 2 can re-read blocks; it writes a second scratch file instead.
+    scratch_bwd = Path(out).with_name(Path(out).name + ".scratch-bwd.f32") if checkpoint else scratch
+    ckpt = checkpoint_path(out)
+    params = {
+        "inp": str(inp), "inp_bytes": Path(inp).stat().st_size, "sr": sr, "target_rms_db": target_rms_db,
+        "fade_seconds": fade_seconds, "hp": hp, "lp": lp, "peak_ceiling_linear": peak_ceiling_linear,
+        "block_frames": block_frames, "outputs": [[str(path), frames] for path, frames in outputs],
+    }
+    saved = load_checkpoint(ckpt, params) if resume else None
+    if saved and saved.get("complete"):
+        print(f"Already complete: {out}")
+        return [tuple(r) for r in saved["results"]]
+    saved = saved or {"pass": 1, "frames": 0}
+    last_checkpoint = time.monotonic()
+
+    def due() -> bool:
+        nonlocal last_checkpoint
+        if checkpoint and time.monotonic() - last_checkpoint >= checkpoint_seconds:
+            last_checkpoint = time.monotonic()
+            return True
+        return False
+
+    try:
+        if saved["pass"] == 1:
+            # Pass 1: forward filter with odd-extension start-up, like filtfilt
+            done = saved["frames"]
+            zf = saved.get("zf")
+            if done:
+                os.truncate(scratch, done * frame_bytes)
+            with sf.SoundFile(inp, mode="r") as f, scratch.open("r+b" if done else "wb") as s, \
+                    span("postprocess.pass1_forward", sr=sr) as sp:
+                f.seek(done)
+                s.seek(done * frame_bytes)
+                while True:
+                    block = f.read(block_frames, dtype="float32")
+                    if block.size == 0:
+                        break
+                    if sos is not None:
+                        if zf is None:
+                            ext = 2 * block[0] - block[padlen:0:-1]
+                            zf = sos_zi(sos, ext[0])
+                            _, zf = sosfilt(sos, ext, axis=0, zi=zf)
+                        y, zf = sosfilt(sos, block, axis=0, zi=zf)
+                        # C order: sosfilt along axis 0 hands back a transposed (F-order) array
+                        block = y.astype(np.float32, order="C")
+                    block.tofile(s)
+                    done += len(block)
+                    sp.add(len(block))
+                    if due():
+                        s.flush()
+                        os.fsync(s.fileno())
+                        save_checkpoint(ckpt, {"params": params, "pass": 1, "frames": done, "zf": zf})
+                zb = None
+                if sos is not None and zf is not None:
+                    # The odd extension needs the last unfiltered samples; re-read them
+                    f.seek(max(0, total - padlen - 1))
+                    end = f.read(dtype="float32")
+                    ext = 2 * end[-1] - end[-2:-(padlen + 2):-1]
+                    tail, _ = sosfilt(sos, ext, axis=0, zi=zf)
+                    zb = sos_zi(sos, tail[-1])
+                    _, zb = sosfilt(sos, tail[::-1], axis=0, zi=zb)
+            saved = {"pass": 2, "stop": total, "zb": zb, "stats": [[0.0, 0.0] for _ in outputs]}
+            if checkpoint:
+                save_checkpoint(ckpt, {"params": params, **saved})
+
+        if saved["pass"] == 2:
+            # Pass 2: backward filter (in place unless checkpointing), stats per output length
+            stats = saved["stats"]
+            stop = saved["stop"]
+            zb = saved["zb"]
+            if scratch_bwd != scratch and not scratch_bwd.exists():
+                scratch_bwd.touch()
+            with scratch.open("r+b") as s, (scratch_bwd.open("r+b") if checkpoint else nullcontext(s)) as d, \
+                    span("postprocess.pass2_backward", sr=sr) as sp:
+                while stop > 0:
+                    start = max(0, stop - block_frames)
+                    s.seek(start * frame_bytes)
+                    block = read_f32_block(s, stop - start, channels)
+                    if zb is not None:
+                        y, zb = sosfilt(sos, block[::-1], axis=0, zi=zb)
+                        block = y[::-1].astype(np.float32, order="C")
+                    if zb is not None or d is not s:
+                        d.seek(start * frame_bytes)
+                        block.tofile(d)
+                    update_prefix_stats(stats, block, start, lengths, fade_len)
+                    stop = start
+                    sp.add(len(block))
+                    if due():
+                        d.flush()
+                        os.fsync(d.fileno())
+                        save_checkpoint(ckpt, {"params": params, "pass": 2, "stop": stop, "zb": zb, "stats": stats})
+            saved = {"pass": 3, "stats": stats, "output": 0, "pos": 0, "acc": [0.0, 0.0], "results": []}
+            if checkpoint:
+                save_checkpoint(ckpt, {"params": params, **saved})
+                scratch.unlink(missing_ok=True)
+
+        # Pass 3: fades + RMS normalization with peak ceiling, one pass per output
+        results = [tuple(r) for r in saved["results"]]
+        for i in range(saved["output"], len(outputs)):
+            path, length = outputs[i]
+            peak, sum_squares = saved["stats"][i]
+            gain = normalization_gain(peak, sum_squares, length * channels, target_rms_db, peak_ceiling_linear)
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            pos = saved["pos"] if i == saved["output"] else 0
+            peak, sum_squares = saved["acc"] if i == saved["output"] else (0.0, 0.0)
+            if pos:
+                o = open_wav_resume(path, pos, sr, channels, "PCM_16")
+            else:
+                o = sf.SoundFile(path, mode="w", samplerate=sr, channels=channels, subtype="PCM_16")
+            enc = ExportSet(path, exports, length, sr, channels) if exports else None
+            with scratch_bwd.open("rb") as s, AnalyzingWavWriter(o, length, exports=enc) as w, \
+                    span("postprocess.pass3_write", sr=sr, output=Path(path).name) as sp:
+                s.seek(pos * frame_bytes)
+                while pos < length:
+                    block = read_f32_block(s, min(block_frames, length - pos), channels)
+                    g = fade_gain(pos, len(block), length, fade_len)
+                    if g is not None:
+                        block *= per_frame(g, block)
+                    block *= gain
+                    peak = max(peak, float(np.max(np.abs(block))))
+                    sum_squares += float(np.sum(np.square(block), dtype=np.float64))
+                    w.write(block)
+                    pos += len(block)
+                    sp.add(len(block))
+                    if due():
+                        o.flush()
+                        save_checkpoint(ckpt, {
+                            "params": params, "pass": 3, "stats": saved["stats"], "output": i, "pos": pos,
+                            "acc": [peak, sum_squares], "results": results,
+                        })
+            rms = float(math.sqrt(sum_squares / max(length * channels, 1))) + 1e-12
+            results.append((20 * math.log10(rms), peak))
+        if checkpoint:
+            save_checkpoint(ckpt, {"params": params, "complete": True, "results": results})
+    except BaseException:
+        if not checkpoint:
+            scratch.unlink(missing_ok=True)
+        raise
+    scratch.unlink(missing_ok=True)
+    scratch_bwd.unlink(missing_ok=True)
+    return results
+
 def main(
     inp: str,
     out: str,
@@ -50,25 +341,57 @@ def main(
     hp: float,
     lp: float,
     peak_ceiling_linear: float,
+    mode: str = "memory",
+    block_frames: int = 65536,
+    variant_outs: list[str] | None = None,
+    variant_hours: list[float] | None = None,
+    checkpoint: bool = False,
+    resume: bool = False,
+    exports: list[str] | None = None,
 ) -> None:
     Path(out).parent.mkdir(parents=True, exist_ok=True)
-    x, file_sr = sf.read(inp, dtype="float32")
-    if file_sr != sr:
-        raise ValueError(f"Sample rate mismatch: file={file_sr}, expected={sr}")
-
-    y = butter_filter(x, sr=sr, lowpass_hz=lp, highpass_hz=hp)
-    y = apply_fade(y, sr=sr, fade_seconds=fade_seconds)
-    y = normalize_to_rms_db(y, target_db=target_rms_db, peak_ceiling_linear=peak_ceiling_linear)
-
-    sf.write(out, y, sr, subtype="PCM_16")
-    peak = float(np.max(np.abs(y))) + 1e-12
-    peak_db = 20 * math.log10(peak)
-    print(f"Processed audio: {out}")
-    print(f"RMS dB (approx): {rms_db(y):.2f} dBFS")
-    print(f"Peak (linear): {peak:.6f}")
-    print(f"Peak (dBFS): {peak_db:.2f} dBFS")
+    variants = [(path, int(float(h) * 3600 * sr)) for path, h in zip(variant_outs or [], variant_hours or [])]
+    if variants and mode != "stream":
+        raise ValueError("Duration variants need --mode stream")
+    if (checkpoint or resume) and mode != "stream":
+        raise ValueError("Checkpoints need --mode stream")
+    if mode == "stream":
+        results = stream_postprocess(
+            inp, out, sr, target_rms_db, fade_seconds, hp, lp, peak_ceiling_linear,
+            block_frames=block_frames, variants=variants, checkpoint=checkpoint or resume, resume=resume,
+            exports=exports,
+        )
+    elif mode == "memory":
+        with span("postprocess.memory", sr=sr) as sp:
+            x, file_sr = sf.read(inp, dtype="float32")
+            if file_sr != sr:
+                raise ValueError(f"Sample rate mismatch: file={file_sr}, expected={sr}")
 
-if __name__ == "__main__":
+            y = butter_filter(x, sr=sr, lowpass_hz=lp, highpass_hz=hp)
+            y = apply_fade(y, sr=sr, fade_seconds=fade_seconds)
+            y = normalize_to_rms_db(y, target_db=target_rms_db, peak_ceiling_linear=peak_ceiling_linear)
+
+            channels = 1 if y.ndim == 1 else y.shape[1]
+            enc = ExportSet(out, exports, len(y), sr, channels) if exports else None
+            o = sf.SoundFile(out, mode="w", samplerate=sr, channels=channels, subtype="PCM_16")
+            with AnalyzingWavWriter(o, len(y), exports=enc) as w:
+                w.write(y)
+            sp.add(len(y))
+        results = [(rms_db(y), float(np.max(np.abs(y))))]
+    else:
+        raise ValueError(f"Unknown postprocess mode: {mode}")
+
+    for path, (out_rms_db, peak) in zip([out] + [v[0] for v in variants], results):
+        peak = peak + 1e-12
+        peak_db = 20 * math.log10(peak)
+        print(f"Processed audio: {path}")
+        print(f"RMS dB (approx): {out_rms_db:.2f} dBFS")
+        print(f"Peak (linear): {peak:.6f}")
+        print(f"Peak (dBFS): {peak_db:.2f} dBFS")
+        for spec in exports or []:
+            print(f"Exported: {export_path(path, spec)}")
+
+def cli(argv: list[str] | None = None) -> None:
     import argparse
     p = argparse.ArgumentParser()
     p.add_argument("--in", dest="inp", required=True)
@@ -79,7 +402,14 @@ if __name__ == "__main__":
     p.add_argument("--highpass_hz", type=float, default=18.0)
     p.add_argument("--lowpass_hz", type=float, default=1200.0)
     p.add_argument("--peak_ceiling_linear", type=float, default=0.98)
-    args = p.parse_args()
+    p.add_argument("--mode", choices=["memory", "stream"], default="memory")
+    p.add_argument("--block_frames", type=int, default=65536)
+    p.add_argument("--variant_out", nargs="*", default=[])
+    p.add_argument("--variant_hours", type=float, nargs="*", default=[])
+    p.add_argument("--checkpoint", action="store_true")
+    p.add_argument("--resume", action="store_true")
+    p.add_argument("--export", nargs="*", default=[], help="extra formats per output, e.g. flac wav:PCM_24")
+    args = p.parse_args(argv)
     main(
         args.inp,
         args.out,
@@ -89,4 +419,14 @@ if __name__ == "__main__":
         args.highpass_hz,
         args.lowpass_hz,
         args.peak_ceiling_linear,
+        args.mode,
+        args.block_frames,
+        args.variant_out,
+        args.variant_hours,
+        args.checkpoint,
+        args.resume,
+        args.export,
     )
+
+if __name__ == "__main__":
+    cli()
@@ -1,40 +1,44 @@
 from __future__ import annotations
 
 from pathlib import Path
+from typing import BinaryIO
 import json
 import math
-import hashlib
 import soundfile as sf
 import numpy as np
 from PIL import Image
 
+from block_pipeline import QUEUE_DEPTH, Slot, run_blocks
+from catalog import index_release
+from export_audio import export_info, export_path
+from wav_analysis import load_or_analyze
 
-def stream_metrics(wav_path: Path, block_frames: int = 65536) -> tuple[float, float]:
-    peak = 0.0
-    sum_squares = 0.0
-    count = 0
-    with sf.SoundFile(str(wav_path), mode="r") as f:
-        while True:
-            block = f.read(block_frames, dtype="float32")
-            if block.size == 0:
-                break
-            peak = max(peak, float(np.max(np.abs(block))))
-            sum_squares += float(np.sum(np.square(block), dtype=np.float64))
-            count += block.size
-    if count == 0:
-        return 0.0, float("-inf")
-    rms = math.sqrt(sum_squares / count)
-    rms_db = 20 * math.log10(rms + 1e-12)
-    return peak, rms_db
 
+def stream_metrics(
+    wav_path: Path | BinaryIO, block_frames: int = 65536, depth: int = QUEUE_DEPTH,
+) -> tuple[float, float]:
+    # wav_path may also be an open binary file, e.g. a zip member. The next
+    # block is decoded while the previous one is measured (block_pipeline)
+    acc = {"peak": 0.0, "sum_squares": 0.0, "count": 0}
+    with sf.SoundFile(wav_path if hasattr(wav_path, "read") else str(wav_path), mode="r") as f:
+        shape = (block_frames,) if f.channels == 1 else (block_frames, f.channels)
+
+        def read(slot: Slot) -> bool:
+            slot.n = len(f.read(out=slot.buf))
+            return slot.n > 0
 
-def sha256_file(path: Path) -> str:
-    h = hashlib.sha256()
-    with path.open("rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b""):
-            h.update(chunk)
-    return h.hexdigest()
+        def measure(slot: Slot) -> None:
+            block = slot.data
+            acc["peak"] = max(acc["peak"], float(np.max(np.abs(block))))
+            acc["sum_squares"] += float(np.sum(np.square(block), dtype=np.float64))
+            acc["count"] += block.size
 
+        run_blocks([np.empty(shape, dtype=np.float32) for _ in range(depth)], read, measure)
+    if acc["count"] == 0:
+        return 0.0, float("-inf")
+    rms = math.sqrt(acc["sum_squares"] / acc["count"])
+    rms_db = 20 * math.log10(rms + 1e-12)
+    return acc["peak"], rms_db
 
 
 def main(
@@ -46,19 +50,47 @@ def main(
     target_rms_db: float,
     preset_name: str,
     peak_ceiling_linear: float,
+    exports: list[str] | None = None,
+    deliverable: str | None = None,
+    catalog: str | None = None,
+    target_hours: float | None = None,
+    params_fingerprint: str | None = None,
 ) -> None:
     release_path = Path(release_dir)
     wav_path = Path(final_wav)
     cover_path = Path(cover)
     meta_path = Path(metadata)
-    info = sf.info(str(wav_path))
     with Image.open(cover_path) as img:
         cover_width, cover_height = img.size
     cover_file_size_mb = cover_path.stat().st_size / (1024 * 1024)
 
-    peak_linear, rms_dbfs = stream_metrics(wav_path)
+    # One read for peak/RMS/hash and all metric plugins, or none if postprocess
+    # left a matching sidecar
+    analysis = load_or_analyze(wav_path)
+    peak_linear = analysis["peak_linear"]
+    rms_dbfs = analysis["rms_dbfs"]
     peak_dbfs = 20 * math.log10(peak_linear + 1e-12)
     file_size_mb = wav_path.stat().st_size / (1024 * 1024)
+    metrics = analysis["metrics"]
+
+    # Encodings of the same signal written next to the WAV (export_audio); the
+    # deliverable is what pack_release puts into the zip
+    export_list = []
+    for spec in exports or []:
+        info = export_info(export_path(wav_path, spec))
+        export_list.append({
+            "filename": export_path(wav_path, spec).name,
+            "format": info["format"],
+            "subtype": info["subtype"],
+            "file_size_mb": info["file_size"] / (1024 * 1024),
+            "sha256": info["sha256"],
+        })
+    deliverable_path = export_path(wav_path, deliverable) if deliverable and deliverable != "wav" else wav_path
+    if deliverable_path != wav_path and deliverable_path.name not in {e["filename"] for e in export_list}:
+        raise ValueError(f"Deliverable {deliverable} is not among the exports: {exports}")
+    deliverable_sha256 = next(
+        (e["sha256"] for e in export_list if e["filename"] == deliverable_path.name), analysis["sha256"],
+    )
 
     meta_payload = json.loads(meta_path.read_text(encoding="utf-8"))
     payload = {
@@ -73,23 +105,42 @@ def main(
         "cover_height_px": cover_height,
         "cover_file_size_mb": cover_file_size_mb,
         "release_pack_sha256_file": "release_pack.sha256",
-        "final_wav_sha256": sha256_file(wav_path),
-        "duration_seconds": info.frames / info.samplerate,
-        "sample_rate": info.samplerate,
+        "final_wav_sha256": analysis["sha256"],
+        "duration_seconds": analysis["frames"] / analysis["sample_rate"],
+        "target_duration_seconds": None if target_hours is None else target_hours * 3600,
+        "params_fingerprint": params_fingerprint,
+        "sample_rate": analysis["sample_rate"],
+        "channels": analysis["channels"],
         "file_size_mb": file_size_mb,
         "target_rms_db": target_rms_db,
         "rms_dbfs": rms_dbfs,
         "peak_linear": peak_linear,
         "peak_dbfs": peak_dbfs,
+        "integrated_lufs": metrics["loudness"]["integrated_lufs"],
+        "loudness_range_lu": metrics["loudness"]["loudness_range_lu"],
+        "true_peak_dbtp": metrics["true_peak"]["true_peak_dbtp"],
+        "dropout_count": len(metrics["silence"]["dropouts"]),
+        "channel_balance_db": metrics["channels"]["balance_db"],
+        "metrics": metrics,
         "wav_filename": wav_path.name,
+        "exports": export_list,
+        "deliverable_filename": deliverable_path.name,
+        "deliverable_sha256": deliverable_sha256,
         "cover_filename": cover_path.name,
         "metadata_filename": meta_path.name,
     }
     Path(out_path).write_text(json.dumps(payload, indent=2), encoding="utf-8")
     print(f"QC report written: {out_path}")
+    dropouts = metrics["silence"]["dropouts"]
+    if dropouts:
+        # A quality gate (verify.py); [start_s, length_s(, channel)]
+        shown = ", ".join(str(d) for d in dropouts[:5]) + (" ..." if len(dropouts) > 5 else "")
+        print(f"QC: {len(dropouts)} dropout(s) in {wav_path.name}: {shown}")
+    if catalog != "off":
+        index_release(release_path, payload, db_path=catalog)
 
 
-if __name__ == "__main__":
+def cli(argv: list[str] | None = None) -> None:
     import argparse
 
     p = argparse.ArgumentParser()
@@ -101,7 +152,13 @@ if __name__ == "__main__":
     p.add_argument("--target_rms_db", type=float, required=True)
     p.add_argument("--preset_name", required=True)
     p.add_argument("--peak_ceiling_linear", type=float, required=True)
-    args = p.parse_args()
+    p.add_argument("--exports", nargs="*", default=[], help="export specs rendered next to --final_wav, e.g. flac")
+    p.add_argument("--deliverable", default=None, help="export spec for the release pack (default: the WAV)")
+    p.add_argument("--catalog", default=None, help="release index (default: catalog.sqlite next to the release dir, off: none)")
+    p.add_argument("--target_hours", type=float, default=None, help="rendered duration, for the duration gate (verify.py)")
+    p.add_argument("--params_fingerprint", default=None,
+                   help="hash of the render and metadata parameters, for the batch dedupe (catalogue)")
+    args = p.parse_args(argv)
     main(
         args.release_dir,
         args.final_wav,
@@ -111,4 +168,13 @@ if __name__ == "__main__":
         args.target_rms_db,
         args.preset_name,
         args.peak_ceiling_linear,
+        args.exports,
+        args.deliverable,
+        args.catalog,
+        args.target_hours,
+        args.params_fingerprint,
     )
+
+
+if __name__ == "__main__":
+    cli()
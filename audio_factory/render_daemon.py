@@ -0,0 +1,537 @@
+from __future__ import annotations
+import asyncio
+import copy
+import heapq
+import importlib
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator
+
+import yaml
+
+import run_pipeline
+import tracing
+
+
+# Imported once by the daemon; every job process is forked from it and starts
+# with these modules (numpy/scipy/soundfile/PIL behind them) already loaded
+WARM_MODULES = (
+    "generate_sleep_noise", "postprocess", "fused_render", "spectral_noise", "export_audio",
+    "metadata_builder", "cover_generator", "qc_report", "pack_release",
+)
+# Last event of a job, and the reply that ends every request: job processes
+# inherit open client sockets, so clients cannot wait for the connection to close
+FINISHED = "finished"
+DONE = "done"
+READ_LIMIT = 1 << 20
+
+
+def default_socket() -> str:
+    return str(Path(tempfile.gettempdir()) / f"audio_factory_{os.getuid()}.sock")
+
+
+def warm_up() -> None:
+    for name in WARM_MODULES:
+        importlib.import_module(name)
+    # Fonts and the cover background are lru_cached; forked jobs inherit them
+    cover_generator = sys.modules["cover_generator"]
+    cover_generator.load_fonts()
+    cover_generator.template(3000)
+
+
+class Job:
+    # One batch entry; `events` is the full history, replayed to late watchers
+
+    __slots__ = (
+        "id", "entry", "cfg", "ts", "cwd", "orchestrator", "priority", "estimate", "status",
+        "events", "watchers", "proc", "cancel_requested", "submitted",
+    )
+
+    def __init__(
+        self, entry: dict, cfg: dict, ts: str, cwd: str, orchestrator: str, priority: int,
+    ) -> None:
+        self.id = uuid.uuid4().hex[:8]
+        self.entry = entry
+        self.cfg = cfg
+        self.ts = ts
+        self.cwd = cwd
+        self.orchestrator = orchestrator
+        self.priority = priority
+        self.estimate = run_pipeline.estimate_entry(cfg, entry)
+        self.status = "queued"
+        self.events: list[dict] = []
+        self.watchers: set[asyncio.Queue] = set()
+        self.proc: multiprocessing.Process | None = None
+        self.cancel_requested = False
+        self.submitted = time.time()
+
+    def emit(self, event: str, **fields) -> None:
+        msg = {"event": event, "job": self.id, "preset": self.entry["preset"], "time": time.time(), **fields}
+        self.events.append(msg)
+        for queue in self.watchers:
+            queue.put_nowait(msg)
+
+    def finish(self, status: str, **fields) -> None:
+        self.status = status
+        self.emit(FINISHED, status=status, **fields)
+
+    def summary(self) -> dict:
+        return {
+            "job": self.id,
+            "preset": self.entry["preset"],
+            "title": self.entry.get("title", ""),
+            "status": self.status,
+            "priority": self.priority,
+            "ts": self.ts,
+            "submitted": self.submitted,
+            "estimate": self.estimate,
+        }
+
+
+def _job_process(wfd: int, cwd: str, cfg: dict, entry: dict, ts: str, orchestrator: str) -> None:
+    # Forked from the daemon: the asyncio loop's signal wakeup fd is shared with
+    # the parent, so a SIGTERM (cancel) here must not end up in the daemon's loop
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.chdir(cwd)
+    lock = threading.Lock()
+
+    def send(msg: dict) -> None:
+        data = (json.dumps(msg, default=str) + "\n").encode("utf-8")
+        with lock:
+            os.write(wfd, data)
+
+    # Finished spans (stages and their block loops) are the progress reports
+    tracing.subscribe(lambda event: send({"event": "span", **event}))
+    result = run_pipeline._entry_worker(cfg, entry, ts, orchestrator)
+    send({"event": "result", **result})
+    os.close(wfd)
+
+
+class RenderDaemon:
+    """Job queue in front of a bounded pool of forked, warm job processes.
+
+    Clients talk newline-delimited JSON over a Unix socket (or localhost
+    TCP); see `handle` for the requests. Jobs wait in a priority queue
+    (higher first, then submission order) and start while fewer than `jobs`
+    run and their memory estimates fit `memory_budget`, as in
+    run_pipeline.run_batch. Each job forks the daemon, which imported all
+    stage modules once (warm_up), and runs run_pipeline._entry_worker there:
+    stdout/stderr go to the release's pipeline.log, tracing spans and the
+    result come back over a pipe and are streamed to watching clients.
+    Cancelling a running job terminates its process; checkpointed stages can
+    be continued with a resume submit.
+    """
+
+    def __init__(self, jobs: int, memory_budget: int | None) -> None:
+        self.jobs = jobs
+        self.memory_budget = memory_budget
+        self.all_jobs: dict[str, Job] = {}
+        self.queue: list[tuple[int, int, Job]] = []
+        self.running: dict[str, Job] = {}
+        self.seq = 0
+        self.configs: dict[str, tuple[int, dict]] = {}
+        self.tasks: set[asyncio.Task] = set()
+        self.clients: set[asyncio.StreamWriter] = set()
+        self.stop = asyncio.Event()
+        self.ctx = multiprocessing.get_context("fork")
+
+    def load_config(self, path: Path) -> dict:
+        # Parsed once per file version
+        key = str(path.resolve())
+        mtime = path.stat().st_mtime_ns
+        cached = self.configs.get(key)
+        if cached is None or cached[0] != mtime:
+            cached = self.configs[key] = (mtime, yaml.safe_load(path.read_text(encoding="utf-8")))
+        return cached[1]
+
+    def submit(self, req: dict) -> tuple[str, list[Job], list[dict]]:
+        cwd = req.get("cwd") or os.getcwd()
+        cfg = copy.deepcopy(self.load_config(Path(cwd) / req.get("config", "config.yaml")))
+        resume = req.get("resume")
+        ts = resume or f"{datetime.now():%Y-%m-%d_%H%M}_{uuid.uuid4().hex[:6]}"
+        render_cfg = cfg.get("render") or {}
+        if resume:
+            # Same release dirs as the interrupted run; stages pick up their checkpoints
+            render_cfg["resume"] = True
+        if req.get("force_stages"):
+            render_cfg["force_stages"] = req["force_stages"]
+        cfg["render"] = render_cfg
+        orchestrator = req.get("orchestrator") or render_cfg.get("orchestrator", "inprocess")
+        entries = req.get("entries") or run_pipeline.build_entries(cfg)
+        presets = req.get("presets") or []
+        if presets:
+            unknown = set(presets) - {e["preset"] for e in entries}
+            if unknown:
+                raise ValueError(f"No batch entry for preset(s): {', '.join(sorted(unknown))}")
+            entries = [e for e in entries if e["preset"] in presets]
+        released = []
+        if not (resume or req.get("force_stages")):
+            root = Path(cwd) / cfg["output"]["release_root"]
+            entries, released = run_pipeline.dedupe_entries(cfg, entries, root)
+        priority = int(req.get("priority", 0))
+        jobs = [Job(entry, cfg, ts, cwd, orchestrator, priority) for entry in entries]
+        for job in jobs:
+            self.all_jobs[job.id] = job
+            self.seq += 1
+            heapq.heappush(self.queue, (-priority, self.seq, job))
+            job.emit("queued", priority=priority, ts=ts, estimate=job.estimate)
+        self.schedule()
+        return ts, jobs, released
+
+    def cancel(self, job: Job) -> bool:
+        if job.status == "queued":
+            # Left in the heap, schedule() drops it
+            job.finish("cancelled", error="cancelled while queued")
+            return True
+        if job.status == "running" and job.proc is not None:
+            job.cancel_requested = True
+            job.proc.terminate()
+            return True
+        return False
+
+    def schedule(self) -> None:
+        used_memory = sum(job.estimate["memory_bytes"] for job in self.running.values())
+        while self.queue and len(self.running) < self.jobs and not self.stop.is_set():
+            job = self.queue[0][2]
+            if job.status != "queued":
+                heapq.heappop(self.queue)
+                continue
+            need = job.estimate["memory_bytes"]
+            if self.running and self.memory_budget is not None and used_memory + need > self.memory_budget:
+                break  # strict priority order: nothing overtakes the head of the queue
+            heapq.heappop(self.queue)
+            root = Path(job.cwd) / job.cfg["output"]["release_root"]
+            disk_left = run_pipeline.free_disk_bytes(root) - sum(
+                j.estimate["disk_bytes"] for j in self.running.values()
+            )
+            if job.estimate["disk_bytes"] > disk_left:
+                job.finish(
+                    "skipped",
+                    error=f"needs ~{job.estimate['disk_bytes'] / 1e9:.1f} GB disk, {disk_left / 1e9:.1f} GB left",
+                )
+                continue
+            self.running[job.id] = job
+            used_memory += need
+            task = asyncio.create_task(self.run_job(job))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run_job(self, job: Job) -> None:
+        loop = asyncio.get_running_loop()
+        rfd, wfd = os.pipe()
+        job.status = "running"
+        job.proc = self.ctx.Process(
+            target=_job_process, args=(wfd, job.cwd, job.cfg, job.entry, job.ts, job.orchestrator),
+        )
+        job.proc.start()
+        os.close(wfd)
+        print(f"[daemon] start {job.id} {job.entry['preset']} (~{job.estimate['memory_bytes'] / 2**20:.0f} MB)")
+        job.emit("started", pid=job.proc.pid, release_dir=str(run_pipeline.release_dir_for(job.cfg, job.entry, job.ts)))
+        reader = asyncio.StreamReader(limit=READ_LIMIT)
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(rfd, "rb", buffering=0),
+        )
+        result: dict = {}
+        try:
+            while line := await reader.readline():
+                msg = json.loads(line)
+                if msg.pop("event") == "result":
+                    result = msg
+                else:
+                    job.emit("span", **msg)
+        finally:
+            transport.close()
+        # EOF: the process is exiting; reap it without blocking the loop
+        while job.proc.exitcode is None:
+            await asyncio.sleep(0.02)
+        del self.running[job.id]
+        if job.cancel_requested:
+            job.finish("cancelled", error="cancelled while running", exitcode=job.proc.exitcode)
+        elif result:
+            job.finish(result.pop("status"), **result)
+        else:
+            job.finish("failed", error=f"job process died (exit code {job.proc.exitcode})", exitcode=job.proc.exitcode)
+        job.proc = None
+        print(f"[daemon] {job.status} {job.id} {job.entry['preset']}")
+        self.schedule()
+
+    async def watch(self, jobs: list[Job], writer: asyncio.StreamWriter) -> None:
+        # History first, then live events, until every job has finished
+        queue: asyncio.Queue = asyncio.Queue()
+        for job in jobs:
+            for msg in job.events:
+                queue.put_nowait(msg)
+            job.watchers.add(queue)
+        try:
+            left = len(jobs)
+            while left:
+                msg = await queue.get()
+                await send(writer, msg)
+                if msg["event"] == FINISHED:
+                    left -= 1
+        finally:
+            for job in jobs:
+                job.watchers.discard(queue)
+
+    def find(self, ids: list[str]) -> list[Job]:
+        unknown = [i for i in ids if i not in self.all_jobs]
+        if unknown:
+            raise KeyError(f"Unknown job(s): {', '.join(unknown)}")
+        return [self.all_jobs[i] for i in ids]
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """One client connection; one JSON request per line.
+
+        {"op": "submit", "config", "cwd", "presets" | "entries", "priority",
+         "resume", "force_stages", "orchestrator", "watch"} -> "submitted" (job ids, ts,
+            entries skipped as already released, see run_pipeline.dedupe_entries),
+            then with "watch" every event of those jobs until they finished
+        {"op": "watch", "jobs": [...]} -> events of the jobs (default: all
+            unfinished) until they finished
+        {"op": "cancel", "jobs": [...]} -> "cancel" with the cancelled ids
+        {"op": "status"} -> "status" with a summary of every job
+        {"op": "shutdown"} -> "shutdown"; running jobs are terminated
+        Failures are answered with {"event": "error", "error": ...}; every
+        request ends with {"event": "done"}.
+        """
+        self.clients.add(writer)
+        try:
+            while line := await reader.readline():
+                try:
+                    req = json.loads(line)
+                    op = req.get("op")
+                    if op == "submit":
+                        ts, jobs, released = self.submit(req)
+                        await send(writer, {
+                            "event": "submitted", "ts": ts, "jobs": [j.summary() for j in jobs], "released": released,
+                        })
+                        if req.get("watch"):
+                            await self.watch(jobs, writer)
+                    elif op == "watch":
+                        ids = req.get("jobs") or [
+                            job.id for job in self.all_jobs.values() if job.status in ("queued", "running")
+                        ]
+                        await self.watch(self.find(ids), writer)
+                    elif op == "cancel":
+                        cancelled = [job.id for job in self.find(req.get("jobs") or []) if self.cancel(job)]
+                        await send(writer, {"event": "cancel", "jobs": cancelled})
+                    elif op == "status":
+                        await send(writer, {
+                            "event": "status",
+                            "jobs": [job.summary() for job in self.all_jobs.values()],
+                            "workers": self.jobs,
+                        })
+                    elif op == "shutdown":
+                        await send(writer, {"event": "shutdown"})
+                        self.stop.set()
+                    else:
+                        raise ValueError(f"Unknown op: {op!r}")
+                except (ValueError, KeyError, FileNotFoundError, yaml.YAMLError) as e:
+                    await send(writer, {"event": "error", "error": f"{type(e).__name__}: {e}"})
+                await send(writer, {"event": DONE})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # client went away; its jobs keep running
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    async def shutdown(self) -> None:
+        self.stop.set()
+        for job in list(self.all_jobs.values()):
+            self.cancel(job)
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+        # Idle connections end their handlers with EOF instead of a cancellation
+        for writer in list(self.clients):
+            writer.transport.abort()
+        await asyncio.sleep(0)
+
+
+async def send(writer: asyncio.StreamWriter, msg: dict) -> None:
+    writer.write((json.dumps(msg, default=str) + "\n").encode("utf-8"))
+    await writer.drain()
+
+
+def _socket_in_use(path: str) -> bool:
+    with socket.socket(socket.AF_UNIX) as s:
+        try:
+            s.connect(path)
+            return True
+        except OSError:
+            return False
+
+
+async def serve(socket_path: str | None, port: int | None, jobs: int, memory_budget: int | None) -> None:
+    warm_up()
+    daemon = RenderDaemon(jobs, memory_budget)
+    if port is not None:
+        server = await asyncio.start_server(daemon.handle, "127.0.0.1", port, limit=READ_LIMIT)
+        where = f"127.0.0.1:{port}"
+    else:
+        if os.path.exists(socket_path):
+            if _socket_in_use(socket_path):
+                raise RuntimeError(f"A render daemon is already listening on {socket_path}")
+            os.unlink(socket_path)
+        server = await asyncio.start_unix_server(daemon.handle, socket_path, limit=READ_LIMIT)
+        where = socket_path
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, daemon.stop.set)
+    budget = f"{memory_budget / 2**30:.1f} GB" if memory_budget is not None else "unlimited"
+    print(f"[daemon] listening on {where}, {jobs} worker(s), memory budget {budget}", flush=True)
+    try:
+        async with server:
+            await daemon.stop.wait()
+            server.close()
+            await daemon.shutdown()
+    finally:
+        if port is None and os.path.exists(socket_path):
+            os.unlink(socket_path)
+    print("[daemon] stopped")
+
+
+def connect(socket_path: str | None, port: int | None) -> socket.socket:
+    if port is not None:
+        return socket.create_connection(("127.0.0.1", port))
+    s = socket.socket(socket.AF_UNIX)
+    s.connect(socket_path)
+    return s
+
+
+def request(req: dict, socket_path: str | None = None, port: int | None = None) -> Iterator[dict]:
+    """Send one request and yield the daemon's replies until it is answered.
+
+    Plain blocking socket, so scripts can use it without asyncio. Streaming
+    requests (submit with "watch", watch) end after the last job finished.
+    """
+    with connect(socket_path or default_socket(), port) as s, s.makefile("rb") as f:
+        s.sendall((json.dumps(req) + "\n").encode("utf-8"))
+        for line in f:
+            msg = json.loads(line)
+            if msg["event"] == DONE:
+                return
+            yield msg
+
+
+def format_event(msg: dict) -> str:
+    tag = f"[{msg.get('job', 'daemon')}]"
+    event = msg["event"]
+    if event == "submitted":
+        jobs = ", ".join(f"{j['job']} {j['preset']}" for j in msg["jobs"])
+        lines = [f"submitted {len(msg['jobs'])} job(s), ts {msg['ts']}: {jobs or '-'}"]
+        for r in msg.get("released", []):
+            lines.append(f"skipped {r['preset']} {r['title']!r}, already released: {', '.join(r['release_dirs'])}")
+        return "\n".join(lines)
+    if event == "queued":
+        return f"{tag} queued {msg['preset']} (priority {msg['priority']})"
+    if event == "started":
+        return f"{tag} started {msg['preset']} -> {msg['release_dir']}"
+    if event == "span":
+        indent = "" if msg["cat"] == "stage" else "  "
+        frames = f", {msg['frames']} frames" if msg.get("frames") else ""
+        return f"{tag} {indent}{msg['name']} {msg['status']} {msg['wall_s']:.2f} s{frames}"
+    if event == FINISHED:
+        detail = msg.get("error") or msg.get("release_dir", "")
+        seconds = f" {msg['seconds']:.1f} s" if msg.get("seconds") else ""
+        log = f" (log: {msg['log']})" if msg["status"] == "failed" and msg.get("log") else ""
+        return f"{tag} {msg['status']} {msg['preset']}{seconds} {detail}{log}"
+    if event == "status":
+        lines = [f"{msg['workers']} worker(s)"]
+        for j in msg["jobs"]:
+            lines.append(f"{j['job']}  {j['status']:<10}{j['priority']:>4}  {j['preset']:<16}{j['ts']}")
+        return "\n".join(lines)
+    if event == "cancel":
+        return f"cancelled: {', '.join(msg['jobs']) or '-'}"
+    if event == "shutdown":
+        return "daemon shutting down, running jobs are terminated"
+    if event == "error":
+        return f"error: {msg['error']}"
+    return json.dumps(msg)
+
+
+def print_replies(replies: Iterator[dict], as_json: bool) -> int:
+    # Exit code for scripts: 1 on an error reply or a job that did not end "ok"
+    code = 0
+    for msg in replies:
+        print(json.dumps(msg) if as_json else format_event(msg), flush=True)
+        if msg["event"] == "error" or (msg["event"] == FINISHED and msg["status"] != "ok"):
+            code = 1
+    return code
+
+
+def cli(argv: list[str] | None = None) -> None:
+    import argparse
+
+    p = argparse.ArgumentParser(description="Warm render daemon and its client")
+    p.add_argument("--socket", default=None, help=f"Unix socket (default {default_socket()})")
+    p.add_argument("--port", type=int, default=None, help="localhost TCP port instead of the Unix socket")
+    p.add_argument("--json", action="store_true", help="print the raw JSON events")
+    sub = p.add_subparsers(dest="command", required=True)
+
+    s = sub.add_parser("serve", help="run the daemon")
+    s.add_argument("--jobs", type=int, default=2, help="jobs running at the same time")
+    s.add_argument("--memory_budget_gb", type=float, default=None, help="default: 80%% of the free RAM at start")
+
+    s = sub.add_parser("submit", help="queue batch entries of a config")
+    s.add_argument("--config", default="config.yaml")
+    s.add_argument("--preset", nargs="*", default=[], help="only the batch entries of these presets")
+    s.add_argument("--entry", action="append", default=[], help="a batch entry as JSON instead of the config's batch")
+    s.add_argument("--priority", type=int, default=0, help="higher runs first")
+    s.add_argument("--orchestrator", choices=["inprocess", "subprocess"], default=None)
+    s.add_argument("--resume", metavar="TIMESTAMP", default=None, help="continue the release dirs of an earlier submit")
+    s.add_argument("--force_stage", "--force-stage", dest="force_stages", nargs="+", default=[],
+                   choices=[*run_pipeline.STAGES, "all"], help="run these stages even if their fingerprint is unchanged")
+    s.add_argument("--wait", action="store_true", help="stream progress until the jobs finished")
+
+    s = sub.add_parser("wait", help="stream progress of jobs until they finished")
+    s.add_argument("jobs", nargs="*", help="default: all unfinished jobs")
+    s = sub.add_parser("cancel", help="cancel queued or running jobs")
+    s.add_argument("jobs", nargs="+")
+    sub.add_parser("status", help="list all jobs")
+    sub.add_parser("shutdown", help="stop the daemon, terminating running jobs")
+    args = p.parse_args(argv)
+
+    socket_path = args.socket or default_socket()
+    if args.command == "serve":
+        if args.memory_budget_gb is not None:
+            memory_budget = int(args.memory_budget_gb * 1024 ** 3)
+        else:
+            available = run_pipeline.available_memory_bytes()
+            memory_budget = int(available * 0.8) if available else None
+        asyncio.run(serve(socket_path, args.port, args.jobs, memory_budget))
+        return
+
+    if args.command == "submit":
+        req = {
+            "op": "submit",
+            "config": str(Path(args.config).resolve()),
+            "cwd": os.getcwd(),
+            "presets": args.preset,
+            "entries": [json.loads(e) for e in args.entry],
+            "priority": args.priority,
+            "orchestrator": args.orchestrator,
+            "resume": args.resume,
+            "force_stages": args.force_stages,
+            "watch": args.wait,
+        }
+    elif args.command in ("wait", "cancel"):
+        req = {"op": "watch" if args.command == "wait" else "cancel", "jobs": args.jobs}
+    else:
+        req = {"op": args.command}
+    sys.exit(print_replies(request(req, socket_path, args.port), args.json))
+
+
+if __name__ == "__main__":
+    cli()
@@ -3,7 +3,38 @@ import yaml
 from pathlib import Path
 import subprocess
 from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import hashlib
+import importlib
+import json
+import os
+import shutil
 import sys
+import time
+import traceback
+from contextlib import closing, contextmanager
+from typing import Iterator
+
+import catalog
+import tracing
+from stage_cache import StageCache
+
+# Stage modules in pipeline order
+STAGES = [
+    "generate_sleep_noise", "postprocess", "fused_render",
+    "metadata_builder", "cover_generator", "qc_report", "pack_release",
+]
+# Stage name -> {"calls", "import_s", "total_s"}; filled by run_stage
+STAGE_TIMINGS: dict[str, dict[str, float]] = {}
+
+# Rough footprint model for the scheduler, measured on 0.1 h renders:
+# interpreter + numpy/scipy, plus per-frame RAM of the in-memory postprocess
+# (float32 signal + float64 filtfilt temporaries). Stream/fused stay flat.
+BASE_MEMORY_BYTES = 150 * 1024 * 1024
+MEMORY_BYTES_PER_FRAME = {"memory": 32, "stream": 0, "fused": 0}
+# Export size relative to PCM of the same subtype; FLAC of the lowpassed
+# presets is ~0.2-0.5, kept pessimistic
+EXPORT_SIZE_FACTOR = {"wav": 1.0, "flac": 0.7, "ogg": 0.1}
 
 def run(cmd: list[str]) -> None:
     if cmd and cmd[0] == "python":
@@ -11,96 +42,712 @@ def run(cmd: list[str]) -> None:
     print(" ".join(cmd))
     subprocess.check_call(cmd)
 
-def main() -> None:
-    cfg = yaml.safe_load(Path("config.yaml").read_text(encoding="utf-8"))
-    ts = datetime.now().strftime("%Y-%m-%d_%H%M")
+def run_inprocess(cmd: list[str]) -> None:
+    # Same argv as run(), but calls the stage module's cli() in this interpreter.
+    # Modules are imported on first use, so e.g. metadata_builder never pulls in scipy.
+    stage = Path(cmd[1]).stem
+    print("[in-process] " + " ".join(cmd[1:]))
+    t0 = time.perf_counter()
+    module = importlib.import_module(stage)
+    STAGE_TIMINGS.setdefault(stage, {"calls": 0, "import_s": 0.0, "total_s": 0.0})["import_s"] += time.perf_counter() - t0
+    module.cli(cmd[2:])
+
+def run_stage(cmd: list[str], orchestrator: str = "inprocess") -> None:
+    stage = Path(cmd[1]).stem
+    t0 = time.perf_counter()
+    with tracing.span(f"stage:{stage}", cat="stage", children=orchestrator == "subprocess", orchestrator=orchestrator):
+        if orchestrator == "inprocess":
+            run_inprocess(cmd)
+        elif orchestrator == "subprocess":
+            run(cmd)
+        else:
+            raise ValueError(f"Unknown orchestrator: {orchestrator}")
+    timing = STAGE_TIMINGS.setdefault(stage, {"calls": 0, "import_s": 0.0, "total_s": 0.0})
+    timing["calls"] += 1
+    timing["total_s"] += time.perf_counter() - t0
+
+def run_cached_stage(
+    cache: StageCache | None,
+    cmd: list[str],
+    orchestrator: str = "inprocess",
+    inputs: list[Path] = (),
+    outputs: list[Path] = (),
+    volatile: tuple[str, ...] = (),
+) -> None:
+    # run_stage, unless an earlier run with the same fingerprint left the outputs (stage_cache)
+    if cache is None:
+        run_stage(cmd, orchestrator)
+        return
+    with tracing.span("stage_cache", stage=Path(cmd[1]).stem) as sp:
+        stage = cache.plan(cmd, inputs, outputs, volatile)
+        sp.attrs["hit"] = cache.restore(stage)
+    if sp.attrs["hit"]:
+        print(f"[cached] {stage.name}: outputs of an earlier run reused ({stage.key[:12]})")
+        return
+    cache.detach(stage)
+    run_stage(cmd, orchestrator)
+    cache.store(stage)
+
+def stage_cache_for(cfg: dict, release_dirs: list[Path]) -> StageCache | None:
+    render_cfg = cfg.get("render") or {}
+    if not render_cfg.get("incremental", True):
+        return None
+    return StageCache(cfg["output"]["release_root"], release_dirs, set(render_cfg.get("force_stages") or []))
+
+def audio_outputs(final_wavs: list[Path], exports: list[str]) -> list[Path]:
+    # Files postprocess/fused_render write per final WAV: the WAV, its exports and their sidecars
+    from export_audio import export_path
+    from wav_analysis import sidecar_path
+
+    files = []
+    for wav in final_wavs:
+        for path in [wav, *(export_path(wav, spec) for spec in exports)]:
+            files += [path, sidecar_path(path)]
+    return files
+
+@contextmanager
+def release_trace(cfg: dict, release_dir: Path) -> Iterator[None]:
+    # Stage and block-loop spans as JSON lines (plus a Chrome trace) in the release dir
+    mode = cfg["output"].get("trace", "jsonl")
+    if mode == "off":
+        yield
+        return
+    chrome = release_dir / "trace.chrome.json" if mode == "chrome" else None
+    with tracing.trace_to(release_dir / "trace.jsonl", chrome):
+        yield
+
+def probe_startup(stage: str) -> float:
+    # Interpreter start + module import, i.e. the fixed cost of one subprocess stage
+    t0 = time.perf_counter()
+    subprocess.check_call([sys.executable, "-c", f"import {stage}"])
+    return time.perf_counter() - t0
+
+def print_timing_report(orchestrator: str, startup_report: bool) -> None:
+    print(f"\nSTAGE TIMINGS ({orchestrator}):")
+    print(f"{'stage':<22}{'calls':>6}{'startup+import s':>18}{'total s':>10}")
+    # Subprocess startup is paid on every call; only measured on request since
+    # it costs extra processes, otherwise the column shows "-"
+    measured = orchestrator != "subprocess" or startup_report
+    overhead = 0.0
+    total = 0.0
+    for stage, t in STAGE_TIMINGS.items():
+        if orchestrator == "subprocess":
+            startup = probe_startup(stage) * t["calls"] if startup_report else 0.0
+        else:
+            startup = t["import_s"]
+        overhead += startup
+        total += t["total_s"]
+        startup_col = f"{startup:>18.2f}" if measured else f"{'-':>18}"
+        print(f"{stage:<22}{int(t['calls']):>6}{startup_col}{t['total_s']:>10.2f}")
+    overhead_col = f"{overhead:>18.2f}" if measured else f"{'-':>18}"
+    print(f"{'all stages':<22}{'':>6}{overhead_col}{total:>10.2f}")
+
+def build_entries(cfg: dict) -> list[dict]:
     batch = cfg.get("batch") or []
-    entries = batch if batch else [{
+    return batch if batch else [{
         "preset": "brown_noise",
         "title": cfg["track"]["title"],
         "filename_base": cfg["output"]["filename_base"],
     }]
 
-    for entry in entries:
-        preset = entry["preset"]
-        title = entry["title"]
-        base = entry["filename_base"]
-        target_rms_db = entry.get("target_rms_db", cfg["audio"]["target_rms_db"])
-        peak_ceiling_linear = entry.get("peak_ceiling_linear", 0.98)
-        release_dir = Path(cfg["output"]["release_root"]) / f"{ts}_{preset}"
+def expand_variants(cfg: dict, entry: dict) -> list[dict]:
+    # One release per duration, longest (the master render) first. With
+    # variants_hours, "{hours}" in title/filename_base is filled in per variant;
+    # a filename_base without it gets an "_<hours>h" suffix.
+    hours = entry.get("variants_hours") or [entry.get("hours", cfg["audio"]["duration_hours"])]
+    releases = []
+    for h in sorted({float(h) for h in hours}, reverse=True):
+        release = dict(entry, hours=h)
+        if entry.get("variants_hours"):
+            hours_str = f"{h:g}"
+            release["title"] = entry["title"].replace("{hours}", hours_str)
+            base = entry["filename_base"]
+            release["filename_base"] = base.replace("{hours}", hours_str) if "{hours}" in base else f"{base}_{hours_str}h"
+        releases.append(release)
+    return releases
+
+def dedupe_entries(cfg: dict, entries: list[dict], release_root: Path | None = None) -> tuple[list[dict], list[dict]]:
+    # Splits entries into (to render, already released). An entry counts as
+    # released when every duration of it is a packed release in the catalogue
+    # with the same preset, title and release_fingerprint, duration within the
+    # QC tolerance, and its release pack is still on disk. An entry whose
+    # parameters changed is rendered again; its unchanged stages come from the
+    # stage cache (render.incremental). A title already used otherwise only warns.
+    root = release_root or Path(cfg["output"]["release_root"])
+    db_path = catalog.catalog_path(root)
+    if not cfg["output"].get("dedupe", True) or not db_path.exists():
+        return entries, []
+    render, released = [], []
+    with closing(catalog.connect(db_path)) as conn:
+        for entry in entries:
+            matches = []
+            for release in expand_variants(cfg, entry):
+                rows = catalog.find_releases(conn, preset=release["preset"], title=release["title"],
+                                             hours=release["hours"], status="packed")
+                fingerprint = release_fingerprint(cfg, release)
+                match = next((
+                    row for row in rows
+                    if row["params_fingerprint"] == fingerprint and Path(row["pack_zip"]).exists()
+                ), None)
+                if match is None and rows:
+                    print(f"[dedupe] {release['title']!r}: no packed release with these parameters (latest: "
+                          f"{rows[0]['release_dir']}), rendering it again; unchanged stages are reused")
+                    break
+                if match is None:
+                    for row in catalog.find_releases(conn, title=release["title"], limit=1):
+                        print(f"[dedupe] warning: title {release['title']!r} already used by {row['release_dir']} "
+                              f"({row['preset']}, {row['duration_seconds'] / 3600:g} h), rendering it again")
+                    break
+                matches.append(match)
+            else:
+                released.append({
+                    "preset": entry["preset"],
+                    "title": entry.get("title", ""),
+                    "release_dirs": [row["release_dir"] for row in matches],
+                })
+                continue
+            render.append(entry)
+    return render, released
+
+def release_dir_for(cfg: dict, entry: dict, ts: str) -> Path:
+    name = f"{ts}_{entry['preset']}"
+    if entry.get("variants_hours"):
+        name += f"_{float(entry.get('hours', max(entry['variants_hours']))):g}h"
+    return Path(cfg["output"]["release_root"]) / name
+
+def export_bytes(spec: str, samples: int) -> int:
+    # spec as in output.exports, e.g. "flac" or "wav:PCM_24"; samples = frames * channels
+    fmt, _, subtype = spec.partition(":")
+    bytes_per_sample = {"PCM_24": 3, "PCM_32": 4, "FLOAT": 4}.get(subtype.upper(), 2)
+    return int(samples * bytes_per_sample * EXPORT_SIZE_FACTOR.get(fmt.lower(), 1.0))
+
+def entry_channels(cfg: dict, entry: dict) -> tuple[int, float]:
+    # (channels, inter-channel correlation) from audio config, overridable per batch entry
+    channels = int(entry.get("channels", cfg["audio"].get("channels", 1)))
+    correlation = float(entry.get("channel_correlation", cfg["audio"].get("channel_correlation", 0.0)))
+    return channels, correlation
+
+def release_fingerprint(cfg: dict, release: dict) -> str:
+    # Hash of everything that goes into a release's audio, metadata, cover
+    # and pack (one expand_variants() release); stored in its QC report and
+    # the catalogue for dedupe_entries. How it is rendered (fused, segments,
+    # workers, ...) and the code version do not count.
+    audio = cfg["audio"]
+    channels, correlation = entry_channels(cfg, release)
+    params = {
+        "preset": release["preset"],
+        "title": release["title"],
+        "filename_base": release.get("filename_base"),
+        "hours": release["hours"],
+        "seed": release.get("seed"),
+        "engine": release.get("engine", (cfg.get("render") or {}).get("engine", "kernel")),
+        "sample_rate": audio["sample_rate"],
+        "channels": channels,
+        "channel_correlation": correlation,
+        "highpass_hz": audio["highpass_hz"],
+        "lowpass_hz": audio["lowpass_hz"],
+        "fade_seconds": audio["fade_seconds"],
+        "target_rms_db": float(release.get("target_rms_db", audio["target_rms_db"])),
+        "peak_ceiling_linear": float(release.get("peak_ceiling_linear", 0.98)),
+        "artist": cfg["project_name"],
+        "album": cfg["album_name"],
+        "genre": cfg["track"]["genre"],
+        "mood": cfg["track"]["mood"],
+        "description": cfg["track"]["description"],
+        "exports": cfg["output"].get("exports") or [],
+        "deliverable": cfg["output"].get("deliverable", "wav"),
+        "pack_audio": cfg["output"].get("pack_audio", "copy"),
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def estimate_entry(cfg: dict, entry: dict) -> dict:
+    # Peak RAM of the heaviest stage and disk left behind in the release dir(s)
+    render_cfg = cfg.get("render") or {}
+    sr = cfg["audio"]["sample_rate"]
+    releases = expand_variants(cfg, entry)
+    frames = int(releases[0]["hours"] * 3600 * sr)
+    channels, _ = entry_channels(cfg, entry)
+    fused = render_cfg.get("fused", False)
+    mode = "fused" if fused else render_cfg.get("postprocess_mode", "memory")
+    if mode == "memory" and len(releases) > 1:
+        mode = "stream"
+    # With pack_audio "move" only the zip (stored WAV) stays, the raw WAV is
+    # removed after postprocess; packing frees the WAV while it is copied, or
+    # briefly holds WAV + zip where the file system cannot punch holes
+    move = cfg["output"].get("pack_audio", "copy") == "move"
+    disk = 0 if fused or move else frames * channels * 2  # raw
+    exports = cfg["output"].get("exports") or []
+    deliverable = cfg["output"].get("deliverable", "wav")
+    for release in releases:
+        n = int(release["hours"] * 3600 * sr) * channels  # samples
+        # final WAV + exports + zip of the deliverable (stored), minus the deliverable if moved
+        packed = n * 2 if deliverable == "wav" else export_bytes(deliverable, n)
+        disk += n * 2 + sum(export_bytes(spec, n) for spec in exports) + (0 if move else packed)
+    if mode == "stream":
+        disk += frames * channels * 4  # float32 scratch, removed again after postprocess
+    elif move:
+        from pack_release import PUNCH_BYTES, can_punch_holes
+
+        root = existing_parent(Path(cfg["output"]["release_root"]))
+        disk += PUNCH_BYTES if can_punch_holes(str(root)) else frames * channels * 2
+    return {
+        "frames": frames,
+        "memory_bytes": BASE_MEMORY_BYTES + frames * channels * MEMORY_BYTES_PER_FRAME[mode],
+        "disk_bytes": disk,
+    }
+
+def available_memory_bytes() -> int | None:
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def batch_memory_budget(render_cfg: dict) -> int | None:
+    # render.memory_budget_gb, default 80% of the RAM free now
+    budget_gb = render_cfg.get("memory_budget_gb")
+    if budget_gb is not None:
+        return int(float(budget_gb) * 1024 ** 3)
+    available = available_memory_bytes()
+    return int(available * 0.8) if available else None
+
+def existing_parent(path: Path) -> Path:
+    # The release root may not exist before the first run; its file system does
+    path = path.resolve()
+    while not path.exists():
+        path = path.parent
+    return path
+
+def free_disk_bytes(path: Path) -> int:
+    return shutil.disk_usage(existing_parent(path)).free
+
+def run_entry(cfg: dict, entry: dict, ts: str, orchestrator: str = "inprocess") -> Path:
+    render_cfg = cfg.get("render") or {}
+    releases = expand_variants(cfg, entry)
+    master = releases[0]
+    preset = master["preset"]
+    target_rms_db = entry.get("target_rms_db", cfg["audio"]["target_rms_db"])
+    peak_ceiling_linear = entry.get("peak_ceiling_linear", 0.98)
+    release_dirs = [release_dir_for(cfg, release, ts) for release in releases]
+    for release_dir in release_dirs:
         release_dir.mkdir(parents=True, exist_ok=True)
+    final_wavs = [d / f"{r['filename_base']}_final.wav" for r, d in zip(releases, release_dirs)]
+    raw_wav = release_dirs[0] / f"{master['filename_base']}_raw.wav"
+    hours_val = master["hours"]
+    # Stages whose fingerprint is unchanged reuse the outputs of an earlier run,
+    # also from older timestamped release dirs
+    cache = stage_cache_for(cfg, release_dirs)
 
-        raw_wav = release_dir / f"{base}_raw.wav"
-        final_wav = release_dir / f"{base}_final.wav"
-        meta_json = release_dir / "metadata.json"
-        cover_jpg = release_dir / "cover.jpg"
-        qc_json = release_dir / "qc_report.json"
-        manifest_txt = release_dir / "manifest.txt"
-        release_zip = release_dir / "release_pack.zip"
-
-        hours_val = cfg["audio"]["duration_hours"]
-        hours_str = f"{hours_val:g}"
-        description_tpl = cfg["track"]["description"]
-        description = description_tpl.format(hours=hours_str, title=title, preset=preset)
-
-        # 1) Generate
-        run(["python", "generate_sleep_noise.py",
-             "--out", str(raw_wav),
-             "--hours", str(hours_val),
-             "--sr", str(cfg["audio"]["sample_rate"]),
-             "--preset", preset])
-
-        # 2) Postprocess
-        run(["python", "postprocess.py",
-             "--in", str(raw_wav),
-             "--out", str(final_wav),
-             "--sr", str(cfg["audio"]["sample_rate"]),
-             "--target_rms_db", str(target_rms_db),
-             "--fade_seconds", str(cfg["audio"]["fade_seconds"]),
-             "--highpass_hz", str(cfg["audio"]["highpass_hz"]),
-             "--lowpass_hz", str(cfg["audio"]["lowpass_hz"]),
-             "--peak_ceiling_linear", str(peak_ceiling_linear)])
+    with release_trace(cfg, release_dirs[0]):
+        # Shorter durations are cut from the master render, see postprocess.stream_postprocess
+        variant_args = []
+        seed = entry.get("seed")
+        volatile = ()
+        if len(releases) > 1:
+            variant_args = ["--variant_out", *map(str, final_wavs[1:]),
+                            "--variant_hours", *[str(r["hours"]) for r in releases[1:]]]
+            if seed is None and render_cfg.get("fused", False):
+                # The fused replay needs a fixed seed for all outputs
+                seed = int.from_bytes(os.urandom(7), "little")
+                volatile = ("--seed",)  # any drawn seed is as good as another for reuse
+                print(f"Master render seed for {preset}: {seed}")
+        seed_args = [] if seed is None else ["--seed", str(seed)]
+        # Checkpoints cover generate (unsegmented) and the streaming postprocess;
+        # a --resume run continues the stages of the same release dirs from there
+        checkpoint_args = []
+        if render_cfg.get("resume", False):
+            checkpoint_args = ["--resume"]
+        elif render_cfg.get("checkpoint", False):
+            checkpoint_args = ["--checkpoint"]
+        # engine "fft" renders the target spectrum including the highpass/lowpass
+        # (spectral_noise); postprocess then has no filters left to run
+        engine = entry.get("engine", render_cfg.get("engine", "kernel"))
+        engine_args = ["--engine", engine] if engine != "kernel" else []
+        filter_hz = [str(cfg["audio"]["highpass_hz"]), str(cfg["audio"]["lowpass_hz"])]
+        generate_filter_args = ["--highpass_hz", filter_hz[0], "--lowpass_hz", filter_hz[1]] if engine == "fft" else []
+        post_filter_hz = ["0", "0"] if engine == "fft" else filter_hz
+        # Multichannel renders are one interleaved file from the start; postprocess
+        # and QC take the channel count from the WAV
+        channels, correlation = entry_channels(cfg, entry)
+        channel_args = []
+        if channels > 1:
+            channel_args = ["--channels", str(channels), "--correlation", str(correlation)]
+        # Further formats (FLAC, 24-bit, ...) are encoded while the final WAVs are written
+        exports = cfg["output"].get("exports") or []
+        export_args = ["--export", *exports] if exports else []
 
+        from pack_release import pending_pack
+
+        if all(pending_pack(d) for d in release_dirs):
+            # A --resume after packing with pack_audio "move" failed: the audio
+            # is in the .packing files and partial zips, pack_release finishes them
+            print(f"Interrupted release pack(s) of {preset} found, not rendering again")
+        elif render_cfg.get("fused", False):
+            # 1+2) Generate and postprocess in one pass, no raw WAV on disk
+            run_cached_stage(cache, ["python", "fused_render.py",
+                                     "--out", str(final_wavs[0]),
+                                     "--hours", str(hours_val),
+                                     "--sr", str(cfg["audio"]["sample_rate"]),
+                                     "--preset", preset,
+                                     "--target_rms_db", str(target_rms_db),
+                                     "--fade_seconds", str(cfg["audio"]["fade_seconds"]),
+                                     "--highpass_hz", str(cfg["audio"]["highpass_hz"]),
+                                     "--lowpass_hz", str(cfg["audio"]["lowpass_hz"]),
+                                     "--peak_ceiling_linear", str(peak_ceiling_linear),
+                                     *seed_args,
+                                     *variant_args,
+                                     *export_args,
+                                     *engine_args,
+                                     *channel_args], orchestrator,
+                             outputs=audio_outputs(final_wavs, exports), volatile=volatile)
+        else:
+            # 1) Generate
+            segment_args = []
+            if int(render_cfg.get("segments", 1)) > 1:
+                segment_args = ["--segments", str(render_cfg["segments"])]
+                if render_cfg.get("segment_workers"):
+                    segment_args += ["--workers", str(render_cfg["segment_workers"])]
+            run_cached_stage(cache, ["python", "generate_sleep_noise.py",
+                                     "--out", str(raw_wav),
+                                     "--hours", str(hours_val),
+                                     "--sr", str(cfg["audio"]["sample_rate"]),
+                                     "--preset", preset,
+                                     *segment_args,
+                                     *seed_args,
+                                     *checkpoint_args,
+                                     *engine_args,
+                                     *generate_filter_args,
+                                     *channel_args], orchestrator,
+                             outputs=[raw_wav])
+
+            # 2) Postprocess (variants need the streaming path)
+            mode = render_cfg.get("postprocess_mode", "memory")
+            if variant_args:
+                mode = "stream"
+            run_cached_stage(cache, ["python", "postprocess.py",
+                                     "--in", str(raw_wav),
+                                     "--out", str(final_wavs[0]),
+                                     "--sr", str(cfg["audio"]["sample_rate"]),
+                                     "--target_rms_db", str(target_rms_db),
+                                     "--fade_seconds", str(cfg["audio"]["fade_seconds"]),
+                                     "--highpass_hz", post_filter_hz[0],
+                                     "--lowpass_hz", post_filter_hz[1],
+                                     "--peak_ceiling_linear", str(peak_ceiling_linear),
+                                     "--mode", mode,
+                                     *variant_args,
+                                     *export_args,
+                                     *(checkpoint_args if mode == "stream" else [])], orchestrator,
+                             inputs=[raw_wav], outputs=audio_outputs(final_wavs, exports))
+            if cfg["output"].get("pack_audio", "copy") == "move":
+                # Only the packed audio is kept, so the intermediate is not needed either
+                raw_wav.unlink(missing_ok=True)
+
+    for release, release_dir, final_wav in zip(releases, release_dirs, final_wavs):
+        run_release_stages(
+            cfg, release, release_dir, final_wav, target_rms_db, peak_ceiling_linear, orchestrator, cache,
+        )
+    return release_dirs[0]
+
+def cover_cache_dir(cfg: dict) -> Path:
+    return Path(cfg["output"]["release_root"]) / ".cover_cache"
+
+def prerender_covers(cfg: dict, entries: list[dict], ts: str, orchestrator: str = "inprocess") -> None:
+    # All covers of the run in one batch (fonts and template loaded once, JPEG
+    # encode in a thread pool); the per-release cover stages then hit the cache
+    covers = [
+        {
+            "out": str(release_dir_for(cfg, release, ts) / "cover.jpg"),
+            "title": release["title"],
+            "artist": cfg["project_name"],
+        }
+        for entry in entries
+        for release in expand_variants(cfg, entry)
+    ]
+    if len(covers) < 2:
+        return
+    cache_dir = cover_cache_dir(cfg)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    batch_json = cache_dir / f"batch_{ts}.json"
+    batch_json.write_text(json.dumps(covers, indent=2), encoding="utf-8")
+    try:
+        run_stage(["python", "cover_generator.py",
+                   "--batch", str(batch_json),
+                   "--cache_dir", str(cache_dir)], orchestrator)
+    finally:
+        batch_json.unlink(missing_ok=True)
+
+def run_release_stages(
+    cfg: dict,
+    release: dict,
+    release_dir: Path,
+    final_wav: Path,
+    target_rms_db: float,
+    peak_ceiling_linear: float,
+    orchestrator: str = "inprocess",
+    cache: StageCache | None = None,
+) -> None:
+    preset = release["preset"]
+    title = release["title"]
+    meta_json = release_dir / "metadata.json"
+    cover_jpg = release_dir / "cover.jpg"
+    qc_json = release_dir / "qc_report.json"
+    manifest_txt = release_dir / "manifest.txt"
+    release_zip = release_dir / "release_pack.zip"
+    move_audio = cfg["output"].get("pack_audio", "copy") == "move"
+    exports = cfg["output"].get("exports") or []
+    deliverable = cfg["output"].get("deliverable", "wav")
+    audio_files = audio_outputs([final_wav], exports)
+
+    hours_str = f"{release['hours']:g}"
+    description_tpl = cfg["track"]["description"]
+    description = description_tpl.format(hours=hours_str, title=title, preset=preset)
+
+    pack_cmd = ["python", "pack_release.py",
+                "--release_dir", str(release_dir),
+                "--qc_report", str(qc_json),
+                "--manifest", str(manifest_txt),
+                "--out_zip", str(release_zip),
+                *(["--move_audio"] if move_audio else [])]
+    from pack_release import pending_pack
+
+    if move_audio and pending_pack(release_dir):
+        # Metadata, cover and QC are done; their stages would need the audio
+        with release_trace(cfg, release_dir):
+            run_stage(pack_cmd, orchestrator)
+        print(f"\nREADY FOR UPLOAD:\n{release_zip}\n{cover_jpg}\n{meta_json}")
+        return
+
+    with release_trace(cfg, release_dir):
         # 3) Metadata
-        run(["python", "metadata_builder.py",
-             "--out", str(meta_json),
-             "--artist", cfg["project_name"],
-             "--title", title,
-             "--album", cfg["album_name"],
-             "--genre", cfg["track"]["genre"],
-             "--mood", *cfg["track"]["mood"],
-             "--description", description])
+        run_cached_stage(cache, ["python", "metadata_builder.py",
+                                 "--out", str(meta_json),
+                                 "--artist", cfg["project_name"],
+                                 "--title", title,
+                                 "--album", cfg["album_name"],
+                                 "--genre", cfg["track"]["genre"],
+                                 "--mood", *cfg["track"]["mood"],
+                                 "--description", description], orchestrator,
+                         outputs=[meta_json])
 
         # 4) Cover
-        run(["python", "cover_generator.py",
-             "--out", str(cover_jpg),
-             "--title", title,
-             "--artist", cfg["project_name"]])
+        run_cached_stage(cache, ["python", "cover_generator.py",
+                                 "--out", str(cover_jpg),
+                                 "--title", title,
+                                 "--artist", cfg["project_name"],
+                                 "--cache_dir", str(cover_cache_dir(cfg))], orchestrator,
+                         outputs=[cover_jpg])
 
         # 5) QC report
-        run(["python", "qc_report.py",
-             "--release_dir", str(release_dir),
-             "--final_wav", str(final_wav),
-             "--cover", str(cover_jpg),
-             "--metadata", str(meta_json),
-             "--out", str(qc_json),
-             "--target_rms_db", str(target_rms_db),
-             "--preset_name", preset,
-             "--peak_ceiling_linear", str(peak_ceiling_linear)])
+        run_cached_stage(cache, ["python", "qc_report.py",
+                                 "--release_dir", str(release_dir),
+                                 "--final_wav", str(final_wav),
+                                 "--cover", str(cover_jpg),
+                                 "--metadata", str(meta_json),
+                                 "--out", str(qc_json),
+                                 "--target_rms_db", str(target_rms_db),
+                                 "--preset_name", preset,
+                                 "--peak_ceiling_linear", str(peak_ceiling_linear),
+                                 "--target_hours", str(release["hours"]),
+                                 "--params_fingerprint", release_fingerprint(cfg, release),
+                                 *(["--exports", *exports] if exports else []),
+                                 "--deliverable", deliverable], orchestrator,
+                         inputs=[cover_jpg, meta_json, *audio_files], outputs=[qc_json])
 
         # 6) Pack release
-        run(["python", "pack_release.py",
-             "--release_dir", str(release_dir),
-             "--qc_report", str(qc_json),
-             "--manifest", str(manifest_txt),
-             "--out_zip", str(release_zip)])
+        run_cached_stage(cache, pack_cmd, orchestrator,
+                         inputs=[qc_json, cover_jpg, meta_json],
+                         outputs=[manifest_txt, release_zip, release_dir / "release_pack.sha256"])
 
-        print("\nREADY FOR UPLOAD:")
-        print(final_wav)
-        print(cover_jpg)
-        print(meta_json)
+    print("\nREADY FOR UPLOAD:")
+    deliverable_name = json.loads(qc_json.read_text(encoding="utf-8"))["deliverable_filename"]
+    print(release_zip if move_audio else release_dir / deliverable_name)
+    print(cover_jpg)
+    print(meta_json)
 
-if __name__ == "__main__":
-    main()
+def _entry_worker(cfg: dict, entry: dict, ts: str, orchestrator: str) -> dict:
+    # Runs one batch entry in a pool worker with stdout/stderr (including
+    # subprocess stages) redirected to the entry's own log file.
+    release_dir = release_dir_for(cfg, entry, ts)
+    release_dir.mkdir(parents=True, exist_ok=True)
+    log_path = release_dir / "pipeline.log"
+    STAGE_TIMINGS.clear()
+    t0 = time.perf_counter()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    log_mode = "a" if (cfg.get("render") or {}).get("resume") else "w"
+    with log_path.open(log_mode, encoding="utf-8") as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            run_entry(cfg, entry, ts, orchestrator)
+            status, error = "ok", ""
+        except BaseException as e:
+            traceback.print_exc()
+            status, error = "failed", f"{type(e).__name__}: {e}"
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+    return {
+        "status": status,
+        "error": error,
+        "seconds": time.perf_counter() - t0,
+        "release_dir": str(release_dir),
+        "log": str(log_path),
+        "timings": dict(STAGE_TIMINGS),
+    }
+
+def _merge_timings(timings: dict[str, dict[str, float]]) -> None:
+    for stage, t in timings.items():
+        acc = STAGE_TIMINGS.setdefault(stage, {"calls": 0, "import_s": 0.0, "total_s": 0.0})
+        for key, value in t.items():
+            acc[key] += value
 
+def run_batch(cfg: dict, entries: list[dict], ts: str, orchestrator: str, jobs: int, memory_budget: int | None) -> list[dict]:
+    """Run batch entries in a process pool.
 
+    An entry is only started while the summed memory estimates of running
+    entries stay within `memory_budget` (an entry that exceeds the budget on
+    its own still runs, but alone). Entries whose outputs would not fit on
+    the release disk are skipped up front. A failing entry is reported in
+    the summary and does not stop the others.
+    """
+    estimates = [estimate_entry(cfg, entry) for entry in entries]
+    results: list[dict] = [
+        {"entry": entry, "estimate": est, "status": "pending", "error": "", "seconds": 0.0, "release_dir": "", "log": ""}
+        for entry, est in zip(entries, estimates)
+    ]
+
+    pending = []
+    disk_left = free_disk_bytes(Path(cfg["output"]["release_root"]))
+    for i, est in enumerate(estimates):
+        if est["disk_bytes"] > disk_left:
+            results[i]["status"] = "skipped"
+            results[i]["error"] = f"needs ~{est['disk_bytes'] / 1e9:.1f} GB disk, {disk_left / 1e9:.1f} GB left"
+            continue
+        disk_left -= est["disk_bytes"]
+        pending.append(i)
+
+    running: dict = {}
+    used_memory = 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        while pending or running:
+            for i in list(pending):
+                if len(running) >= jobs:
+                    break
+                need = estimates[i]["memory_bytes"]
+                if running and memory_budget is not None and used_memory + need > memory_budget:
+                    continue
+                print(f"[batch] start {entries[i]['preset']} (~{need / 2**20:.0f} MB)")
+                running[pool.submit(_entry_worker, cfg, entries[i], ts, orchestrator)] = i
+                used_memory += need
+                pending.remove(i)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                i = running.pop(fut)
+                used_memory -= estimates[i]["memory_bytes"]
+                try:
+                    res = fut.result()
+                except BaseException as e:  # worker process died (e.g. OOM kill)
+                    res = {"status": "failed", "error": f"{type(e).__name__}: {e}", "seconds": 0.0, "timings": {}}
+                _merge_timings(res.pop("timings", {}))
+                results[i].update(res)
+                print(f"[batch] {results[i]['status']} {entries[i]['preset']} ({results[i]['seconds']:.1f} s)")
+    return results
+
+def print_batch_summary(results: list[dict]) -> None:
+    print("\nBATCH SUMMARY:")
+    print(f"{'preset':<16}{'status':<9}{'time s':>8}{'est RAM MB':>12}{'est disk MB':>13}  release_dir / error")
+    for r in results:
+        est = r["estimate"]
+        detail = r["error"] or r["release_dir"]
+        print(
+            f"{r['entry']['preset']:<16}{r['status']:<9}{r['seconds']:>8.1f}"
+            f"{est['memory_bytes'] / 2**20:>12.0f}{est['disk_bytes'] / 2**20:>13.0f}  {detail}"
+        )
+        if r["status"] == "failed" and r["log"]:
+            print(f"{'':<16}log: {r['log']}")
+
+def main(
+    config: str = "config.yaml",
+    orchestrator: str | None = None,
+    startup_report: bool = False,
+    jobs: int | None = None,
+    resume: str | None = None,
+    force_stages: list[str] | None = None,
+    plan: bool = False,
+    recalibrate: bool = False,
+) -> None:
+    cfg = yaml.safe_load(Path(config).read_text(encoding="utf-8"))
+    ts = resume or datetime.now().strftime("%Y-%m-%d_%H%M")
+    render_cfg = cfg.get("render") or {}
+    if resume:
+        # Same release dirs as the interrupted run; stages pick up their checkpoints
+        render_cfg["resume"] = True
+        cfg["render"] = render_cfg
+    if force_stages:
+        render_cfg["force_stages"] = force_stages
+        cfg["render"] = render_cfg
+    orchestrator = orchestrator or render_cfg.get("orchestrator", "inprocess")
+    jobs = jobs or int(render_cfg.get("jobs", 1))
+    entries = build_entries(cfg)
+    if not (resume or force_stages):
+        entries, released = dedupe_entries(cfg, entries)
+        for r in released:
+            print(f"[dedupe] skipping {r['preset']} {r['title']!r}, already released: {', '.join(r['release_dirs'])}")
+        if not entries:
+            print("Nothing to render (--force_stage all renders anyway)")
+            return
+    if plan:
+        from planner import plan as plan_batch
+
+        if not plan_batch(cfg, entries, orchestrator, jobs, recalibrate):
+            sys.exit(1)
+        return
+    prerender_covers(cfg, entries, ts, orchestrator)
+
+    if jobs > 1:
+        results = run_batch(cfg, entries, ts, orchestrator, jobs, batch_memory_budget(render_cfg))
+        print_batch_summary(results)
+        print_timing_report(orchestrator, startup_report)
+        if any(r["status"] != "ok" for r in results):
+            sys.exit(1)
+        return
+
+    # Unlike run_batch (which skips what does not fit), a sequential run would
+    # only stop once the disk is full
+    disk = sum(estimate_entry(cfg, entry)["disk_bytes"] for entry in entries)
+    free = free_disk_bytes(Path(cfg["output"]["release_root"]))
+    if disk > free and not resume:
+        sys.exit(f"Not enough disk space: the batch needs ~{disk / 1e9:.1f} GB, {free / 1e9:.1f} GB free (see --plan)")
+    for entry in entries:
+        run_entry(cfg, entry, ts, orchestrator)
+
+    print_timing_report(orchestrator, startup_report)
+
+def cli(argv: list[str] | None = None) -> None:
+    import argparse
+    p = argparse.ArgumentParser()
+    p.add_argument("--config", default="config.yaml")
+    p.add_argument("--orchestrator", choices=["inprocess", "subprocess"], default=None)
+    p.add_argument("--startup_report", action="store_true")
+    p.add_argument("--jobs", type=int, default=None)
+    p.add_argument("--resume", metavar="TIMESTAMP", default=None,
+                   help="continue an interrupted run, e.g. 2024-05-01_2130 from its release dir names")
+    p.add_argument("--force_stage", "--force-stage", dest="force_stages", nargs="+", default=None,
+                   choices=[*STAGES, "all"],
+                   help="run these stages even if their fingerprint is unchanged; also renders already released entries")
+    p.add_argument("--plan", action="store_true",
+                   help="only predict wall time, peak RAM and disk of the batch; exit 1 if it does not fit on disk")
+    p.add_argument("--recalibrate", action="store_true", help="with --plan: renew the cached stage throughput calibration")
+    args = p.parse_args(argv)
+    main(
+        args.config, args.orchestrator, args.startup_report, args.jobs, args.resume, args.force_stages,
+        args.plan, args.recalibrate,
+    )
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,159 @@
+from __future__ import annotations
+import math
+from typing import Callable
+import numpy as np
+import scipy.fft
+
+from noise_kernels import NoiseKernel, add_clicks, RainWindow
+
+
+# Shape name -> magnitude(freqs, sr); filled by @register_shape. Shapes use the
+# preset names, so a batch entry switches engines without renaming its preset.
+SHAPES: dict[str, Callable[[np.ndarray, int], np.ndarray]] = {}
+
+# Raw output level of the engine (-20 dBFS RMS); postprocess normalizes anyway,
+# this only keeps the raw WAV far from clipping
+TARGET_RMS = 0.1
+# 1/f shapes are flat below this frequency instead of growing towards DC
+F_MIN = 5.0
+
+
+def register_shape(name: str):
+    def deco(fn: Callable[[np.ndarray, int], np.ndarray]) -> Callable[[np.ndarray, int], np.ndarray]:
+        SHAPES[name] = fn
+        return fn
+    return deco
+
+
+def boxcar_corner(sr: int, divisor: int) -> float:
+    # -3 dB point of the kernels' MovingAverage(max(3, int(sr / divisor)))
+    return 0.443 * sr / max(3, int(sr / divisor))
+
+
+def smooth_lowpass(f: np.ndarray, corner: float) -> np.ndarray:
+    # Monotonic 12 dB/oct roll-off at the boxcar's -3 dB point, without its sidelobes
+    return 1.0 / np.sqrt(1.0 + (f / corner) ** 4)
+
+
+@register_shape("brown_noise")
+def _brown(f: np.ndarray, sr: int) -> np.ndarray:
+    return 1.0 / np.maximum(f, F_MIN)
+
+
+@register_shape("pink_noise")
+def _pink(f: np.ndarray, sr: int) -> np.ndarray:
+    return 1.0 / np.sqrt(np.maximum(f, F_MIN))
+
+
+@register_shape("fan_noise")
+def _fan(f: np.ndarray, sr: int) -> np.ndarray:
+    # Same mix as FanNoise: 0.7 * integrated white (gain 0.02 -> 0.02 * sr / (2 pi f))
+    # plus 0.015 white, then its moving-average lowpass
+    brown = 0.7 * 0.02 * sr / (2 * math.pi * np.maximum(f, F_MIN))
+    return np.sqrt(brown ** 2 + 0.015 ** 2) * smooth_lowpass(f, boxcar_corner(sr, 800))
+
+
+@register_shape("rain_window")
+def _rain(f: np.ndarray, sr: int) -> np.ndarray:
+    # RainWindow's band: white minus a long moving average, then a short one
+    highpass = 1.0 - smooth_lowpass(f, boxcar_corner(sr, 200))
+    return highpass * smooth_lowpass(f, boxcar_corner(sr, 3500))
+
+
+def fir_taps(sr: int) -> int:
+    # ~3 Hz frequency grid (16384 taps at 32-48 kHz), fine enough for the 1/f
+    # slopes and an 18 Hz highpass; longer FIRs cost FFT size for no audible gain
+    return 1 << max(10, math.ceil(math.log2(sr / 3)))
+
+
+def design_fir(shape: str, sr: int, highpass_hz: float | None, lowpass_hz: float | None) -> np.ndarray:
+    """Linear-phase FIR with the magnitude of `shape` times the config filters.
+
+    The highpass/lowpass enter as the squared magnitude of postprocess's
+    Butterworth sections, i.e. what its filtfilt applies. The FIR is scaled
+    so white noise of unit variance comes out at TARGET_RMS.
+    """
+    if shape not in SHAPES:
+        raise ValueError(f"No spectral shape for preset {shape} (known: {', '.join(SHAPES)})")
+    from postprocess import butter_sos
+    from scipy.signal import sosfreqz
+
+    taps = fir_taps(sr)
+    freqs = np.fft.rfftfreq(taps, 1.0 / sr)
+    mag = SHAPES[shape](freqs, sr).astype(np.float64)
+    mag[0] = 0.0
+    sos = butter_sos(sr, lowpass_hz=lowpass_hz, highpass_hz=highpass_hz)
+    if sos is not None:
+        _, h = sosfreqz(sos, worN=freqs, fs=sr)
+        mag *= np.abs(h) ** 2
+    fir = np.roll(np.fft.irfft(mag, taps), taps // 2) * np.hanning(taps)
+    fir *= TARGET_RMS / math.sqrt(float(np.sum(fir ** 2)))
+    return fir
+
+
+class SpectralNoise(NoiseKernel):
+    """Shaped noise by FFT overlap-add: white noise convolved with design_fir().
+
+    Each block of white noise is filtered in one rfft/irfft of a fixed size;
+    the last taps - 1 samples of the convolution are carried and added to the
+    next block, so the output is exactly the linear convolution of one
+    continuous white stream and has no seams. The first render primes the
+    carry with taps frames of white noise, so there is no fade-in. All
+    channels go through one batched transform per block.
+    """
+
+    __slots__ = ("name", "fir", "nfft", "spectrum", "tail", "primed", "click_offsets", "click_env")
+    engine = "fft"
+
+    def __init__(
+        self, preset: str, sr: int, block_frames: int = 65536,
+        highpass_hz: float | None = None, lowpass_hz: float | None = None,
+        channels: int = 1, correlation: float = 0.0,
+    ) -> None:
+        super().__init__(sr, block_frames, channels, correlation)
+        self.name = preset
+        self.fir = design_fir(preset, sr, highpass_hz, lowpass_hz).astype(np.float32)
+        taps = self.fir.size
+        self.nfft = scipy.fft.next_fast_len(block_frames + taps - 1, real=True)
+        self.spectrum = scipy.fft.rfft(self.fir, self.nfft)
+        self.white = np.empty((channels, max(block_frames, taps)), dtype=np.float32)
+        self.tail = np.zeros((channels, taps - 1), dtype=np.float32)
+        self.primed = False
+        self.click_offsets = self.click_env = None
+        if preset == "rain_window":
+            # Same drop clicks as RainWindow, at the same level relative to the band
+            click_len = max(1, int(sr * RainWindow.CLICK_SECONDS))
+            self.click_offsets = np.arange(click_len)
+            decay = np.exp(-self.click_offsets / (sr * RainWindow.CLICK_DECAY_SECONDS))
+            self.click_env = (decay * 0.7 * TARGET_RMS).astype(np.float32)
+
+    def _convolve(self, white: np.ndarray, out: np.ndarray) -> np.ndarray:
+        n = white.shape[1]
+        k = self.tail.shape[1]
+        y = scipy.fft.irfft(scipy.fft.rfft(white, self.nfft, axis=1) * self.spectrum, self.nfft, axis=1)[:, :n + k]
+        y[:, :k] += self.tail
+        out[:] = y[:, :n]
+        self.tail[:] = y[:, n:n + k]
+        return out
+
+    def render(self, n: int, rng: np.random.Generator) -> np.ndarray:
+        if not self.primed:
+            prime = self.noise(self.white[:, :self.fir.size], rng)
+            for start in range(0, prime.shape[1], self.block_frames):
+                part = prime[:, start:start + self.block_frames]
+                self._convolve(part, np.empty_like(part))
+            self.primed = True
+        white = self.noise(self.white[:, :n], rng)
+        out = self._convolve(white, self.out[:, :n])
+        if self.click_env is not None:
+            for row, stream in zip(out, self.channel_streams(rng)):
+                add_clicks(row, stream, self.sr, RainWindow.RATE, self.click_offsets, self.click_env)
+        return self.emit(out)
+
+    def get_state(self) -> dict:
+        return {**super().get_state(), "tail": self.tail.copy(), "primed": self.primed}
+
+    def set_state(self, state: dict) -> None:
+        super().set_state(state)
+        self.tail[:] = state["tail"]
+        self.primed = bool(state["primed"])
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+from functools import lru_cache
+from pathlib import Path
+import ast
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from block_pipeline import sha256_file
+
+
+CACHE_DIRNAME = ".stage_cache"
+# Flags that change how a stage runs, not what it writes: flag -> number of values
+RUN_ONLY_FLAGS = {"--checkpoint": 0, "--resume": 0, "--workers": 1, "--cache_dir": 1, "--queue_depth": 1}
+# Restored outputs from this size on are hard links (audio), smaller ones copies:
+# writers like shutil.copyfile or soundfile rewrite files in place
+LINK_MIN_BYTES = 1 << 20
+MODULE_DIR = Path(__file__).resolve().parent
+
+
+@lru_cache(maxsize=None)
+def code_version(module: str) -> str:
+    # SHA-256 over the source of `module` and of every module of this directory
+    # it imports (also inside functions), transitively
+    seen: set[str] = set()
+    todo = [module]
+    while todo:
+        name = todo.pop()
+        path = MODULE_DIR / f"{name}.py"
+        if name in seen or not path.exists():
+            continue
+        seen.add(name)
+        for node in ast.walk(ast.parse(path.read_bytes())):
+            if isinstance(node, ast.Import):
+                todo.extend(alias.name.split(".")[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                todo.append(node.module.split(".")[0])
+    h = hashlib.sha256()
+    for name in sorted(seen):
+        h.update(name.encode("utf-8") + b"\0" + (MODULE_DIR / f"{name}.py").read_bytes())
+    return h.hexdigest()
+
+
+def _stat(path: Path) -> list[int]:
+    st = path.stat()
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _try_link(src: Path, dst: Path) -> bool:
+    try:
+        os.link(src, dst)
+        return True
+    except OSError:  # other filesystem, no hard link support
+        return False
+
+
+def _write_json(path: Path, payload: dict) -> None:
+    # Atomic replace; batch workers share the cache dir
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(payload, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+class Stage:
+    # One planned stage run: its fingerprint and a stored run with the same key, if any
+
+    __slots__ = ("name", "key", "fingerprint", "outputs", "record")
+
+    def __init__(self, name: str, fingerprint: dict, outputs: list[Path], record: dict | None) -> None:
+        self.name = name
+        self.fingerprint = fingerprint
+        self.key = hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode("utf-8")).hexdigest()
+        self.outputs = outputs
+        self.record = record
+
+
+class StageCache:
+    """Stage fingerprints and the outputs they produced, in <release_root>/.stage_cache.
+
+    A stage's fingerprint covers its module's code_version(), its argv and
+    the content hashes of the files it reads. Paths inside the entry's
+    release dirs enter the argv as "{release_dir<i>}/name", so a later run
+    in new timestamped dirs computes the same fingerprint; an argument that
+    is a release dir itself stays verbatim (qc_report writes the dir name
+    into its report). RUN_ONLY_FLAGS and the `volatile` flags of plan() do
+    not count.
+
+    store() records the outputs of a stage that ran, with size and mtime.
+    restore() hard-links (audio) or copies the outputs of a matching record
+    into place if they are all still unchanged; otherwise the stage has to
+    run, after detach() gave linked outputs their own copy.
+    Stages named in `force` ("all" for every stage) always run. Content
+    hashes come from valid WAV/export sidecars, otherwise the file is hashed
+    once and the digest memoized by path, size and mtime.
+    """
+
+    def __init__(self, release_root: str | Path, release_dirs: list[Path], force: set[str] | None = None) -> None:
+        self.dir = Path(release_root) / CACHE_DIRNAME
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.release_dirs = [str(d) for d in release_dirs]
+        self.force = force or set()
+        self.memo_path = self.dir / "digests.json"
+        try:
+            self.memo: dict[str, list] = json.loads(self.memo_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            self.memo = {}
+
+    def normalize(self, arg: str) -> str:
+        for i, d in enumerate(self.release_dirs):
+            if arg.startswith(d + os.sep):
+                return f"{{release_dir{i}}}" + arg[len(d):]
+        return arg
+
+    def digest(self, path: Path) -> str | None:
+        if not path.exists():
+            return None
+        stat = _stat(path)
+        key = str(path.resolve())
+        memo = self.memo.get(key)
+        if memo is not None and memo[:2] == stat:
+            return memo[2]
+        from wav_analysis import load_sidecar
+
+        sidecar = load_sidecar(path, metrics=[])
+        sha = sidecar["sha256"] if sidecar and "sha256" in sidecar else sha256_file(path)
+        self.memo[key] = [*stat, sha]
+        return sha
+
+    def plan(self, cmd: list[str], inputs=(), outputs=(), volatile=()) -> Stage:
+        name = Path(cmd[1]).stem
+        args = []
+        rest = cmd[2:]
+        i = 0
+        while i < len(rest):
+            if rest[i] in RUN_ONLY_FLAGS or rest[i] in volatile:
+                i += 1 + RUN_ONLY_FLAGS.get(rest[i], 1)
+                continue
+            args.append(self.normalize(rest[i]))
+            i += 1
+        fingerprint = {
+            "stage": name,
+            "code": code_version(name),
+            "args": args,
+            "inputs": [[self.normalize(str(p)), self.digest(Path(p))] for p in inputs],
+        }
+        stage = Stage(name, fingerprint, [Path(p) for p in outputs], None)
+        record_path = self.dir / f"{stage.key}.json"
+        if not ({name, "all"} & self.force) and record_path.exists():
+            try:
+                stage.record = json.loads(record_path.read_text(encoding="utf-8"))
+            except ValueError:
+                pass
+        return stage
+
+    def restore(self, stage: Stage) -> bool:
+        if stage.record is None:
+            return False
+        saved = stage.record["outputs"]
+        if len(saved) != len(stage.outputs):
+            return False
+        for out in saved:
+            src = Path(out["path"])
+            if not src.exists() or _stat(src) != [out["size"], out["mtime_ns"]]:
+                return False
+        for out, dst in zip(saved, stage.outputs):
+            src = Path(out["path"])
+            if dst.exists() and os.path.samefile(src, dst):
+                continue
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            dst.unlink(missing_ok=True)
+            if not (out["size"] >= LINK_MIN_BYTES and _try_link(src, dst)):
+                shutil.copy2(src, dst)  # keeps the mtime, so sidecars stay valid
+            memo = self.memo.get(str(src.resolve()))
+            if memo is not None:
+                self.memo[str(dst.resolve())] = memo
+        # Record the new copies, the old release dir may be deleted later
+        self.store(stage)
+        return True
+
+    def detach(self, stage: Stage) -> None:
+        # Before a stage runs over outputs that are hard links into other release
+        # dirs: give them their own copy, so writing in place cannot change those
+        for path in stage.outputs:
+            if path.exists() and path.stat().st_nlink > 1:
+                tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+                shutil.copy2(path, tmp)
+                os.replace(tmp, path)
+
+    def store(self, stage: Stage) -> None:
+        if not all(p.exists() for p in stage.outputs):
+            return  # e.g. moved into the release pack; nothing to reuse
+        outputs = []
+        for path in stage.outputs:
+            size, mtime_ns = _stat(path)
+            outputs.append({"path": str(path.resolve()), "size": size, "mtime_ns": mtime_ns})
+        _write_json(self.dir / f"{stage.key}.json", {
+            "stage": stage.name,
+            "stored": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "fingerprint": stage.fingerprint,
+            "outputs": outputs,
+        })
+        # Digests of files that are gone are dropped
+        self.memo = {path: memo for path, memo in self.memo.items() if os.path.exists(path)}
+        _write_json(self.memo_path, self.memo)
@@ -0,0 +1,249 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator
+import json
+import os
+import resource
+import threading
+import time
+
+
+# Child processes (subprocess orchestrator) append their spans to this file
+TRACE_ENV = "AUDIO_FACTORY_TRACE"
+
+_subscribers: list[Callable[[dict], None]] = []
+_local = threading.local()
+# Measured in-process spans running in any thread. VmHWM is per process, so
+# only a span starting while none runs may reset it
+_active = 0
+_active_lock = threading.Lock()
+_outer_reset = False  # whether the outermost running span could reset it
+
+
+def subscribe(callback: Callable[[dict], None]) -> None:
+    """Call `callback(event)` for every finished span in this process.
+
+    An event is a flat dict: name, cat, ts (epoch start), wall_s, cpu_s,
+    peak_rss_mb, peak_rss_scope, read_bytes, written_bytes, blocks, frames,
+    blocks_per_s, status, pid, tid, parent and any attributes given to span().
+    """
+    _subscribers.append(callback)
+
+
+def unsubscribe(callback: Callable[[dict], None]) -> None:
+    if callback in _subscribers:
+        _subscribers.remove(callback)
+
+
+def _proc_io() -> tuple[int, int] | None:
+    # Bytes through read()/write() syscalls of this process (page cache included)
+    try:
+        fields = dict(line.split(": ") for line in Path("/proc/self/io").read_text().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _hwm_kb() -> int | None:
+    try:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _reset_hwm() -> bool:
+    # Linux: writing 5 to clear_refs resets the peak RSS (VmHWM) to the current RSS
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class Span:
+    """A measured section; block loops call add() once per block."""
+
+    __slots__ = ("name", "cat", "attrs", "blocks", "frames", "parent")
+
+    def __init__(self, name: str, cat: str, attrs: dict, parent: Span | None) -> None:
+        self.name = name
+        self.cat = cat
+        self.attrs = attrs
+        self.blocks = 0
+        self.frames = 0
+        self.parent = parent
+
+    def add(self, frames: int = 0, blocks: int = 1) -> None:
+        self.blocks += blocks
+        self.frames += frames
+
+
+@contextmanager
+def span(name: str, cat: str = "block", children: bool = False, **attrs) -> Iterator[Span]:
+    """Measure wall/CPU time, peak RSS and I/O bytes of the enclosed code.
+
+    Peak RSS is process-wide, so peak_rss_scope says what it covers: "span"
+    for a span that started while no other span ran in any thread (the
+    high-water mark is reset for it where /proc allows); "inclusive" for
+    nested and concurrent spans, which report the process peak since the
+    outermost running span started, an upper bound for their own; "process"
+    where the mark cannot be reset (the peak since process start). With
+    `children`, CPU time and peak RSS ("child") are taken from waited-for
+    child processes instead (subprocess stages); their I/O, and their peak
+    RSS unless it exceeds every earlier child, is not visible from here and
+    is reported as null. The spans inside such a stage come from the child
+    itself.
+    """
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    parent = stack[-1] if stack else None
+    sp = Span(name, cat, attrs, parent)
+    if not _subscribers:
+        # Nobody listening: only the block counters, no syscalls
+        stack.append(sp)
+        try:
+            yield sp
+        finally:
+            stack.pop()
+        return
+
+    global _active, _outer_reset
+    reset = False
+    if not children:
+        with _active_lock:
+            if _active == 0:
+                reset = _outer_reset = _reset_hwm()
+            _active += 1
+    io0 = None if children else _proc_io()
+    ru0 = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    ts = time.time()
+    t0 = time.perf_counter()
+    status = "ok"
+    stack.append(sp)
+    try:
+        yield sp
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        stack.pop()
+        if not children:
+            with _active_lock:
+                _active -= 1
+        wall = time.perf_counter() - t0
+        ru1 = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+        cpu = (ru1.ru_utime - ru0.ru_utime) + (ru1.ru_stime - ru0.ru_stime)
+        if children:
+            # ru_maxrss of children is the largest child so far; it only tells
+            # something about this stage if it grew during it
+            peak_kb = ru1.ru_maxrss if ru1.ru_maxrss > ru0.ru_maxrss else None
+            scope = "child" if peak_kb is not None else None
+        else:
+            # Nobody else resets the mark while a span runs, so VmHWM covers
+            # at least the time since the outermost running span started
+            hwm = _hwm_kb()
+            if hwm is not None and reset:
+                peak_kb, scope = hwm, "span"
+            elif hwm is not None and _outer_reset:
+                peak_kb, scope = hwm, "inclusive"
+            else:
+                peak_kb, scope = ru1.ru_maxrss, "process"
+        io1 = _proc_io() if io0 is not None else None
+        event = {
+            "name": name,
+            "cat": cat,
+            "ts": ts,
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "peak_rss_mb": peak_kb / 1024 if peak_kb is not None else None,
+            "peak_rss_scope": scope,
+            "read_bytes": io1[0] - io0[0] if io1 else None,
+            "written_bytes": io1[1] - io0[1] if io1 else None,
+            "blocks": sp.blocks,
+            "frames": sp.frames,
+            "blocks_per_s": sp.blocks / wall if sp.blocks and wall > 0 else None,
+            "status": status,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "parent": parent.name if parent is not None else None,
+            **attrs,
+        }
+        for callback in list(_subscribers):
+            callback(event)
+
+
+class JsonLinesSink:
+    # One event per line; O_APPEND writes of whole lines, so several processes
+    # can share the file
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def __call__(self, event: dict) -> None:
+        os.write(self.fd, (json.dumps(event) + "\n").encode("utf-8"))
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def write_chrome_trace(jsonl_path: str | Path, out_path: str | Path) -> None:
+    # Complete ("X") events for chrome://tracing / Perfetto
+    events = []
+    for line in Path(jsonl_path).read_text(encoding="utf-8").splitlines():
+        if not line.strip():
+            continue
+        e = json.loads(line)
+        args = {k: v for k, v in e.items() if k not in ("name", "cat", "ts", "wall_s", "pid", "tid")}
+        events.append({
+            "name": e["name"],
+            "cat": e["cat"],
+            "ph": "X",
+            "ts": e["ts"] * 1e6,
+            "dur": e["wall_s"] * 1e6,
+            "pid": e["pid"],
+            "tid": e["tid"],
+            "args": args,
+        })
+    Path(out_path).write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}), encoding="utf-8")
+
+
+@contextmanager
+def trace_to(jsonl_path: str | Path, chrome_path: str | Path | None = None) -> Iterator[None]:
+    """Append all spans of this process and of stage subprocesses to `jsonl_path`.
+
+    With `chrome_path`, the JSON-lines file is converted to a Chrome
+    trace-event file on exit.
+    """
+    sink = JsonLinesSink(jsonl_path)
+    previous = os.environ.get(TRACE_ENV)
+    os.environ[TRACE_ENV] = str(jsonl_path)
+    subscribe(sink)
+    try:
+        yield
+    finally:
+        unsubscribe(sink)
+        sink.close()
+        if previous is None:
+            os.environ.pop(TRACE_ENV, None)
+        else:
+            os.environ[TRACE_ENV] = previous
+        if chrome_path is not None:
+            write_chrome_trace(jsonl_path, chrome_path)
+
+
+def _subscribe_from_env() -> None:
+    # Stage subprocesses started inside trace_to() trace into the parent's file
+    path = os.environ.get(TRACE_ENV)
+    if path and not any(isinstance(s, JsonLinesSink) for s in _subscribers):
+        subscribe(JsonLinesSink(path))
+
+
+_subscribe_from_env()
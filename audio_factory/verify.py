@@ -0,0 +1,272 @@
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+import hashlib
+import json
+import mmap
+import os
+import zipfile
+
+import soundfile as sf
+
+from catalog import PACK_SHA_NAME, QC_REPORT_NAME
+from qc_report import stream_metrics
+from stage_cache import code_version
+from wav_analysis import analyze_wav
+
+
+CACHE_NAME = ".verify_cache.json"
+REPORT_NAME = "verify_report.json"
+# Gate tolerances. The streaming postprocess may differ from the in-memory one
+# by 2 LSB of PCM_16, the README allows ±0.1% duration
+RMS_TOLERANCE_DB = 0.1
+PEAK_TOLERANCE = 2 / 32768
+DURATION_TOLERANCE = 0.001
+BIT_DEPTH = {"PCM_S8": 8, "PCM_U8": 8, "PCM_16": 16, "PCM_24": 24, "PCM_32": 32, "FLOAT": 32, "DOUBLE": 64}
+MEMBER_CHUNK = 4 * 1024 * 1024
+
+
+def sha256_mapped(path: Path) -> str:
+    # Hashes the file through a read-only mapping: no copies into Python
+    # buffers, sequential read-ahead by the kernel
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return h.hexdigest()  # empty files cannot be mapped
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            h.update(m)
+    return h.hexdigest()
+
+
+def measure_audio(release_dir: Path, qc: dict) -> dict:
+    # Hash, format, peak and RMS of the final WAV in one read (wav_analysis).
+    # With pack_audio "move" and a WAV deliverable it only exists inside the
+    # zip; the stored member is then streamed twice (hash, stream_metrics).
+    wav = release_dir / qc["wav_filename"]
+    if wav.exists():
+        analysis = analyze_wav(wav, metrics=[])
+        return {key: analysis[key] for key in ("sha256", "frames", "sample_rate", "subtype", "peak_linear", "rms_dbfs")}
+    with zipfile.ZipFile(release_dir / "release_pack.zip") as zf:
+        h = hashlib.sha256()
+        with zf.open(qc["wav_filename"]) as member:
+            for chunk in iter(lambda: member.read(MEMBER_CHUNK), b""):
+                h.update(chunk)
+        with zf.open(qc["wav_filename"]) as member:
+            info = sf.info(member)
+        with zf.open(qc["wav_filename"]) as member:
+            peak, rms_db = stream_metrics(member)
+    return {
+        "sha256": h.hexdigest(),
+        "frames": info.frames,
+        "sample_rate": info.samplerate,
+        "subtype": info.subtype,
+        "peak_linear": peak,
+        "rms_dbfs": rms_db,
+    }
+
+
+def check_gates(qc: dict, audio: dict, pack_sha: str, recorded_sha: str, sample_rate: int, bit_depth: int) -> dict:
+    # Gate name -> {"passed", "value", "expected"}; the README's quality gates,
+    # plus the WAV still being the one QC measured (so its dropout scan holds)
+    target_rms, ceiling = qc["target_rms_db"], qc["peak_ceiling_linear"]
+    peak, rms = audio["peak_linear"], audio["rms_dbfs"]
+    # A peak-limited render ends up quieter than its RMS target, never louder
+    limited = peak >= ceiling - PEAK_TOLERANCE
+    seconds = audio["frames"] / audio["sample_rate"]
+    target_seconds = qc.get("target_duration_seconds")
+    return {
+        "rms": {
+            "passed": abs(rms - target_rms) <= RMS_TOLERANCE_DB or (limited and rms < target_rms),
+            "value": rms,
+            "expected": f"{target_rms:g} dBFS ±{RMS_TOLERANCE_DB:g}" + (", or below if peak-limited" if limited else ""),
+        },
+        "peak": {"passed": peak <= ceiling + PEAK_TOLERANCE, "value": peak, "expected": f"<= {ceiling:g}"},
+        "duration": {
+            "passed": target_seconds is not None and abs(seconds - target_seconds) <= DURATION_TOLERANCE * target_seconds,
+            "value": seconds,
+            "expected": "not recorded by qc_report (re-run it)" if target_seconds is None
+            else f"{target_seconds:g} s ±{DURATION_TOLERANCE:.1%}",
+        },
+        "sample_rate": {"passed": audio["sample_rate"] == sample_rate, "value": audio["sample_rate"], "expected": sample_rate},
+        "bit_depth": {
+            "passed": BIT_DEPTH.get(audio["subtype"]) == bit_depth, "value": audio["subtype"], "expected": bit_depth,
+        },
+        "wav_sha256": {
+            "passed": audio["sha256"] == qc.get("final_wav_sha256"),
+            "value": audio["sha256"],
+            "expected": qc.get("final_wav_sha256"),
+        },
+        "pack_sha256": {"passed": pack_sha == recorded_sha, "value": pack_sha, "expected": recorded_sha},
+        "dropouts": {
+            "passed": qc.get("dropout_count") == 0,
+            "value": ((qc.get("metrics") or {}).get("silence") or {}).get("dropouts", qc.get("dropout_count")),
+            "expected": "none (metrics.Silence)",
+        },
+    }
+
+
+def verify_release(release_dir: str, sample_rate: int, bit_depth: int) -> dict:
+    path = Path(release_dir)
+    result = {"release_dir": release_dir, "passed": False, "cached": False, "gates": {}, "error": ""}
+    try:
+        qc = json.loads((path / QC_REPORT_NAME).read_text(encoding="utf-8"))
+        recorded_sha, _, zip_name = (path / PACK_SHA_NAME).read_text(encoding="utf-8").strip().partition("  ")
+        pack_sha = sha256_mapped(path / zip_name)
+        audio = measure_audio(path, qc)
+        result["gates"] = check_gates(qc, audio, pack_sha, recorded_sha, sample_rate, bit_depth)
+    except (OSError, ValueError, KeyError, RuntimeError, zipfile.BadZipFile) as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+    result["passed"] = all(gate["passed"] for gate in result["gates"].values())
+    return result
+
+
+def gate_files(release_dir: Path) -> dict[str, list[int]]:
+    # Size and mtime of every file the gates read; a cached result is reused
+    # only while these are unchanged
+    names = [QC_REPORT_NAME, PACK_SHA_NAME]
+    try:
+        qc = json.loads((release_dir / QC_REPORT_NAME).read_text(encoding="utf-8"))
+        names.append(qc.get("wav_filename", ""))
+        names.append((release_dir / PACK_SHA_NAME).read_text(encoding="utf-8").strip().partition("  ")[2])
+    except (OSError, ValueError):
+        pass
+    files = {}
+    for name in filter(None, names):
+        try:
+            st = (release_dir / name).stat()
+            files[name] = [st.st_size, st.st_mtime_ns]
+        except OSError:
+            files[name] = None
+    return files
+
+
+def load_cache(path: Path, key: str) -> dict:
+    try:
+        cache = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    return cache["releases"] if cache.get("key") == key else {}
+
+
+def save_cache(path: Path, key: str, releases: dict) -> None:
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps({"key": key, "releases": releases}), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def main(
+    release_root: str,
+    sample_rate: int,
+    bit_depth: int = 16,
+    jobs: int | None = None,
+    out: str | None = None,
+    full: bool = False,
+) -> bool:
+    """Check the README quality gates for every release dir under release_root.
+
+    Releases are verified in parallel (`jobs` processes, default all cores);
+    each one streams its final WAV once and hashes the zip through a memory
+    map. Results are cached in <release_root>/.verify_cache.json together
+    with the size and mtime of the files they read, and reused while those
+    files, the expected format and this module's code are unchanged (`full`
+    re-verifies everything). Writes the pass/fail report to `out` (default
+    <release_root>/verify_report.json) and returns whether all releases passed.
+    """
+    root = Path(release_root)
+    release_dirs = sorted(d for d in root.iterdir() if d.is_dir() and not d.name.startswith("."))
+    cache_path = root / CACHE_NAME
+    key = hashlib.sha256(json.dumps([code_version("verify"), sample_rate, bit_depth]).encode("utf-8")).hexdigest()
+    cached = {} if full else load_cache(cache_path, key)
+
+    results: dict[str, dict] = {}
+    stats: dict[str, dict] = {}
+    todo = []
+    for d in release_dirs:
+        name = str(d.resolve())
+        stats[name] = gate_files(d)
+        entry = cached.get(name)
+        if entry is not None and entry["files"] == stats[name]:
+            results[name] = dict(entry["result"], cached=True)
+        else:
+            todo.append(name)
+
+    def report(result: dict) -> None:
+        failed = [gate for gate, r in result["gates"].items() if not r["passed"]]
+        status = "PASS" if result["passed"] else "FAIL"
+        detail = result["error"] or ", ".join(failed)
+        print(f"[verify] {status} {Path(result['release_dir']).name}{' (cached)' if result['cached'] else ''}"
+              f"{': ' + detail if detail else ''}")
+
+    for result in results.values():
+        report(result)
+    jobs = min(jobs or os.cpu_count() or 1, max(1, len(todo)))
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(verify_release, name, sample_rate, bit_depth) for name in todo]
+            for fut in as_completed(futures):
+                result = fut.result()
+                results[result["release_dir"]] = result
+                report(result)
+    else:
+        for name in todo:
+            results[name] = verify_release(name, sample_rate, bit_depth)
+            report(results[name])
+
+    # Re-stat after verifying: a file that changed meanwhile is checked again next time
+    save_cache(cache_path, key, {
+        name: {"files": stats[name], "result": dict(result, cached=False)}
+        for name, result in results.items() if gate_files(Path(name)) == stats[name]
+    })
+    ordered = [results[str(d.resolve())] for d in release_dirs]
+    passed = sum(r["passed"] for r in ordered)
+    payload = {
+        "verified_at": datetime.now().isoformat(timespec="seconds"),
+        "release_root": str(root.resolve()),
+        "expected": {"sample_rate": sample_rate, "bit_depth": bit_depth},
+        "tolerances": {"rms_db": RMS_TOLERANCE_DB, "peak_linear": PEAK_TOLERANCE, "duration": DURATION_TOLERANCE},
+        "summary": {
+            "releases": len(ordered),
+            "passed": passed,
+            "failed": len(ordered) - passed,
+            "cached": sum(r["cached"] for r in ordered),
+        },
+        "releases": ordered,
+    }
+    out_path = Path(out) if out else root / REPORT_NAME
+    out_path.write_text(json.dumps(payload, indent=2), encoding="utf-8")
+    print(f"{passed}/{len(ordered)} release(s) passed, report written: {out_path}")
+    return passed == len(ordered)
+
+
+def cli(argv: list[str] | None = None) -> None:
+    import argparse
+    import sys
+
+    import yaml
+
+    p = argparse.ArgumentParser(description="Check the quality gates of all releases under release_root")
+    p.add_argument("--config", default="config.yaml", help="release_root and sample rate, if not given")
+    p.add_argument("--release_root", default=None)
+    p.add_argument("--sample_rate", type=int, default=None)
+    p.add_argument("--bit_depth", type=int, default=16)
+    p.add_argument("--jobs", type=int, default=None, help="default: all cores")
+    p.add_argument("--out", default=None, help=f"default: <release_root>/{REPORT_NAME}")
+    p.add_argument("--full", action="store_true", help="ignore cached results")
+    args = p.parse_args(argv)
+    cfg_path = Path(args.config)
+    cfg = yaml.safe_load(cfg_path.read_text(encoding="utf-8-sig")) if cfg_path.exists() else {}
+    release_root = args.release_root or (cfg.get("output") or {}).get("release_root", "releases")
+    sample_rate = args.sample_rate or (cfg.get("audio") or {}).get("sample_rate")
+    if sample_rate is None:
+        p.error("--sample_rate is required without a config")
+    ok = main(release_root, int(sample_rate), args.bit_depth, args.jobs, args.out, args.full)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    cli()
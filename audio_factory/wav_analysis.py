@@ -0,0 +1,281 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import TYPE_CHECKING
+import hashlib
+import io
+import json
+import math
+import numpy as np
+import soundfile as sf
+
+from checkpoint import BYTES_PER_SAMPLE, wav_data_offset
+from metrics import DEFAULT_METRICS, Metric, make_metrics
+from tracing import span
+
+if TYPE_CHECKING:
+    from export_audio import ExportSet
+
+
+SIDECAR_SUFFIX = ".analysis.json"
+CHUNK_BYTES = 4 * 1024 * 1024
+# Metric plugins get at most this many frames at a time (bounds their temporaries)
+METRIC_BLOCK_FRAMES = 65536
+
+# Sidecars are only trusted while the metric plugins that filled them are unchanged
+METRICS_CODE = hashlib.sha256(Path(__file__).with_name("metrics.py").read_bytes()).hexdigest()[:16]
+
+# Full scale of the integer PCM subtypes, as used by soundfile when reading them as float
+PCM_SCALE = {"PCM_16": 2.0 ** 15, "PCM_24": 2.0 ** 23, "PCM_32": 2.0 ** 31, "FLOAT": 1.0}
+
+
+def sidecar_path(wav_path: str | Path) -> Path:
+    return Path(str(wav_path) + SIDECAR_SUFFIX)
+
+
+def decode_pcm(buf: memoryview, subtype: str) -> np.ndarray:
+    # Raw little-endian WAV sample bytes -> samples without the float scaling
+    if subtype == "PCM_16":
+        return np.frombuffer(buf, dtype="<i2")
+    if subtype == "PCM_32":
+        return np.frombuffer(buf, dtype="<i4")
+    if subtype == "FLOAT":
+        return np.frombuffer(buf, dtype="<f4")
+    if subtype == "PCM_24":
+        b = np.frombuffer(buf, dtype=np.uint8).reshape(-1, 3)
+        v = b[:, 0].astype(np.int32) | (b[:, 1].astype(np.int32) << 8) | (b[:, 2].astype(np.int8).astype(np.int32) << 16)
+        return v
+    raise ValueError(f"Unsupported WAV subtype for analysis: {subtype}")
+
+
+def float_to_pcm16(block: np.ndarray) -> np.ndarray:
+    # Explicit float -> PCM_16 quantization, so the writer knows the exact bytes
+    # that end up in the file. Matches libsndfile 1.2's own conversion except
+    # for rare samples right at a step boundary or just below zero (1 LSB).
+    # C order, so the bytes are the interleaved frames even for a block that
+    # came out of a filter along axis 0 as a transposed view.
+    return np.clip(np.floor(block * np.float32(32768.0)), -32768, 32767).astype("<i2", order="C")
+
+
+class WavStats:
+    # Running peak / sum of squares over raw samples, in float units (value / scale)
+
+    __slots__ = ("scale", "peak", "sum_squares", "samples")
+
+    def __init__(self, scale: float) -> None:
+        self.scale = scale
+        self.peak = 0.0
+        self.sum_squares = 0.0
+        self.samples = 0
+
+    def update(self, samples: np.ndarray) -> None:
+        if samples.size == 0:
+            return
+        self.peak = max(self.peak, max(-float(samples.min()), float(samples.max())) / self.scale)
+        x = samples.astype(np.float64).ravel()  # interleaved (frames, channels) blocks too
+        self.sum_squares += float(np.dot(x, x)) / (self.scale * self.scale)
+        self.samples += samples.size
+
+    def rms_dbfs(self) -> float:
+        if self.samples == 0:
+            return float("-inf")
+        return 20 * math.log10(math.sqrt(self.sum_squares / self.samples) + 1e-12)
+
+
+def feed_metrics(plugins: list[Metric], samples: np.ndarray, scale: float, channels: int) -> None:
+    # Raw interleaved samples -> float32 (frames, channels), once for all plugins
+    if not plugins or samples.size == 0:
+        return
+    frames = samples.reshape(-1, channels)
+    for start in range(0, frames.shape[0], METRIC_BLOCK_FRAMES):
+        block = frames[start:start + METRIC_BLOCK_FRAMES].astype(np.float32) * np.float32(1.0 / scale)
+        for plugin in plugins:
+            plugin.update(block)
+
+
+def _result(
+    path: Path, sha256: str, frames: int, sr: int, channels: int, subtype: str, stats: WavStats,
+    plugins: list[Metric],
+) -> dict:
+    st = path.stat()
+    return {
+        "sha256": sha256,
+        "frames": frames,
+        "sample_rate": sr,
+        "channels": channels,
+        "subtype": subtype,
+        "peak_linear": stats.peak,
+        "rms_dbfs": stats.rms_dbfs(),
+        "file_size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "metrics": {plugin.name: plugin.result() for plugin in plugins},
+        "metrics_code": METRICS_CODE,
+    }
+
+
+def analyze_wav(wav_path: str | Path, chunk_bytes: int = CHUNK_BYTES, metrics: list[str] | None = None) -> dict:
+    """Peak, RMS, SHA-256, frame count and metric plugins of a WAV in a single read.
+
+    The file is read in large chunks into one reusable buffer; every chunk is
+    hashed and its sample bytes are decoded from the same buffer, so the data
+    is read from disk once. Peak/RMS match qc_report.stream_metrics. Each
+    decoded chunk is handed to the `metrics` plugins (see metrics.py, default
+    DEFAULT_METRICS); their results are under "metrics".
+    """
+    path = Path(wav_path)
+    info = sf.info(str(path))
+    subtype = info.subtype
+    frame_bytes = BYTES_PER_SAMPLE[subtype] * info.channels
+    data_start = wav_data_offset(path)
+    data_end = data_start + info.frames * frame_bytes
+    # Chunks hold whole frames so samples never straddle two reads
+    buf = bytearray(max(frame_bytes, chunk_bytes // frame_bytes * frame_bytes))
+    view = memoryview(buf)
+    h = hashlib.sha256()
+    stats = WavStats(PCM_SCALE[subtype])
+    plugins = make_metrics(DEFAULT_METRICS if metrics is None else metrics, info.samplerate, info.channels)
+    with path.open("rb", buffering=0) as f, span("analyze_wav", file=path.name) as sp:
+        h.update(f.read(data_start))
+        pos = data_start
+        while pos < data_end:
+            n = f.readinto(view[:min(len(buf), data_end - pos)])
+            if not n:
+                break
+            h.update(view[:n])
+            usable = n - n % frame_bytes
+            samples = decode_pcm(view[:usable], subtype)
+            stats.update(samples)
+            feed_metrics(plugins, samples, stats.scale, info.channels)
+            pos += n
+            sp.add(usable // frame_bytes)
+        # Trailing chunks after the sample data (LIST etc.) only go into the hash
+        while True:
+            n = f.readinto(view)
+            if not n:
+                break
+            h.update(view[:n])
+    return _result(path, h.hexdigest(), info.frames, info.samplerate, info.channels, subtype, stats, plugins)
+
+
+def write_sidecar(wav_path: str | Path, analysis: dict) -> None:
+    sidecar_path(wav_path).write_text(json.dumps(analysis, indent=2), encoding="utf-8")
+
+
+def load_sidecar(wav_path: str | Path, metrics: list[str] | None = None) -> dict | None:
+    # Only trusted while size and mtime still match the WAV it was written for
+    # and it has every requested metric, computed by the current metrics.py
+    path = Path(wav_path)
+    sidecar = sidecar_path(path)
+    if not sidecar.exists():
+        return None
+    try:
+        analysis = json.loads(sidecar.read_text(encoding="utf-8"))
+    except ValueError:
+        return None
+    st = path.stat()
+    if analysis.get("file_size") != st.st_size or analysis.get("mtime_ns") != st.st_mtime_ns:
+        return None
+    wanted = set(DEFAULT_METRICS if metrics is None else metrics)
+    if not wanted <= set(analysis.get("metrics", {})):
+        return None
+    if wanted and analysis.get("metrics_code") != METRICS_CODE:
+        return None
+    return analysis
+
+
+def load_or_analyze(wav_path: str | Path, metrics: list[str] | None = None) -> dict:
+    analysis = load_sidecar(wav_path, metrics)
+    if analysis is None:
+        analysis = analyze_wav(wav_path, metrics=metrics)
+        write_sidecar(wav_path, analysis)
+    return analysis
+
+
+def expected_wav_header(sr: int, channels: int, subtype: str, frames: int) -> bytes:
+    # Header libsndfile writes on close: taken from an empty file, sizes patched in
+    bio = io.BytesIO()
+    with sf.SoundFile(bio, mode="w", samplerate=sr, channels=channels, subtype=subtype, format="WAV"):
+        pass
+    header = bytearray(bio.getvalue())
+    if header[-8:-4] != b"data":
+        raise ValueError("Unexpected WAV header layout")
+    data_bytes = frames * BYTES_PER_SAMPLE[subtype] * channels
+    header[4:8] = (len(header) - 8 + data_bytes).to_bytes(4, "little")
+    header[-4:] = data_bytes.to_bytes(4, "little")
+    return bytes(header)
+
+
+class AnalyzingWavWriter:
+    """PCM_16 WAV writer that hashes and measures exactly what it writes.
+
+    Wraps an open soundfile writer. Float blocks are quantized here
+    (float_to_pcm16) and written as int16, so the file bytes are known while
+    writing: the SHA-256 starts with the header the file will have once
+    `frames` frames are written. On close the real header is compared with
+    the expected one; a mismatch, a different frame count or a writer that
+    did not start at frame 0 (resumed from a checkpoint) falls back to
+    analyze_wav. The result is stored in the sidecar that qc_report trusts;
+    the `metrics` plugins see the quantized samples, as analyze_wav would.
+    `exports` (export_audio.ExportSet) gets every block for its encoders and
+    is closed after the WAV.
+    """
+
+    def __init__(
+        self, f: sf.SoundFile, frames: int, metrics: list[str] | None = None, exports: ExportSet | None = None,
+    ) -> None:
+        if f.subtype != "PCM_16":
+            raise ValueError(f"AnalyzingWavWriter writes PCM_16, got {f.subtype}")
+        self.f = f
+        self.sr = f.samplerate
+        self.channels = f.channels
+        self.frames = frames
+        self.hashing = f.tell() == 0
+        self.header = expected_wav_header(f.samplerate, f.channels, f.subtype, frames)
+        self.sha = hashlib.sha256(self.header)
+        self.stats = WavStats(PCM_SCALE["PCM_16"])
+        self.metrics = metrics
+        self.plugins = make_metrics(DEFAULT_METRICS if metrics is None else metrics, f.samplerate, f.channels)
+        self.exports = exports
+        self.written = 0
+        self.analysis: dict | None = None
+        self.export_results: list[dict] = []
+
+    def write(self, block: np.ndarray) -> None:
+        pcm = float_to_pcm16(block)
+        self.f.write(pcm)
+        if self.hashing:
+            self.sha.update(pcm.data)
+            self.stats.update(pcm)
+            feed_metrics(self.plugins, pcm, self.stats.scale, self.channels)
+        if self.exports is not None:
+            self.exports.write(block, pcm)
+        self.written += len(pcm)
+
+    def close(self) -> dict:
+        path = Path(self.f.name)
+        self.f.close()
+        if self.hashing and self.written == self.frames:
+            with path.open("rb") as f:
+                actual = f.read(len(self.header))
+            if actual == self.header and path.stat().st_size == len(self.header) + self.written * 2 * self.channels:
+                self.analysis = _result(
+                    path, self.sha.hexdigest(), self.written, self.sr, self.channels, "PCM_16", self.stats,
+                    self.plugins,
+                )
+        if self.analysis is None:
+            self.analysis = analyze_wav(path, metrics=self.metrics)
+        write_sidecar(path, self.analysis)
+        if self.exports is not None:
+            self.export_results = self.exports.close()
+        return self.analysis
+
+    def __enter__(self) -> AnalyzingWavWriter:
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+            if self.exports is not None:
+                self.exports.abort()